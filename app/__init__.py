@@ -1,5 +1,5 @@
-import os
-from flask import Flask, send_from_directory
+from flask import Flask, abort, jsonify, request
+from werkzeug.security import safe_join
 from flask_sqlalchemy import SQLAlchemy
 from flask_bcrypt import Bcrypt
 from flask_jwt_extended import JWTManager
@@ -18,6 +18,10 @@ mail = Mail()
 def create_app(config_class=Config):  # Modified to accept a config class
     app = Flask(__name__)
     app.config.from_object(config_class)  # Load the provided config class
+
+    # Multipart uploads can be streamed straight into the upload folder
+    from app.utils.upload_utils import UploadRequest
+    app.request_class = UploadRequest
     
     CORS(app, resources={r"/*": {"origins": "http://localhost:3000"}}, supports_credentials=True)
     db.init_app(app)
@@ -47,6 +51,13 @@ def create_app(config_class=Config):  # Modified to accept a config class
         app.register_blueprint(dashboard_routes.bp, url_prefix='/dashboard')
         app.register_blueprint(stat_routes.bp, url_prefix='/stat')
 
+        # CLI commands (flask model ..., flask uploads ..., flask stats ...)
+        from app.commands import jobs_cli, model_cli, stats_cli, uploads_cli
+        app.cli.add_command(model_cli)
+        app.cli.add_command(uploads_cli)
+        app.cli.add_command(stats_cli)
+        app.cli.add_command(jobs_cli)
+
     
         # Create database tables
         db.create_all()
@@ -54,10 +65,31 @@ def create_app(config_class=Config):  # Modified to accept a config class
         # Insert initial data
         from app.models import insert_initial_data
         insert_initial_data()
+
+    # Load the model and trace the graph now rather than on the first request
+    if app.config.get('MODEL_WARMUP'):
+        from app.utils.model_utils import warm_up_model
+        with app.app_context():
+            warm_up_model()
+
+    # Resume prediction jobs that were queued, or lost while running, when the last process stopped
+    if app.config.get('PREDICTION_JOBS_RECOVER'):
+        from app.routes.prediction_routes import run_prediction_job
+        from app.utils.job_utils import get_job_queue
+        with app.app_context():
+            get_job_queue(run_prediction_job)
     
     # Route for serving static files
-    @app.route('/static/uploads/<filename>')
+    @app.route('/static/uploads/<path:filename>')
     def uploaded_file(filename):
-        return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+        # ?variant=thumbnail|web serves a derivative, or the original until it is ready
+        from app.utils.image_utils import IMAGE_VARIANTS
+        from app.utils.serving_utils import serve_upload
+        if safe_join(app.config['UPLOAD_FOLDER'], filename) is None:
+            abort(404)
+        variant = request.args.get('variant')
+        if variant and variant not in IMAGE_VARIANTS:
+            return jsonify({'message': f"Unknown image variant, expected one of {', '.join(IMAGE_VARIANTS)}"}), 400
+        return serve_upload(filename, variant)
     
     return app
\ No newline at end of file
@@ -0,0 +1,188 @@
+import click
+import numpy as np
+import os
+from flask import current_app
+from flask.cli import AppGroup
+from app import db
+from app.models import Blob, Image
+from app.utils.cache_utils import hash_image_file
+from app.utils.image_utils import VARIANT_COLUMNS, variant_path
+from app.utils.inference_backends import convert_model, create_backend, compare_backends
+from app.utils.model_utils import get_model_path, preprocess_image
+from app.utils.storage_utils import file_incoming, get_storage
+from app.utils.gc_utils import collect_garbage
+from app.utils.job_utils import PredictionJobQueue
+from app.utils.stat_utils import reconcile_confidence_counts, reconcile_daily_counts, reconcile_prediction_counts, reconcile_survey_counts
+from app.utils.upload_utils import expire_chunked_uploads
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.gif')
+
+model_cli = AppGroup('model', help='Convert the disease model and check converted backends.')
+
+def _sample_batches(sample_dir, limit, batch_size=16):
+    paths = sorted(
+        os.path.join(root, name)
+        for root, _, names in os.walk(sample_dir)
+        for name in names if name.lower().endswith(IMAGE_EXTENSIONS)
+    )[:limit]
+    if not paths:
+        raise click.ClickException(f"No images found in {sample_dir}")
+    for start in range(0, len(paths), batch_size):
+        yield np.stack([preprocess_image(path) for path in paths[start:start + batch_size]]).astype(np.float32)
+
+@model_cli.command('convert')
+@click.option('--format', 'target', type=click.Choice(['tflite', 'onnx']), required=True, help='Converted model format.')
+@click.option('--quantize', type=click.Choice(['none', 'float16', 'int8']), default='none', show_default=True)
+@click.option('--sample-dir', type=click.Path(exists=True, file_okay=False), help='Leaf images used to calibrate int8 quantisation.')
+@click.option('--limit', default=200, show_default=True, help='Maximum number of calibration images.')
+@click.option('--output', type=click.Path(dir_okay=False), help='Defaults to the configured path for the format.')
+def convert(target, quantize, sample_dir, limit, output):
+    """Convert the Keras model to TFLite or ONNX, optionally quantised."""
+    output = output or get_model_path(target)
+    quantization = None if quantize == 'none' else quantize
+    sample_batches = _sample_batches(sample_dir, limit) if sample_dir else None
+
+    try:
+        convert_model(current_app.config['MODEL_PATH'], output, target, quantization=quantization, sample_batches=sample_batches)
+    except (ImportError, ValueError) as e:
+        raise click.ClickException(str(e))
+
+    click.echo(f"Wrote {target} model ({quantize}) to {output} ({os.path.getsize(output) / 1024 / 1024:.2f} MB)")
+
+@model_cli.command('check-accuracy')
+@click.option('--backend', 'backend_name', type=click.Choice(['tflite', 'onnx']), required=True)
+@click.option('--model-path', type=click.Path(exists=True, dir_okay=False), help='Defaults to the configured path for the backend.')
+@click.option('--sample-dir', type=click.Path(exists=True, file_okay=False), required=True, help='Leaf images to compare on.')
+@click.option('--limit', default=200, show_default=True, help='Maximum number of images to compare.')
+@click.option('--min-agreement', default=0.99, show_default=True, help='Fail when top-1 agreement with Keras is lower.')
+def check_accuracy(backend_name, model_path, sample_dir, limit, min_agreement):
+    """Compare a converted backend's top-1 predictions against Keras."""
+    reference = create_backend('keras', current_app.config['MODEL_PATH'])
+    candidate = create_backend(backend_name, model_path or get_model_path(backend_name))
+    report = compare_backends(reference, candidate, _sample_batches(sample_dir, limit))
+
+    click.echo(f"Images compared:      {report['images']}")
+    click.echo(f"Top-1 agreement:      {100 * report['top1_agreement']:.2f}%")
+    click.echo(f"Max probability diff: {report['max_abs_diff']:.4f}")
+    click.echo(f"Keras latency:        {report['reference_ms_per_image']:.2f} ms/image")
+    click.echo(f"{backend_name + ' latency:':<22}{report['candidate_ms_per_image']:.2f} ms/image")
+
+    if report['top1_agreement'] < min_agreement:
+        raise click.ClickException(f"Top-1 agreement below {100 * min_agreement:.2f}%")
+
+uploads_cli = AppGroup('uploads', help='Maintain the uploaded image store.')
+
+@uploads_cli.command('rehash')
+@click.option('--batch-size', default=500, show_default=True, help='Images moved per transaction.')
+@click.option('--dry-run', is_flag=True, help='Only report what would be moved.')
+def rehash(batch_size, dry_run):
+    """Move flat uploads into content-addressed storage, deduplicating them.
+
+    The flat files are read from local disk and filed into the configured
+    storage backend, so this also migrates them to S3 when that is in use.
+    """
+    storage = get_storage()
+    moved = duplicates = missing = 0
+    stored = {}  # legacy path -> (new path, content hash), for rows sharing a file
+    hashes = set()
+    last_id = 0
+
+    while True:
+        images = Image.query.filter(Image.content_hash.is_(None), Image.id > last_id).order_by(Image.id).limit(batch_size).all()
+        if not images:
+            break
+
+        for image in images:
+            last_id = image.id
+            if image.image_path in stored:
+                image.image_path, image.content_hash = stored[image.image_path]
+                continue
+            if not image.image_path or not os.path.isfile(image.image_path):
+                missing += 1
+                continue
+
+            content_hash = hash_image_file(image.image_path)
+            if content_hash in hashes or db.session.get(Blob, content_hash) is not None:
+                duplicates += 1
+            hashes.add(content_hash)
+            moved += 1
+            if dry_run:
+                continue
+
+            legacy_path = image.image_path
+            variants = {variant: getattr(image, column) for variant, column in VARIANT_COLUMNS.items()}
+            new_path, _ = file_incoming(legacy_path, content_hash, os.path.getsize(legacy_path), legacy_path)
+            image.image_path, image.content_hash = new_path, content_hash
+            stored[legacy_path] = (new_path, content_hash)
+
+            # Variants follow their original, or are dropped when the blob already has them
+            for variant, old_variant_path in variants.items():
+                if not old_variant_path or not os.path.exists(old_variant_path):
+                    continue
+                target = variant_path(new_path, variant)
+                if storage.exists(storage.key_for(target)):
+                    os.remove(old_variant_path)
+                else:
+                    storage.put_file(old_variant_path, storage.key_for(target))
+                setattr(image, VARIANT_COLUMNS[variant], target)
+
+        if not dry_run:
+            db.session.commit()
+
+    action = 'Would move' if dry_run else 'Moved'
+    click.echo(f"{action} {moved} upload(s), {duplicates} of them duplicates; {missing} missing file(s) left as they were")
+
+@uploads_cli.command('expire-partial')
+@click.option('--ttl', type=int, help='Seconds without a new chunk. Defaults to CHUNKED_UPLOAD_TTL.')
+def expire_partial(ttl):
+    """Remove resumable uploads that were abandoned before finalize."""
+    expired = expire_chunked_uploads(ttl if ttl is not None else current_app.config['CHUNKED_UPLOAD_TTL'])
+    click.echo(f"Removed {expired} abandoned upload(s)")
+
+@uploads_cli.command('gc')
+@click.option('--batch-size', default=1000, show_default=True, help='Rows and files handled per transaction.')
+@click.option('--dry-run', is_flag=True, help='Only report what would be deleted; files of images it would expire are not counted.')
+def gc(batch_size, dry_run):
+    """Delete orphaned upload files and rows and apply the retention settings.
+
+    Safe to run from cron while the app serves requests.
+    """
+    report = collect_garbage(batch_size=batch_size, dry_run=dry_run)
+    click.echo(report.summary(dry_run))
+
+stats_cli = AppGroup('stats', help='Maintain the precomputed statistics tables.')
+
+@stats_cli.command('reconcile')
+@click.option('--dry-run', is_flag=True, help='Only report how many counters are wrong.')
+def reconcile(dry_run):
+    """Rebuild the per-user prediction counters, by class and by confidence, and the survey option counters.
+
+    Needed once after restoring a backup or editing predictions in SQL;
+    the app keeps the counters up to date itself.
+    """
+    fixed = reconcile_prediction_counts(dry_run=dry_run)
+    fixed_confidence = reconcile_confidence_counts(dry_run=dry_run)
+    action = 'Would fix' if dry_run else 'Fixed'
+    click.echo(f"{action} {fixed} prediction counter(s)")
+    click.echo(f"{action} {fixed_confidence} confidence counter(s)")
+    click.echo(f"{action} {reconcile_survey_counts(dry_run=dry_run)} survey option counter(s)")
+
+@stats_cli.command('backfill-daily')
+@click.option('--since', type=click.DateTime(formats=['%Y-%m-%d']), help='First day to check. Defaults to the first prediction.')
+@click.option('--dry-run', is_flag=True, help='Only report how many daily counters are missing or wrong.')
+def backfill_daily(since, dry_run):
+    """Fill in and correct the per-user daily prediction counts used by the charts."""
+    fixed = reconcile_daily_counts(since=since.date() if since else None, dry_run=dry_run)
+    action = 'Would fix' if dry_run else 'Fixed'
+    click.echo(f"{action} {fixed} daily prediction counter(s)")
+
+jobs_cli = AppGroup('jobs', help='Manage background prediction jobs.')
+
+@jobs_cli.command('recover')
+@click.option('--stale-after', type=int, help='Seconds without an update before a running job is requeued. Defaults to PREDICTION_JOB_STALE_AFTER.')
+def recover_jobs(stale_after):
+    """Run queued prediction jobs, and running ones lost with a crashed process, in this process."""
+    from app.routes.prediction_routes import run_prediction_job
+    stale_after = stale_after if stale_after is not None else current_app.config['PREDICTION_JOB_STALE_AFTER']
+    queue = PredictionJobQueue(current_app._get_current_object(), run_prediction_job, eager=True, stale_after=stale_after)
+    click.echo(f"Ran {queue.recover()} prediction job(s)")
@@ -4,6 +4,9 @@ import os
 # Load environment variables from .env file
 load_dotenv()
 
+# Project root, where the model files live by default
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
 class Config:
     SQLALCHEMY_DATABASE_URI = os.getenv('SQLALCHEMY_DATABASE_URI')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
@@ -19,9 +22,98 @@ class Config:
     MAIL_PASSWORD = os.getenv('MAIL_PASSWORD')
     MAIL_DEFAULT_SENDER = os.getenv('MAIL_DEFAULT_SENDER')
 
+    # Model file and optional warm-up forward pass when the app boots
+    MODEL_PATH = os.getenv('MODEL_PATH', os.path.join(BASE_DIR, 'best_model1_1.keras'))
+    MODEL_WARMUP = os.getenv('MODEL_WARMUP') == 'True'
+
+    # Inference backend: keras, tflite or onnx (converted with `flask model convert`)
+    INFERENCE_BACKEND = os.getenv('INFERENCE_BACKEND', 'keras')
+    TFLITE_MODEL_PATH = os.getenv('TFLITE_MODEL_PATH', os.path.join(BASE_DIR, 'best_model1_1.tflite'))
+    ONNX_MODEL_PATH = os.getenv('ONNX_MODEL_PATH', os.path.join(BASE_DIR, 'best_model1_1.onnx'))
+    INFERENCE_THREADS = int(os.getenv('INFERENCE_THREADS', 0)) or None  # None keeps the runtime default
+
+    # Image decoding and resizing: tf, or pillow (faster on large JPEGs, no TensorFlow needed)
+    PREPROCESSING_BACKEND = os.getenv('PREPROCESSING_BACKEND', 'tf')
+
+    # Micro-batching of concurrent predictions into one forward pass
+    INFERENCE_BATCHING = os.getenv('INFERENCE_BATCHING', 'True') == 'True'
+    INFERENCE_BATCH_SIZE = int(os.getenv('INFERENCE_BATCH_SIZE', 16))
+    INFERENCE_BATCH_TIMEOUT_MS = float(os.getenv('INFERENCE_BATCH_TIMEOUT_MS', 5))
+    INFERENCE_DECODE_WORKERS = int(os.getenv('INFERENCE_DECODE_WORKERS', 4))
+    PREDICTION_BULK_MAX_IMAGES = int(os.getenv('PREDICTION_BULK_MAX_IMAGES', 200))
+
+    # Multi-process inference pool; 0 processes keeps inference in the web process
+    INFERENCE_POOL_PROCESSES = int(os.getenv('INFERENCE_POOL_PROCESSES', 0))
+    INFERENCE_POOL_THREADS = int(os.getenv('INFERENCE_POOL_THREADS', 1))  # runtime threads per worker process
+    INFERENCE_POOL_QUEUE_SIZE = int(os.getenv('INFERENCE_POOL_QUEUE_SIZE', 64))
+    INFERENCE_POOL_SUBMIT_TIMEOUT = float(os.getenv('INFERENCE_POOL_SUBMIT_TIMEOUT', 0.5))  # seconds before answering 503
+    INFERENCE_POOL_TIMEOUT = float(os.getenv('INFERENCE_POOL_TIMEOUT', 30))  # seconds to wait for a result
+
+    # Prediction cache keyed on image content hash and model version
+    MODEL_VERSION = os.getenv('MODEL_VERSION', 'best_model1_1')
+    PREDICTION_CACHE_ENABLED = os.getenv('PREDICTION_CACHE_ENABLED', 'True') == 'True'
+    PREDICTION_CACHE_SIZE = int(os.getenv('PREDICTION_CACHE_SIZE', 1024))
+    PREDICTION_CACHE_TTL = int(os.getenv('PREDICTION_CACHE_TTL', 86400))  # seconds
+    PREDICTION_CACHE_PERSISTENT = os.getenv('PREDICTION_CACHE_PERSISTENT') == 'True'
+
+    # Where uploads are stored: local (UPLOAD_FOLDER) or s3, for several API nodes.
+    # S3 credentials come from the usual AWS_* environment variables.
+    STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'local')
+    S3_BUCKET = os.getenv('S3_BUCKET')
+    S3_PREFIX = os.getenv('S3_PREFIX', '')
+    S3_ENDPOINT_URL = os.getenv('S3_ENDPOINT_URL')  # e.g. a MinIO server; empty for AWS
+    S3_REGION = os.getenv('S3_REGION')
+    UPLOAD_SPOOL_FOLDER = os.getenv('UPLOAD_SPOOL_FOLDER')  # local scratch space for S3 uploads, defaults to the temp dir
+    S3_PUBLIC_URL = os.getenv('S3_PUBLIC_URL')  # CDN or public bucket URL; uploads are otherwise served by presigned redirects
+    S3_PRESIGN_EXPIRES = int(os.getenv('S3_PRESIGN_EXPIRES', 3600))  # seconds
+
+    # Who sends local upload bytes: the app (empty), or the front web server via
+    # x-accel-redirect (nginx, internal location UPLOAD_ACCEL_PREFIX aliased to
+    # UPLOAD_FOLDER) or x-sendfile (Apache mod_xsendfile, lighttpd)
+    UPLOAD_SENDFILE = os.getenv('UPLOAD_SENDFILE', '')
+    UPLOAD_ACCEL_PREFIX = os.getenv('UPLOAD_ACCEL_PREFIX', '/protected-uploads/')
+
+    # Upload limits, checked while the body streams in: whole request, each image file and its pixel count
+    MAX_CONTENT_LENGTH = int(os.getenv('MAX_CONTENT_LENGTH', 200 * 1024 * 1024))
+    UPLOAD_MAX_BYTES = int(os.getenv('UPLOAD_MAX_BYTES', 20 * 1024 * 1024))
+    UPLOAD_MAX_PIXELS = int(os.getenv('UPLOAD_MAX_PIXELS', 50_000_000))
+
+    # Resumable chunked uploads; unfinished ones are removed once idle for the TTL.
+    # Their chunks are kept on the receiving node (UPLOAD_FOLDER, or UPLOAD_SPOOL_FOLDER under S3)
+    # until the upload completes, so with several API nodes either route each upload's requests to
+    # the same node (sticky sessions on the upload id) or put that folder on storage they all share.
+    CHUNKED_UPLOAD_TTL = int(os.getenv('CHUNKED_UPLOAD_TTL', 86400))  # seconds since the last chunk
+    CHUNKED_UPLOAD_SWEEP_INTERVAL = int(os.getenv('CHUNKED_UPLOAD_SWEEP_INTERVAL', 600))  # seconds between clean-ups
+
+    # Garbage collection of uploads (`flask uploads gc`); retention periods of 0 keep images forever
+    UPLOAD_GC_GRACE_PERIOD = int(os.getenv('UPLOAD_GC_GRACE_PERIOD', 3600))  # seconds; newer files and rows are never touched
+    UPLOAD_UNPREDICTED_RETENTION_DAYS = int(os.getenv('UPLOAD_UNPREDICTED_RETENTION_DAYS', 30))  # images never predicted
+    UPLOAD_RETENTION_DAYS = int(os.getenv('UPLOAD_RETENTION_DAYS', 0))  # every image, with its predictions
+
+    # Thumbnail and web variants created in the background after upload
+    IMAGE_THUMBNAIL_SIZE = int(os.getenv('IMAGE_THUMBNAIL_SIZE', 150))  # pixels, longest side
+    IMAGE_WEB_SIZE = int(os.getenv('IMAGE_WEB_SIZE', 1024))
+    IMAGE_INGEST_WORKERS = int(os.getenv('IMAGE_INGEST_WORKERS', 2))
+    IMAGE_INGEST_EAGER = os.getenv('IMAGE_INGEST_EAGER') == 'True'  # create variants inline, e.g. for tests
+
+    # Prediction history pages (cursor pagination) and streamed exports
+    HISTORY_PAGE_SIZE = int(os.getenv('HISTORY_PAGE_SIZE', 50))
+    HISTORY_MAX_PAGE_SIZE = int(os.getenv('HISTORY_MAX_PAGE_SIZE', 500))
+    EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', 1000))  # rows fetched from the server-side cursor at a time
+
+    # Comma-separated emails of accounts that may read every user's data, e.g. the whole-tenant export
+    ADMIN_EMAILS = [email.strip().lower() for email in os.getenv('ADMIN_EMAILS', '').split(',') if email.strip()]
+
+    # Background prediction jobs (submit/poll)
+    PREDICTION_JOB_WORKERS = int(os.getenv('PREDICTION_JOB_WORKERS', 2))
+    PREDICTION_JOBS_EAGER = os.getenv('PREDICTION_JOBS_EAGER') == 'True'  # run jobs inline, e.g. for tests
+    PREDICTION_JOBS_RECOVER = os.getenv('PREDICTION_JOBS_RECOVER') == 'True'  # resume left-over jobs at start-up; set for the web process
+    PREDICTION_JOB_STALE_AFTER = int(os.getenv('PREDICTION_JOB_STALE_AFTER', 600))  # seconds before a running job counts as lost
+
 class TestingConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'
     MAIL_SUPPRESS_SEND = True
     JWT_SECRET_KEY = 'testing_jwt_secret_key'
-    SECRET_KEY = 'testing_secret_key'
\ No newline at end of file
+    SECRET_KEY = 'testing_secret_key'
+    IMAGE_INGEST_EAGER = True
\ No newline at end of file
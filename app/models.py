@@ -1,5 +1,8 @@
 from app import db
+from sqlalchemy import event
 import datetime
+import math
+import uuid
 
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -14,18 +17,233 @@ class Image(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     image_path = db.Column(db.String(255))
+    content_hash = db.Column(db.String(64), db.ForeignKey('blob.content_hash'), index=True)  # empty for legacy flat uploads
+    # Derivatives written by the ingest thread pool; empty until they are ready
+    thumbnail_path = db.Column(db.String(255))
+    web_path = db.Column(db.String(255))
     upload_date = db.Column(db.DateTime, default=datetime.datetime.utcnow)
     user = db.relationship('User', backref=db.backref('images', lazy=True))
+    # A user's uploads, newest first
+    __table_args__ = (db.Index('ix_image_user_id_upload_date', 'user_id', 'upload_date'),)
+
+class Blob(db.Model):
+    # One stored file per distinct upload content, shared by every Image with that content
+    content_hash = db.Column(db.String(64), primary_key=True)  # SHA-256 of the file
+    storage_key = db.Column(db.String(255), nullable=False)  # path under UPLOAD_FOLDER, e.g. ab/cd/abcd...jpg
+    size = db.Column(db.BigInteger)
+    ref_count = db.Column(db.Integer, nullable=False, default=0)
+    create_date = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    # When ref_count last reached zero, or an upload claimed the blob while it was there; None while referenced.
+    # The garbage collector only deletes blobs unreferenced for longer than UPLOAD_GC_GRACE_PERIOD.
+    unreferenced_since = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+
+def _update_blob_refs(connection, content_hash, delta):
+    blob = Blob.__table__
+    ref_count = blob.c.ref_count + delta
+    connection.execute(
+        blob.update().where(blob.c.content_hash == content_hash).values(
+            ref_count=ref_count,
+            unreferenced_since=db.case((ref_count <= 0, datetime.datetime.utcnow()), else_=None)
+        )
+    )
+
+@event.listens_for(Image, 'after_insert')
+def _reference_blob(mapper, connection, image):
+    if image.content_hash:
+        _update_blob_refs(connection, image.content_hash, 1)
+
+@event.listens_for(Image, 'after_update')
+def _move_blob_reference(mapper, connection, image):
+    history = db.inspect(image).attrs.content_hash.history
+    for content_hash in history.deleted or ():
+        if content_hash:
+            _update_blob_refs(connection, content_hash, -1)
+    for content_hash in history.added or ():
+        if content_hash:
+            _update_blob_refs(connection, content_hash, 1)
+
+@event.listens_for(Image, 'after_delete')
+def _release_blob(mapper, connection, image):
+    if image.content_hash:
+        _update_blob_refs(connection, image.content_hash, -1)
 
 class Prediction(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
-    image_id = db.Column(db.Integer, db.ForeignKey('image.id'))
-    predicted_class = db.Column(db.String(100))
-    confidence_percentage = db.Column(db.Float)
-    prediction_date = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    # active_history: the counters need the old user, class, confidence and date when any of them changes
+    user_id = db.column_property(db.Column(db.Integer, db.ForeignKey('user.id')), active_history=True)
+    image_id = db.Column(db.Integer, db.ForeignKey('image.id'), index=True)
+    predicted_class = db.column_property(db.Column(db.String(100)), active_history=True)
+    confidence_percentage = db.column_property(db.Column(db.Float), active_history=True)
+    probabilities = db.Column(db.LargeBinary)  # Full class probability vector, packed float16
+    prediction_date = db.column_property(db.Column(db.DateTime, default=datetime.datetime.utcnow), active_history=True)
     user = db.relationship('User', backref=db.backref('predictions', lazy=True))
     image = db.relationship('Image', backref=db.backref('prediction', uselist=False))
+    # Every per-user read starts from user_id: history and recent activity by date, stats and dashboard counts by class.
+    __table_args__ = (
+        db.Index('ix_prediction_user_id_prediction_date', 'user_id', 'prediction_date'),
+        db.Index('ix_prediction_user_id_predicted_class', 'user_id', 'predicted_class'),
+    )
+
+HEALTHY = 'healthy'
+DISEASED = 'diseased'
+UNKNOWN = 'unknown'
+
+def health_status_for(predicted_class):
+    # Class names look like Corn___healthy or Unknown___Unexpected_input
+    if predicted_class is None:
+        return None
+    name = predicted_class.lower()
+    if 'healthy' in name:
+        return HEALTHY
+    if 'unknown' in name:
+        return UNKNOWN
+    return DISEASED
+
+def plant_name_for(predicted_class):
+    # The part before ___, e.g. Corn for Corn___Common_rust
+    if predicted_class is None or '___' not in predicted_class:
+        return None
+    return predicted_class.split('___', 1)[0]
+
+class PredictionCount(db.Model):
+    # Predictions per user and class, so dashboards read O(classes) rows rather than every prediction.
+    # Kept in the same transaction as the predictions by the mapper events below; bulk deletes
+    # go through stat_utils.uncount_predictions, and `flask stats reconcile` repairs any drift.
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    plant_name = db.Column(db.String(50))
+    predicted_class = db.Column(db.String(100), nullable=False)
+    health_status = db.Column(db.String(20))
+    count = db.Column(db.Integer, nullable=False, default=0)
+    __table_args__ = (db.UniqueConstraint('user_id', 'predicted_class'),)
+
+def increment_counter(connection, table, keys, delta, **values):
+    """Add ``delta`` to ``table.count`` of the row with the ``keys`` column values,
+    creating it with ``values`` first if needed, in one atomic statement where
+    the database has an upsert. ``keys`` must be a unique constraint."""
+    match = db.and_(*(table.c[column] == value for column, value in keys.items()))
+    if delta < 0:
+        # A missing row has nothing to take away from
+        connection.execute(table.update().where(match).values(count=table.c.count + delta))
+        return
+    dialect = connection.dialect.name
+    if dialect in ('sqlite', 'postgresql', 'mysql'):
+        if dialect == 'mysql':
+            from sqlalchemy.dialects.mysql import insert
+        elif dialect == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert
+        else:
+            from sqlalchemy.dialects.sqlite import insert
+        statement = insert(table).values(**keys, **values, count=delta)
+        if dialect == 'mysql':
+            statement = statement.on_duplicate_key_update(count=table.c.count + delta)
+        else:
+            statement = statement.on_conflict_do_update(index_elements=list(keys), set_={'count': table.c.count + delta})
+        connection.execute(statement)
+        return
+    if not connection.execute(table.update().where(match).values(count=table.c.count + delta)).rowcount:
+        connection.execute(table.insert().values(**keys, **values, count=delta))
+
+class DailyPredictionCount(db.Model):
+    # Predictions per user and UTC day, for the charts over time; kept like PredictionCount
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    day = db.Column(db.Date, nullable=False)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    __table_args__ = (db.UniqueConstraint('user_id', 'day'),)
+
+class ConfidenceCount(db.Model):
+    # Predictions per user, class and whole confidence percent (0-99, 100 counted as 99), for the
+    # confidence histogram at any bin width; kept like PredictionCount
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    predicted_class = db.Column(db.String(100), nullable=False)
+    percent = db.Column(db.Integer, nullable=False)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    __table_args__ = (db.UniqueConstraint('user_id', 'predicted_class', 'percent'),)
+
+def confidence_percent(confidence_percentage):
+    if confidence_percentage is None:
+        return None
+    return min(max(int(math.floor(confidence_percentage)), 0), 99)
+
+def count_prediction(connection, user_id, predicted_class, delta):
+    if user_id is None or predicted_class is None:
+        # The API always records both; anything else is left out of the counters
+        return
+    increment_counter(
+        connection, PredictionCount.__table__, {'user_id': user_id, 'predicted_class': predicted_class}, delta,
+        plant_name=plant_name_for(predicted_class), health_status=health_status_for(predicted_class)
+    )
+
+def count_prediction_day(connection, user_id, day, delta):
+    if user_id is None or day is None:
+        return
+    increment_counter(connection, DailyPredictionCount.__table__, {'user_id': user_id, 'day': day}, delta)
+
+def count_prediction_confidence(connection, user_id, predicted_class, confidence_percentage, delta):
+    percent = confidence_percent(confidence_percentage)
+    if user_id is None or predicted_class is None or percent is None:
+        return
+    increment_counter(
+        connection, ConfidenceCount.__table__, {'user_id': user_id, 'predicted_class': predicted_class, 'percent': percent}, delta
+    )
+
+def _day(prediction_date):
+    return prediction_date.date() if prediction_date is not None else None
+
+@event.listens_for(Prediction, 'after_insert')
+def _count_new_prediction(mapper, connection, prediction):
+    count_prediction(connection, prediction.user_id, prediction.predicted_class, 1)
+    count_prediction_day(connection, prediction.user_id, _day(prediction.prediction_date), 1)
+    count_prediction_confidence(connection, prediction.user_id, prediction.predicted_class, prediction.confidence_percentage, 1)
+
+@event.listens_for(Prediction, 'after_update')
+def _recount_prediction(mapper, connection, prediction):
+    def old_value(attribute):
+        history = db.inspect(prediction).attrs[attribute].history
+        return history.deleted[0] if history.deleted else getattr(prediction, attribute), history.has_changes()
+
+    old_user, user_changed = old_value('user_id')
+    old_class, class_changed = old_value('predicted_class')
+    old_date, date_changed = old_value('prediction_date')
+    old_confidence, confidence_changed = old_value('confidence_percentage')
+    if user_changed or class_changed:
+        count_prediction(connection, old_user, old_class, -1)
+        count_prediction(connection, prediction.user_id, prediction.predicted_class, 1)
+    if user_changed or class_changed or (confidence_changed and confidence_percent(old_confidence) != confidence_percent(prediction.confidence_percentage)):
+        count_prediction_confidence(connection, old_user, old_class, old_confidence, -1)
+        count_prediction_confidence(connection, prediction.user_id, prediction.predicted_class, prediction.confidence_percentage, 1)
+    if user_changed or (date_changed and _day(old_date) != _day(prediction.prediction_date)):
+        count_prediction_day(connection, old_user, _day(old_date), -1)
+        count_prediction_day(connection, prediction.user_id, _day(prediction.prediction_date), 1)
+
+@event.listens_for(Prediction, 'after_delete')
+def _uncount_prediction(mapper, connection, prediction):
+    count_prediction(connection, prediction.user_id, prediction.predicted_class, -1)
+    count_prediction_day(connection, prediction.user_id, _day(prediction.prediction_date), -1)
+    count_prediction_confidence(connection, prediction.user_id, prediction.predicted_class, prediction.confidence_percentage, -1)
+
+class PredictionCacheEntry(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    content_hash = db.Column(db.String(64), nullable=False)  # SHA-256 of the image bytes
+    model_version = db.Column(db.String(100), nullable=False)
+    predicted_class = db.Column(db.String(100))
+    confidence_percentage = db.Column(db.Float)
+    probabilities = db.Column(db.LargeBinary)  # Packed float16, see model_utils.pack_probabilities
+    create_date = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    __table_args__ = (db.UniqueConstraint('content_hash', 'model_version'),)
+
+class PredictionJob(db.Model):
+    id = db.Column(db.String(32), primary_key=True, default=lambda: uuid.uuid4().hex)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    image_id = db.Column(db.Integer, db.ForeignKey('image.id'))
+    prediction_id = db.Column(db.Integer, db.ForeignKey('prediction.id'))
+    status = db.Column(db.String(20), default='queued', index=True)  # queued, running, succeeded or failed
+    error = db.Column(db.Text)
+    create_date = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    update_date = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    prediction = db.relationship('Prediction')
 
 class PlantDisease(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -39,21 +257,102 @@ class PlantDisease(db.Model):
 
 class CureSuggestion(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    disease_id = db.Column(db.Integer, db.ForeignKey('plant_disease.id'))
+    disease_id = db.Column(db.Integer, db.ForeignKey('plant_disease.id'), index=True)
     suggestion = db.Column(db.Text)
     create_date = db.Column(db.DateTime, default=datetime.datetime.utcnow)
     update_date = db.Column(db.DateTime, default=datetime.datetime.utcnow)
     plant_disease = db.relationship('PlantDisease', backref=db.backref('cure_suggestions', lazy=True))
 
+# Questions answered with one option, stored on the survey, and with several, stored as SurveyAnswer rows
+SINGLE_CHOICE_QUESTIONS = ('satisfaction', 'recommendation')
+MULTIPLE_CHOICE_QUESTIONS = ('usefulness', 'desired_features')
+
 class UserSatisfactionSurvey(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
-    satisfaction = db.Column(db.String(50))
-    usefulness = db.Column(db.Text)  # Store as a comma-separated string
-    desired_features = db.Column(db.Text)  # Store as a comma-separated string
-    recommendation = db.Column(db.String(50))
+    # active_history: the option counters need the old answer when it changes
+    satisfaction = db.column_property(db.Column(db.String(50)), active_history=True)
+    recommendation = db.column_property(db.Column(db.String(50)), active_history=True)
     survey_date = db.Column(db.DateTime, default=datetime.datetime.utcnow)
     user = db.relationship('User', backref=db.backref('surveys', lazy=True))
+    answers = db.relationship('SurveyAnswer', backref='survey', cascade='all, delete-orphan', order_by='SurveyAnswer.id')
+
+    def options(self, question):
+        return [answer.option for answer in self.answers if answer.question == question]
+
+    def set_options(self, question, options):
+        # Unchanged options keep their rows, so a resubmitted survey only moves the counters it changes
+        options = list(dict.fromkeys(option for option in options if option))
+        for answer in [answer for answer in self.answers if answer.question == question and answer.option not in options]:
+            self.answers.remove(answer)
+        kept = set(self.options(question))
+        self.answers.extend(SurveyAnswer(question=question, option=option) for option in options if option not in kept)
+
+    # The multiple-choice answers as the comma-separated strings the survey table used to hold
+    @property
+    def usefulness(self):
+        return ','.join(self.options('usefulness'))
+
+    @usefulness.setter
+    def usefulness(self, value):
+        self.set_options('usefulness', value.split(',') if value else [])
+
+    @property
+    def desired_features(self):
+        return ','.join(self.options('desired_features'))
+
+    @desired_features.setter
+    def desired_features(self, value):
+        self.set_options('desired_features', value.split(',') if value else [])
+
+class SurveyAnswer(db.Model):
+    # One option ticked in a multiple-choice survey question
+    id = db.Column(db.Integer, primary_key=True)
+    survey_id = db.Column(db.Integer, db.ForeignKey('user_satisfaction_survey.id'), nullable=False)
+    question = db.Column(db.String(50), nullable=False)
+    option = db.Column(db.String(255), nullable=False)
+    __table_args__ = (db.UniqueConstraint('survey_id', 'question', 'option'),)
+
+class SurveyOptionCount(db.Model):
+    # Surveys giving each answer to each question, for the survey statistics; kept by the mapper events
+    # below in the same transaction as the surveys, like PredictionCount
+    id = db.Column(db.Integer, primary_key=True)
+    question = db.Column(db.String(50), nullable=False)
+    option = db.Column(db.String(255), nullable=False)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    __table_args__ = (db.UniqueConstraint('question', 'option'),)
+
+def count_survey_option(connection, question, option, delta):
+    if option is None:
+        return
+    increment_counter(connection, SurveyOptionCount.__table__, {'question': question, 'option': option}, delta)
+
+@event.listens_for(UserSatisfactionSurvey, 'after_insert')
+def _count_new_survey(mapper, connection, survey):
+    for question in SINGLE_CHOICE_QUESTIONS:
+        count_survey_option(connection, question, getattr(survey, question), 1)
+
+@event.listens_for(UserSatisfactionSurvey, 'after_update')
+def _recount_survey(mapper, connection, survey):
+    for question in SINGLE_CHOICE_QUESTIONS:
+        history = db.inspect(survey).attrs[question].history
+        old_option = history.deleted[0] if history.deleted else None
+        if history.has_changes() and old_option != getattr(survey, question):
+            count_survey_option(connection, question, old_option, -1)
+            count_survey_option(connection, question, getattr(survey, question), 1)
+
+@event.listens_for(UserSatisfactionSurvey, 'after_delete')
+def _uncount_survey(mapper, connection, survey):
+    for question in SINGLE_CHOICE_QUESTIONS:
+        count_survey_option(connection, question, getattr(survey, question), -1)
+
+@event.listens_for(SurveyAnswer, 'after_insert')
+def _count_new_answer(mapper, connection, answer):
+    count_survey_option(connection, answer.question, answer.option, 1)
+
+@event.listens_for(SurveyAnswer, 'after_delete')
+def _uncount_answer(mapper, connection, answer):
+    count_survey_option(connection, answer.question, answer.option, -1)
 
 def insert_initial_data():
     if PlantDisease.query.first() is not None:
@@ -2,7 +2,8 @@ from flask import Blueprint, jsonify, url_for
 from flask_jwt_extended import jwt_required, get_jwt_identity
 from app import db
 from app.models import User, Prediction, Image
-import os
+from app.utils.stat_utils import health_counts, plant_counts
+from app.utils.storage_utils import upload_url_path
 from sqlalchemy import func, case
 
 bp = Blueprint('dashboard', __name__, url_prefix='/dashboard')
@@ -28,26 +29,7 @@ def get_profile():
 @jwt_required()
 def get_dashboard_overview():
     user_id = get_jwt_identity()['id']
-    
-    # Query for total number of predictions
-    total_predictions = db.session.query(Prediction).filter_by(user_id=user_id).count()
-    
-    # Query for total number of healthy predictions
-    healthy_predictions = db.session.query(Prediction).filter_by(user_id=user_id).filter(
-        Prediction.predicted_class.like('%healthy%')
-    ).count()
-    
-    # Query for total number of diseased plants (excluding healthy and unknown classes)
-    diseased_predictions = db.session.query(Prediction).filter_by(user_id=user_id).filter(
-        ~Prediction.predicted_class.like('%healthy%'),
-        ~Prediction.predicted_class.like('%Unknown%')
-    ).count()
-
-    return jsonify({
-        'predictions_made': total_predictions,
-        'healthy_plants': healthy_predictions,
-        'diseased_plants': diseased_predictions
-    }), 200
+    return jsonify(health_counts(user_id)), 200
 
 @bp.route('/recent_activity', methods=['GET'])
 @jwt_required()
@@ -74,7 +56,8 @@ def get_recent_activity():
             'predicted_class': prediction.predicted_class,
             'confidence_percentage': prediction.confidence_percentage,
             'prediction_date': prediction.prediction_date,
-            'image_url': url_for('uploaded_file', filename=os.path.basename(prediction.image_path), _external=True)
+            'image_url': url_for('uploaded_file', filename=upload_url_path(prediction.image_path), _external=True),
+            'thumbnail_url': url_for('uploaded_file', filename=upload_url_path(prediction.image_path), variant='thumbnail', _external=True)
         })
 
     return jsonify(recent_activities), 200
@@ -84,31 +67,9 @@ def get_recent_activity():
 def get_predictions_by_crop_type():
     user_id = get_jwt_identity()['id']
 
-    # Define crop categories
-    crop_types = {
-        'Corn': ['Corn___Common_rust', 'Corn___Gray_leaf_spot', 'Corn___Northern_Leaf_Blight', 'Corn___healthy'],
-        'Potato': ['Potato___Early_blight', 'Potato___Late_blight', 'Potato___healthy'],
-        'Strawberry': ['Strawberry___Leaf_scorch', 'Strawberry___healthy'],
-        'Unknown': ['Unknown___Unexpected_input']
-    }
-
-    # Initialize dictionary to count predictions per crop type
-    crop_type_counts = {
-        'Corn': 0,
-        'Potato': 0,
-        'Strawberry': 0,
-        'Unknown': 0
-    }
-
-    # Query predictions for the user
-    predictions = db.session.query(Prediction.predicted_class).filter_by(user_id=user_id).all()
-
-    # Count predictions per crop type
-    for prediction in predictions:
-        for crop, classes in crop_types.items():
-            if prediction.predicted_class in classes:
-                crop_type_counts[crop] += 1
-                break
+    # Crops the model knows; counts come from the per-class counters, one row per class
+    plant_totals = plant_counts(user_id)
+    crop_type_counts = {crop: plant_totals.get(crop, 0) for crop in ('Corn', 'Potato', 'Strawberry', 'Unknown')}
 
     # Calculate total predictions
     total_predictions = sum(crop_type_counts.values())
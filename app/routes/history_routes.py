@@ -1,16 +1,38 @@
-from flask import Blueprint, jsonify, request, url_for, send_file
+from flask import Blueprint, current_app, jsonify, request, stream_with_context, url_for, send_file
 from flask_jwt_extended import jwt_required, get_jwt_identity
+from sqlalchemy import select
 from app import db
 from app.models import Prediction, Image
+from app.utils.auth_utils import is_admin
+from app.utils.image_utils import image_file_for
+from app.utils.pagination_utils import keyset_page
+from app.utils.storage_utils import get_storage, upload_url_path
 from datetime import datetime
 from reportlab.lib.pagesizes import letter
 from reportlab.pdfgen import canvas
 from reportlab.lib.colors import HexColor
+from reportlab.lib.utils import ImageReader
+import csv
+import json
 import os
-from io import BytesIO
+from io import BytesIO, StringIO
 
 bp = Blueprint('history', __name__)
 
+EXPORT_COLUMNS = ('id', 'user_id', 'image_id', 'predicted_class', 'confidence_percentage', 'prediction_date', 'image_url')
+EXPORT_FORMATS = {
+    'ndjson': ('application/x-ndjson', 'prediction_history.ndjson'),
+    'csv': ('text/csv', 'prediction_history.csv')
+}
+
+def pdf_image(image_path):
+    # A file ReportLab can read directly, or the stored object loaded into memory
+    storage = get_storage()
+    key = storage.key_for(image_path)
+    if not storage.exists(key):
+        return None
+    return storage.local_path(key) or ImageReader(BytesIO(storage.read(key)))
+
 @bp.route('/view_prediction_history', methods=['GET'])
 @jwt_required()
 def view_prediction_history():
@@ -35,7 +57,15 @@ def view_prediction_history():
     if end_date:
         query = query.filter(Prediction.prediction_date <= end_date)
 
-    predictions = query.order_by(Prediction.prediction_date.desc()).all()
+    # Newest first, a page at a time; the client passes next_cursor back to get the following page
+    limit = min(request.args.get('limit', current_app.config['HISTORY_PAGE_SIZE'], type=int), current_app.config['HISTORY_MAX_PAGE_SIZE'])
+    if limit < 1:
+        return jsonify({'message': 'limit must be a positive integer'}), 400
+    try:
+        predictions, next_cursor = keyset_page(query, Prediction.prediction_date, Prediction.id, request.args.get('cursor'), limit,
+                                               undated=not (start_date or end_date))
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
 
     predictions_list = [{
         'id': p.id,
@@ -43,11 +73,98 @@ def view_prediction_history():
         'predicted_class': p.predicted_class,
         'confidence_percentage': p.confidence_percentage,
         'prediction_date': p.prediction_date,
-        'image_url': url_for('uploaded_file', filename=os.path.basename(p.image_path), _external=True),
+        'image_url': url_for('uploaded_file', filename=upload_url_path(p.image_path), _external=True),
+        'thumbnail_url': url_for('uploaded_file', filename=upload_url_path(p.image_path), variant='thumbnail', _external=True),
         'image_path': p.image_path
     } for p in predictions]
 
-    return jsonify(predictions_list), 200
+    return jsonify({'predictions': predictions_list, 'next_cursor': next_cursor}), 200
+
+def export_batches(statement, batch_size):
+    # Rows from a server-side cursor, batch_size at a time, so the result is never all in memory
+    result = db.session.execute(statement.execution_options(yield_per=batch_size))
+    try:
+        for rows in result.partitions():
+            yield [{
+                'id': row.id,
+                'user_id': row.user_id,
+                'image_id': row.image_id,
+                'predicted_class': row.predicted_class,
+                'confidence_percentage': row.confidence_percentage,
+                'prediction_date': row.prediction_date.isoformat() if row.prediction_date else None,
+                'image_url': url_for('uploaded_file', filename=upload_url_path(row.image_path), _external=True) if row.image_path else None
+            } for row in rows]
+    finally:
+        result.close()
+
+def ndjson_chunks(batches):
+    for batch in batches:
+        yield ''.join(json.dumps(row) + '\n' for row in batch)
+
+def csv_chunks(batches):
+    buffer = StringIO()
+    writer = csv.DictWriter(buffer, EXPORT_COLUMNS)
+    writer.writeheader()
+    # The header goes out before the first rows are fetched
+    yield buffer.getvalue()
+    for batch in batches:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(batch)
+        yield buffer.getvalue()
+
+@bp.route('/export', methods=['GET'])
+@jwt_required()
+def export_prediction_history():
+    """Stream predictions as NDJSON (default) or CSV: ?format=ndjson|csv.
+
+    ?scope=all exports every user's predictions and is limited to ADMIN_EMAILS.
+    Rows are read from a server-side cursor and written out a batch at a time
+    as they arrive, so memory use does not grow with the history and the
+    download starts at once.
+    """
+    user_id = get_jwt_identity()['id']
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({'message': f"format must be one of {', '.join(EXPORT_FORMATS)}"}), 400
+    scope = request.args.get('scope', 'mine')
+    if scope not in ('mine', 'all'):
+        return jsonify({'message': 'scope must be mine or all'}), 400
+    if scope == 'all' and not is_admin(user_id):
+        return jsonify({'message': 'Only administrators can export all predictions'}), 403
+    try:
+        start_date = datetime.strptime(request.args['start_date'], '%Y-%m-%d') if request.args.get('start_date') else None
+        end_date = datetime.strptime(request.args['end_date'], '%Y-%m-%d') if request.args.get('end_date') else None
+    except ValueError:
+        return jsonify({'message': 'Dates must be given as YYYY-MM-DD'}), 400
+
+    statement = select(
+        Prediction.id,
+        Prediction.user_id,
+        Prediction.image_id,
+        Prediction.predicted_class,
+        Prediction.confidence_percentage,
+        Prediction.prediction_date,
+        Image.image_path
+    ).outerjoin(Image, Prediction.image_id == Image.id)
+    if scope == 'mine':
+        # Same order as the history view, read straight off the (user_id, prediction_date) index
+        statement = statement.where(Prediction.user_id == user_id).order_by(Prediction.prediction_date.desc(), Prediction.id.desc())
+    else:
+        statement = statement.order_by(Prediction.id)
+    if start_date:
+        statement = statement.where(Prediction.prediction_date >= start_date)
+    if end_date:
+        statement = statement.where(Prediction.prediction_date <= end_date)
+
+    batches = export_batches(statement, current_app.config.get('EXPORT_BATCH_SIZE', 1000))
+    chunks = ndjson_chunks(batches) if export_format == 'ndjson' else csv_chunks(batches)
+    mimetype, filename = EXPORT_FORMATS[export_format]
+    response = current_app.response_class(stream_with_context(chunks), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename={filename}'
+    # Let nginx pass each chunk on rather than buffering the whole export
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
 @bp.route('/download_prediction_history_pdf', methods=['GET'])
 @jwt_required()
@@ -65,7 +182,8 @@ def download_prediction_history_pdf():
         Prediction.predicted_class,
         Prediction.confidence_percentage,
         Prediction.prediction_date,
-        Image.image_path
+        Image.image_path,
+        Image.thumbnail_path
     ).join(Image, Prediction.image_id == Image.id).filter(Prediction.user_id == user_id)
 
     if start_date:
@@ -89,9 +207,10 @@ def download_prediction_history_pdf():
     p.setFont("Helvetica", 12)
     y_position = height - 130
     for prediction in predictions:
-        image_path = prediction.image_path
-        if os.path.exists(image_path):
-            p.drawImage(image_path, 50, y_position - 50, width=75, height=75)
+        # The thumbnail is drawn at 75px anyway and keeps the PDF small and fast to build
+        image = pdf_image(image_file_for(prediction.image_path, prediction.thumbnail_path))
+        if image is not None:
+            p.drawImage(image, 50, y_position - 50, width=75, height=75)
         else:
             p.drawString(50, y_position, "Image not available")
 
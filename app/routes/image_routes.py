@@ -1,45 +1,149 @@
-from flask import Blueprint, request, jsonify, current_app
+from flask import Blueprint, current_app, request, jsonify
 from flask_jwt_extended import jwt_required, get_jwt_identity
 from app import db
 from app.models import Image
-import os
-from werkzeug.utils import secure_filename
-import uuid
+from app.utils.image_utils import schedule_derivatives
+from app.utils.storage_utils import discard_upload, store_stream
+from app.utils.upload_utils import ChunkedUpload, IncomingUpload, UploadRejected, receive_uploads, sweep_chunked_uploads
 import logging
 
 bp = Blueprint('image', __name__)
 
 def save_image(file):
-    filename = secure_filename(file.filename)
-    unique_filename = f"{uuid.uuid4().hex}_{filename}"
-    upload_folder = current_app.config['UPLOAD_FOLDER']
-    os.makedirs(upload_folder, exist_ok=True)
-    filepath = os.path.join(upload_folder, unique_filename)
-    file.save(filepath)
+    # Stored under its content hash; returns (filepath, content_hash).
+    # Streamed uploads were already checked and hashed while they arrived.
+    if isinstance(file.stream, IncomingUpload):
+        return file.stream.store(file.filename)
+    return store_stream(file.stream, file.filename)
 
-    if os.path.exists(filepath):
-        logging.info(f"File saved successfully: {filepath}")
-    else:
-        logging.error(f"File not found after saving: {filepath}")
-
-    return filepath
+def rejected_response(error):
+    logging.warning(f"Upload rejected: {error}")
+    return jsonify({'message': str(error)}), error.status_code
 
 @bp.route('/upload_image', methods=['POST'])
 @jwt_required()
 def upload_image():
+    try:
+        receive_uploads('image')
+    except UploadRejected as e:
+        return rejected_response(e)
     if 'image' not in request.files:
         return jsonify({'message': 'No image file provided'}), 400
     file = request.files['image']
     if file.filename == '':
         return jsonify({'message': 'No selected file'}), 400
     user_id = get_jwt_identity()['id']
+    filepath = content_hash = None
     try:
-        filepath = save_image(file)
-        image_record = Image(user_id=user_id, image_path=filepath)
+        filepath, content_hash = save_image(file)
+        image_record = Image(user_id=user_id, image_path=filepath, content_hash=content_hash)
         db.session.add(image_record)
         db.session.commit()
+        schedule_derivatives([image_record])
         logging.info(f"Image saved at: {filepath}")
         return jsonify({'message': 'Image uploaded successfully', 'image_id': image_record.id, 'file_path': filepath}), 201
+    except UploadRejected as e:
+        return rejected_response(e)
     except Exception as e:
+        db.session.rollback()
+        discard_upload(filepath, content_hash)
         logging.error(f"Error saving image: {e}")
         return jsonify({'message': 'Image upload failed', 'error': str(e)}), 500
+
+
+# Resumable uploads: POST /uploads announces the file, PATCH /uploads/<id> sends
+# chunks with an Upload-Offset header, GET/HEAD /uploads/<id> tells a client
+# where to resume after a dropped connection, and POST /uploads/<id>/finalize
+# stores the image like /upload_image.
+
+def upload_status(upload, offset=None):
+    offset = upload.offset if offset is None else offset
+    response = jsonify({'upload_id': upload.id, 'offset': offset, 'length': upload.length})
+    response.headers['Upload-Offset'] = str(offset)
+    response.headers['Upload-Length'] = str(upload.length)
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+def load_chunked_upload(upload_id):
+    # Uploads are private to the user who started them
+    upload = ChunkedUpload.load(upload_id)
+    return upload if upload and upload.user_id == get_jwt_identity()['id'] else None
+
+@bp.route('/uploads', methods=['POST'])
+@jwt_required()
+def start_chunked_upload():
+    data = request.get_json(silent=True) or {}
+    filename = data.get('filename')
+    length = data.get('length')
+    if not filename:
+        return jsonify({'message': 'filename is required'}), 400
+    if not isinstance(length, int) or isinstance(length, bool) or length <= 0:
+        return jsonify({'message': 'length must be a positive integer'}), 400
+    max_bytes = current_app.config.get('UPLOAD_MAX_BYTES')
+    if max_bytes and length > max_bytes:
+        return jsonify({'message': f"Image is larger than the {max_bytes} byte limit"}), 413
+
+    sweep_chunked_uploads()
+    upload = ChunkedUpload.create(get_jwt_identity()['id'], filename, length)
+    logging.info(f"Resumable upload {upload.id} started for {length} bytes")
+    response = upload_status(upload, 0)
+    response.headers['Location'] = f'/image/uploads/{upload.id}'
+    return response, 201
+
+@bp.route('/uploads/<upload_id>', methods=['GET'])
+@jwt_required()
+def chunked_upload_status(upload_id):
+    upload = load_chunked_upload(upload_id)
+    if not upload:
+        return jsonify({'message': 'Upload not found'}), 404
+    return upload_status(upload), 200
+
+@bp.route('/uploads/<upload_id>', methods=['PATCH'])
+@jwt_required()
+def upload_chunk(upload_id):
+    upload = load_chunked_upload(upload_id)
+    if not upload:
+        return jsonify({'message': 'Upload not found'}), 404
+    offset = request.headers.get('Upload-Offset', type=int)
+    if offset is None or offset < 0:
+        return jsonify({'message': 'Upload-Offset header is required'}), 400
+    try:
+        return upload_status(upload, upload.write_chunk(offset, request.stream)), 200
+    except UploadRejected as e:
+        response, status = rejected_response(e)
+        # Taken from the rejection: the .part may be gone by now if another request finalized the upload
+        if e.offset is not None:
+            response.headers['Upload-Offset'] = str(e.offset)
+        return response, status
+
+@bp.route('/uploads/<upload_id>/finalize', methods=['POST'])
+@jwt_required()
+def finalize_chunked_upload(upload_id):
+    upload = load_chunked_upload(upload_id)
+    if not upload:
+        return jsonify({'message': 'Upload not found'}), 404
+    filepath = content_hash = None
+    try:
+        filepath, content_hash = upload.store(current_app.config.get('UPLOAD_MAX_PIXELS'))
+        image_record = Image(user_id=upload.user_id, image_path=filepath, content_hash=content_hash)
+        db.session.add(image_record)
+        db.session.commit()
+        schedule_derivatives([image_record])
+        logging.info(f"Resumable upload {upload_id} saved at: {filepath}")
+        return jsonify({'message': 'Image uploaded successfully', 'image_id': image_record.id, 'file_path': filepath}), 201
+    except UploadRejected as e:
+        return rejected_response(e)
+    except Exception as e:
+        db.session.rollback()
+        discard_upload(filepath, content_hash)
+        logging.error(f"Error saving resumable upload {upload_id}: {e}")
+        return jsonify({'message': 'Image upload failed', 'error': str(e)}), 500
+
+@bp.route('/uploads/<upload_id>', methods=['DELETE'])
+@jwt_required()
+def cancel_chunked_upload(upload_id):
+    upload = load_chunked_upload(upload_id)
+    if not upload:
+        return jsonify({'message': 'Upload not found'}), 404
+    upload.discard()
+    return jsonify({'message': 'Upload cancelled'}), 200
@@ -1,13 +1,128 @@
-from flask import Blueprint, jsonify, current_app
-from flask_jwt_extended import jwt_required
+from flask import Blueprint, request, jsonify, current_app
+from flask_jwt_extended import jwt_required, get_jwt_identity
 from app import db
-from app.models import Image, Prediction
-from app.utils.model_utils import predict_disease
-import os
+from app.models import Image, Prediction, PredictionJob
+from app.utils.model_utils import (
+    predict_disease, predict_images, get_model_version, top_k_predictions,
+    pack_probabilities, unpack_probabilities, FALLBACK_PREDICTION
+)
+from app.utils.inference_pool import InferencePoolBusy
+from app.utils.cache_utils import get_prediction_cache, hash_image_file
+from app.utils.job_utils import get_job_queue
+from app.utils.image_utils import schedule_derivatives
+from app.utils.storage_utils import discard_upload, upload_url_path
+from app.utils.upload_utils import UploadRejected, receive_uploads
+from app.routes.image_routes import rejected_response, save_image
+from concurrent.futures import ThreadPoolExecutor
 import logging
 
 bp = Blueprint('prediction', __name__)
 
+def lookup_cached_prediction(image_path, content_hash=None):
+    # Returns (content_hash, cached_result); both are None when caching is off or the file is unreadable.
+    # Content-addressed uploads already know their hash, legacy ones are hashed here.
+    if not current_app.config.get('PREDICTION_CACHE_ENABLED', True):
+        return None, None
+    try:
+        content_hash = content_hash or hash_image_file(image_path)
+    except OSError as e:
+        logging.warning(f"Could not hash image {image_path}: {e}")
+        return None, None
+    return content_hash, get_prediction_cache().get(content_hash, get_model_version())
+
+def store_cached_predictions(results):
+    # (content_hash, result) pairs. Failed predictions are not cached so a transient error is retried next time.
+    model_version = get_model_version()
+    get_prediction_cache().put_many([
+        (content_hash, model_version, result)
+        for content_hash, result in results if content_hash and tuple(result) != FALLBACK_PREDICTION
+    ])
+
+def new_prediction(image_record, result):
+    predicted_class, confidence_percentage = result
+    return Prediction(
+        user_id=image_record.user_id,
+        image_id=image_record.id,
+        predicted_class=predicted_class,
+        confidence_percentage=confidence_percentage,
+        probabilities=pack_probabilities(getattr(result, 'probabilities', None))
+    )
+
+def run_prediction(image_record, commit=True):
+    # With commit=False the new Prediction is only flushed, for the caller to commit with its own changes
+    image_path = image_record.image_path
+    logging.info(f"Predicting disease for image path: {image_path}")
+
+    # Re-uploaded photos are answered from the cache without running the model
+    content_hash, cached_result = lookup_cached_prediction(image_path, image_record.content_hash)
+    if cached_result:
+        result = cached_result
+        logging.info(f"Prediction cache hit for image: {image_path}")
+    else:
+        result = predict_disease(image_path)
+        # Before the session writes anything, as the cache has a connection of its own
+        store_cached_predictions([(content_hash, result)])
+
+    prediction = new_prediction(image_record, result)
+    db.session.add(prediction)
+    if commit:
+        db.session.commit()
+    else:
+        db.session.flush()
+    return prediction, bool(cached_result)
+
+def run_bulk_prediction(image_records):
+    image_paths = [image_record.image_path for image_record in image_records]
+    with ThreadPoolExecutor(max_workers=current_app.config.get('INFERENCE_DECODE_WORKERS', 4)) as executor:
+        app = current_app._get_current_object()
+
+        def lookup(image_record):
+            with app.app_context():
+                return lookup_cached_prediction(image_record.image_path, image_record.content_hash)
+
+        lookups = list(executor.map(lookup, image_records))
+
+    # Only cache misses go through the model, in real batches
+    misses = [i for i, (_, cached_result) in enumerate(lookups) if not cached_result]
+    predicted = dict(zip(misses, predict_images([image_paths[i] for i in misses])))
+
+    predictions = [new_prediction(image_record, lookups[i][1] or predicted[i]) for i, image_record in enumerate(image_records)]
+    db.session.add_all(predictions)
+    db.session.commit()
+
+    store_cached_predictions([(lookups[i][0], predicted[i]) for i in misses])
+
+    return [(prediction, bool(lookups[i][1])) for i, prediction in enumerate(predictions)]
+
+def run_prediction_job(job):
+    # The job queue commits the prediction together with the job's result
+    image_record = db.session.get(Image, job.image_id)
+    if not image_record:
+        raise ValueError(f"Image with ID {job.image_id} not found")
+    prediction, _ = run_prediction(image_record, commit=False)
+    return prediction
+
+def busy_response():
+    logging.warning("Inference queue is full, rejecting prediction request")
+    response = jsonify({'message': 'Prediction service is busy, please retry shortly'})
+    response.headers['Retry-After'] = '1'
+    return response, 503
+
+def image_url_for(image_path):
+    return f'/static/uploads/{upload_url_path(image_path)}'
+
+def serialize_prediction(prediction, image_path, top_k=None):
+    data = {
+        'prediction_id': prediction.id,
+        'predicted_class': prediction.predicted_class,
+        'confidence_percentage': prediction.confidence_percentage,
+        'image_url': image_url_for(image_path)
+    }
+    # Alternatives come from the stored vector, so no extra inference is needed
+    if top_k and prediction.probabilities is not None:
+        data['top_k'] = top_k_predictions(unpack_probabilities(prediction.probabilities), top_k)
+    return data
+
 @bp.route('/predict_disease/<int:image_id>', methods=['GET'])
 @jwt_required()
 def predict_disease_route(image_id):
@@ -16,34 +131,195 @@ def predict_disease_route(image_id):
         logging.warning(f"Image with ID {image_id} not found.")
         return jsonify({'message': 'Image not found'}), 404
     
-    image_path = image_record.image_path
-    logging.info(f"Predicting disease for image path: {image_path}")
-    
     try:
-        predicted_class, confidence_percentage = predict_disease(image_path)
+        prediction, cached = run_prediction(image_record)
         
-        prediction = Prediction(
-            user_id=image_record.user_id, 
-            image_id=image_id, 
-            predicted_class=predicted_class, 
-            confidence_percentage=confidence_percentage
-        )
-        db.session.add(prediction)
-        db.session.commit()
-        
-        # Generate the image URL
-        filename = os.path.basename(image_path)
-        image_url = f'/static/uploads/{filename}'
-        logging.info(f"Generated image URL: {image_url}")
-        
-        response = {
-            'prediction_id': prediction.id,
-            'predicted_class': predicted_class,
-            'confidence_percentage': confidence_percentage,
-            'image_url': image_url
-        }
+        # Optional top-k alternatives, e.g. ?top_k=3
+        response = serialize_prediction(prediction, image_record.image_path, top_k=request.args.get('top_k', type=int))
+        response['cached'] = cached
+        logging.info(f"Generated image URL: {response['image_url']}")
         
         return jsonify(response), 200
+    except InferencePoolBusy:
+        db.session.rollback()
+        return busy_response()
     except Exception as e:
         logging.error(f"Error during prediction: {e}")
         return jsonify({'message': 'Prediction failed', 'error': str(e)}), 500
+
+@bp.route('/upload_and_predict', methods=['POST'])
+@jwt_required()
+def upload_and_predict():
+    try:
+        # Kept in memory as well as spooled, so inference needs no read back from disk
+        receive_uploads('image', keep_bytes=True)
+    except UploadRejected as e:
+        return rejected_response(e)
+    if 'image' not in request.files:
+        return jsonify({'message': 'No image file provided'}), 400
+    file = request.files['image']
+    if file.filename == '':
+        return jsonify({'message': 'No selected file'}), 400
+    user_id = get_jwt_identity()['id']
+
+    filepath = content_hash = None
+    try:
+        # The upload was checked and hashed as it arrived; inference decodes it from memory
+        upload = file.stream
+        data = upload.getvalue()
+
+        cached_result = None
+        if current_app.config.get('PREDICTION_CACHE_ENABLED', True):
+            cached_result = get_prediction_cache().get(upload.content_hash, get_model_version())
+
+        # The spool file is filed under its content hash, next to any identical earlier upload,
+        # while the model runs. A failed prediction removes it again below.
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix='upload-store') as executor:
+            finish_store = upload.store_async(file.filename, executor)
+            try:
+                result = cached_result or predict_disease(data)
+            finally:
+                filepath, content_hash = finish_store()
+
+        # Image and Prediction are committed together
+        image_record = Image(user_id=user_id, image_path=filepath, content_hash=content_hash)
+        db.session.add(image_record)
+        db.session.flush()
+        prediction = new_prediction(image_record, result)
+        db.session.add(prediction)
+        db.session.commit()
+
+        schedule_derivatives([image_record])
+        if not cached_result:
+            store_cached_predictions([(content_hash, result)])
+
+        response = serialize_prediction(prediction, filepath, top_k=request.args.get('top_k', type=int))
+        response.update({'image_id': image_record.id, 'cached': bool(cached_result)})
+        return jsonify(response), 201
+    except UploadRejected as e:
+        return rejected_response(e)
+    except InferencePoolBusy:
+        db.session.rollback()
+        discard_upload(filepath, content_hash)
+        return busy_response()
+    except Exception as e:
+        db.session.rollback()
+        discard_upload(filepath, content_hash)
+        logging.error(f"Error during upload and prediction: {e}")
+        return jsonify({'message': 'Upload and prediction failed', 'error': str(e)}), 500
+
+def discard_bulk_uploads(stored):
+    # Files stored before a later upload or the prediction failed; shared ones are kept
+    db.session.rollback()
+    for filepath, content_hash in stored:
+        discard_upload(filepath, content_hash)
+
+@bp.route('/predict_disease_bulk', methods=['POST'])
+@jwt_required()
+def predict_disease_bulk():
+    max_images = current_app.config.get('PREDICTION_BULK_MAX_IMAGES', 200)
+    try:
+        # Counted as the files arrive, so an oversized batch is not spooled to disk first
+        files = receive_uploads('images', max_files=max_images)
+    except UploadRejected as e:
+        return rejected_response(e)
+    data = request.get_json(silent=True) or {}
+    image_ids = data.get('image_ids')
+    top_k = data.get('top_k', request.form.get('top_k', type=int))
+
+    if not files and not image_ids:
+        return jsonify({'message': 'No image ids or image files provided'}), 400
+    if not files and (not isinstance(image_ids, list) or not all(isinstance(image_id, int) for image_id in image_ids)):
+        return jsonify({'message': 'image_ids must be a list of integers'}), 400
+    # bool is an int subclass, but true is not a count
+    if top_k is not None and (isinstance(top_k, bool) or not isinstance(top_k, int)):
+        return jsonify({'message': 'top_k must be an integer'}), 400
+    if len(files or image_ids) > max_images:
+        return jsonify({'message': f'At most {max_images} images can be predicted per request'}), 400
+
+    stored = []
+    try:
+        if files:
+            # Multipart batch: store the uploads, then predict them like any other images
+            user_id = get_jwt_identity()['id']
+            for file in files:
+                if file.filename:
+                    stored.append(save_image(file))
+            image_records = [
+                Image(user_id=user_id, image_path=filepath, content_hash=content_hash)
+                for filepath, content_hash in stored
+            ]
+            db.session.add_all(image_records)
+            db.session.flush()
+            missing_ids = []
+        else:
+            found = {image.id: image for image in Image.query.filter(Image.id.in_(image_ids)).all()}
+            image_records = [found[image_id] for image_id in dict.fromkeys(image_ids) if image_id in found]
+            missing_ids = [image_id for image_id in dict.fromkeys(image_ids) if image_id not in found]
+
+        results = [
+            dict(serialize_prediction(prediction, image_record.image_path, top_k=top_k), image_id=prediction.image_id, cached=cached)
+            for image_record, (prediction, cached) in zip(image_records, run_bulk_prediction(image_records))
+        ]
+        results.extend({'image_id': image_id, 'message': 'Image not found'} for image_id in missing_ids)
+        if files:
+            schedule_derivatives(image_records)
+
+        return jsonify({'results': results}), 200
+    except UploadRejected as e:
+        discard_bulk_uploads(stored)
+        return rejected_response(e)
+    except InferencePoolBusy:
+        discard_bulk_uploads(stored)
+        return busy_response()
+    except Exception as e:
+        discard_bulk_uploads(stored)
+        logging.error(f"Error during bulk prediction: {e}")
+        return jsonify({'message': 'Bulk prediction failed', 'error': str(e)}), 500
+
+@bp.route('/predict_disease_async/<int:image_id>', methods=['POST'])
+@jwt_required()
+def submit_prediction_job(image_id):
+    image_record = db.session.get(Image, image_id)
+    if not image_record:
+        logging.warning(f"Image with ID {image_id} not found.")
+        return jsonify({'message': 'Image not found'}), 404
+
+    try:
+        job = get_job_queue(run_prediction_job).submit(image_record)
+        return jsonify({
+            'job_id': job.id,
+            'status': job.status,
+            'status_url': f'/prediction/jobs/{job.id}'
+        }), 202
+    except Exception as e:
+        db.session.rollback()
+        logging.error(f"Error submitting prediction job: {e}")
+        return jsonify({'message': 'Prediction job submission failed', 'error': str(e)}), 500
+
+@bp.route('/jobs/<job_id>', methods=['GET'])
+@jwt_required()
+def get_prediction_job(job_id):
+    user_id = get_jwt_identity()['id']
+    job = db.session.get(PredictionJob, job_id)
+    if not job or job.user_id != user_id:
+        return jsonify({'message': 'Job not found'}), 404
+
+    response = {
+        'job_id': job.id,
+        'image_id': job.image_id,
+        'status': job.status,
+        'create_date': job.create_date,
+        'update_date': job.update_date
+    }
+    if job.status == 'succeeded' and job.prediction:
+        response.update(serialize_prediction(job.prediction, job.prediction.image.image_path, top_k=request.args.get('top_k', type=int)))
+    elif job.status == 'failed':
+        response['error'] = job.error
+
+    return jsonify(response), 200
+
+@bp.route('/cache_stats', methods=['GET'])
+@jwt_required()
+def prediction_cache_stats():
+    return jsonify(get_prediction_cache().stats()), 200
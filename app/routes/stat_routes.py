@@ -1,9 +1,11 @@
-from flask import Blueprint, jsonify, url_for
+from flask import Blueprint, jsonify, request, url_for
 from flask_jwt_extended import jwt_required, get_jwt_identity
-from app import db
-from app.models import Prediction, Image, UserSatisfactionSurvey
+from app.models import Image
+from app.utils.stat_utils import (
+    GRANULARITIES, class_counts, confidence_histogram, health_counts, prediction_time_series, survey_option_counts
+)
 import os
-from sqlalchemy import func, case
+from sqlalchemy import case
 import datetime
 from collections import Counter
 import numpy as np
@@ -14,25 +16,7 @@ bp = Blueprint('stat', __name__, url_prefix='/stat')
 @bp.route('/overview/all', methods=['GET'])
 @jwt_required()
 def get_prediction_overview_all():
-    # Query for total number of predictions
-    total_predictions = db.session.query(Prediction).count()
-    
-    # Query for total number of healthy predictions
-    healthy_predictions = db.session.query(Prediction).filter(
-        Prediction.predicted_class.like('%healthy%')
-    ).count()
-    
-    # Query for total number of diseased plants (excluding healthy and unknown classes)
-    diseased_predictions = db.session.query(Prediction).filter(
-        ~Prediction.predicted_class.like('%healthy%'),
-        ~Prediction.predicted_class.like('%Unknown%')
-    ).count()
-
-    return jsonify({
-        'predictions_made': total_predictions,
-        'healthy_plants': healthy_predictions,
-        'diseased_plants': diseased_predictions
-    }), 200
+    return jsonify(health_counts()), 200
 
 
 @bp.route('/charts/number_of_predictions_per_class', methods=['GET'])
@@ -40,12 +24,8 @@ def get_prediction_overview_all():
 def get_number_of_predictions_per_class():
     user_id = get_jwt_identity()['id']
     
-    predictions_per_class = db.session.query(
-        Prediction.predicted_class, func.count(Prediction.id)
-    ).filter(
-        Prediction.user_id == user_id
-    ).group_by(Prediction.predicted_class).all()
-    
+    predictions_per_class = class_counts(user_id)
+
     data = {
         "classes": [result[0] for result in predictions_per_class],
         "counts": [result[1] for result in predictions_per_class]
@@ -57,18 +37,23 @@ def get_number_of_predictions_per_class():
 @bp.route('/charts/predictions_over_time', methods=['GET'])
 @jwt_required()
 def get_predictions_over_time():
+    # ?granularity=day|week|month and an optional start_date/end_date (YYYY-MM-DD); buckets are labelled by their first day
     user_id = get_jwt_identity()['id']
-    
-    predictions_over_time = db.session.query(
-        func.date_format(Prediction.prediction_date, '%Y-%m-%d').label('date'),
-        func.count(Prediction.id)
-    ).filter(
-        Prediction.user_id == user_id
-    ).group_by('date').order_by('date').all()
-    
+    granularity = request.args.get('granularity', 'day')
+    if granularity not in GRANULARITIES:
+        return jsonify({'message': f"granularity must be one of {', '.join(GRANULARITIES)}"}), 400
+    try:
+        start_date = datetime.date.fromisoformat(request.args['start_date']) if request.args.get('start_date') else None
+        end_date = datetime.date.fromisoformat(request.args['end_date']) if request.args.get('end_date') else None
+    except ValueError:
+        return jsonify({'message': 'Dates must be given as YYYY-MM-DD'}), 400
+
+    predictions_over_time = prediction_time_series(user_id, granularity, start_date, end_date)
+
     data = {
-        "dates": [result[0] for result in predictions_over_time],
-        "counts": [result[1] for result in predictions_over_time]
+        "granularity": granularity,
+        "dates": [day.isoformat() for day, _ in predictions_over_time],
+        "counts": [count for _, count in predictions_over_time]
     }
     
     return jsonify(data), 200
@@ -77,30 +62,22 @@ def get_predictions_over_time():
 @bp.route('/charts/confidence_percentage_distribution', methods=['GET'])
 @jwt_required()
 def get_confidence_percentage_distribution():
+    # ?bin_width= whole percent (default 10); bins are labelled by their lower edge and 100% counts in the last one.
+    # ?by_class=true adds the frequencies of each predicted class.
     user_id = get_jwt_identity()['id']
-    
-    confidence_percentages = db.session.query(
-        Prediction.confidence_percentage
-    ).filter(
-        Prediction.user_id == user_id
-    ).all()
-    
-    # Extract confidence percentages from the query results
-    confidence_values = [result[0] for result in confidence_percentages]
-    
-    # Create bins for confidence percentage ranges (0-10, 11-20, ..., 91-100)
-    bins = [i for i in range(0, 101, 10)]
-    frequency = [0] * len(bins)  # Initialize frequency with the number of bins
-    
-    for confidence in confidence_values:
-        bin_index = int(confidence // 10)
-        if bin_index < len(bins):  # Ensure bin_index is within range
-            frequency[bin_index] += 1
-    
+    bin_width = request.args.get('bin_width', '10')
+    if not bin_width.isdigit() or not 1 <= int(bin_width) <= 100:
+        return jsonify({'message': 'bin_width must be a whole number from 1 to 100'}), 400
+    by_class = request.args.get('by_class', '').lower() in ('1', 'true', 'yes')
+
+    bins, frequency, frequency_by_class = confidence_histogram(user_id, int(bin_width), by_class)
+
     data = {
         "bins": bins,
         "frequency": frequency
     }
+    if by_class:
+        data["by_class"] = frequency_by_class
     
     return jsonify(data), 200
 
@@ -109,50 +86,12 @@ def get_confidence_percentage_distribution():
 @jwt_required()
 def get_statistics():
     try:
-        # Calculate satisfaction statistics
-        satisfaction_stats = db.session.query(
-            UserSatisfactionSurvey.satisfaction,
-            func.count(UserSatisfactionSurvey.satisfaction)
-        ).group_by(UserSatisfactionSurvey.satisfaction).all()
-
-        # Calculate recommendation statistics
-        recommendation_stats = db.session.query(
-            UserSatisfactionSurvey.recommendation,
-            func.count(UserSatisfactionSurvey.recommendation)
-        ).group_by(UserSatisfactionSurvey.recommendation).all()
-
-        # Calculate usefulness statistics
-        usefulness_stats = db.session.query(
-            UserSatisfactionSurvey.usefulness
-        ).all()
-
-        # Calculate desired features statistics
-        desired_features_stats = db.session.query(
-            UserSatisfactionSurvey.desired_features
-        ).all()
-
-        # Convert statistics to a dictionary
-        satisfaction_dict = {stat[0]: stat[1] for stat in satisfaction_stats}
-        recommendation_dict = {stat[0]: stat[1] for stat in recommendation_stats}
-
-        # Process usefulness and desired features (comma-separated strings)
-        usefulness_dict = {}
-        for entry in usefulness_stats:
-            features = entry.usefulness.split(',')
-            for feature in features:
-                if feature in usefulness_dict:
-                    usefulness_dict[feature] += 1
-                else:
-                    usefulness_dict[feature] = 1
-
-        desired_features_dict = {}
-        for entry in desired_features_stats:
-            features = entry.desired_features.split(',')
-            for feature in features:
-                if feature in desired_features_dict:
-                    desired_features_dict[feature] += 1
-                else:
-                    desired_features_dict[feature] = 1
+        # Read the per-option counters kept as surveys are submitted
+        counts = survey_option_counts()
+        satisfaction_dict = counts.get('satisfaction', {})
+        recommendation_dict = counts.get('recommendation', {})
+        usefulness_dict = counts.get('usefulness', {})
+        desired_features_dict = counts.get('desired_features', {})
 
         # Calculate total counts for usefulness and desired features
         total_usefulness = sum(usefulness_dict.values())
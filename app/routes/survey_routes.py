@@ -17,18 +17,14 @@ def submit_survey():
 
         data = request.get_json()
 
-        # Convert lists to comma-separated strings
-        usefulness = ','.join(data['usefulness'])
-        desired_features = ','.join(data['desiredFeatures'])
-
         # Check if a survey already exists for the user
         existing_survey = UserSatisfactionSurvey.query.filter_by(user_id=user_id).first()
 
         if existing_survey:
-            # Update the existing survey
+            # Update the existing survey; only the answers that changed move the option counters
             existing_survey.satisfaction = data['satisfaction']
-            existing_survey.usefulness = usefulness
-            existing_survey.desired_features = desired_features
+            existing_survey.set_options('usefulness', data['usefulness'])
+            existing_survey.set_options('desired_features', data['desiredFeatures'])
             existing_survey.recommendation = data['recommendation']
             db.session.commit()
             return jsonify({"message": "Survey updated successfully!"}), 200
@@ -37,10 +33,10 @@ def submit_survey():
             new_survey = UserSatisfactionSurvey(
                 user_id=user_id,
                 satisfaction=data['satisfaction'],
-                usefulness=usefulness,
-                desired_features=desired_features,
                 recommendation=data['recommendation']
             )
+            new_survey.set_options('usefulness', data['usefulness'])
+            new_survey.set_options('desired_features', data['desiredFeatures'])
             db.session.add(new_survey)
             db.session.commit()
             return jsonify({"message": "Survey submitted successfully!"}), 201
@@ -0,0 +1,12 @@
+from flask import current_app
+from app import db
+from app.models import User
+
+
+def is_admin(user_id):
+    # Admins are the accounts listed in ADMIN_EMAILS; they may read data across all users
+    admin_emails = current_app.config.get('ADMIN_EMAILS') or []
+    if not admin_emails:
+        return False
+    user = db.session.get(User, user_id)
+    return user is not None and user.email is not None and user.email.lower() in admin_emails
@@ -0,0 +1,80 @@
+from concurrent.futures import Future
+import logging
+import os
+import queue
+import threading
+import time
+
+
+class MicroBatcher:
+    """Collects single-item requests into batches for one forward pass.
+
+    Callers submit one item at a time and block on their own future. A single
+    background thread waits up to ``max_wait_ms`` (or until ``max_batch_size``
+    items are queued), calls ``predict_fn`` once with the list of items and
+    hands every caller the result at its position in the returned list.
+    """
+
+    def __init__(self, predict_fn, max_batch_size=16, max_wait_ms=5):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def submit(self, item):
+        future = Future()
+        self._ensure_worker()
+        self._queue.put((item, future))
+        return future
+
+    def predict(self, item, timeout=None):
+        return self.submit(item).result(timeout=timeout)
+
+    def _ensure_worker(self):
+        # The worker thread does not survive a fork (e.g. gunicorn --preload),
+        # so start a fresh one whenever we are in a new process.
+        if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            if self._pid != os.getpid():
+                self._queue = queue.Queue()
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='micro-batcher', daemon=True)
+            self._thread.start()
+
+    def _collect_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+            items = [item for item, _ in batch]
+            try:
+                results = self.predict_fn(items)
+                if len(results) != len(batch):
+                    raise RuntimeError(f"Batch returned {len(results)} results for {len(batch)} inputs")
+            except Exception as e:
+                logging.error(f"Error in batched prediction: {str(e)}")
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            logging.info(f"Ran batched prediction for {len(batch)} image(s)")
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
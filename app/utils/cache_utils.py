@@ -0,0 +1,139 @@
+from collections import OrderedDict
+from flask import current_app
+from sqlalchemy.exc import IntegrityError
+from app import db
+from app.models import PredictionCacheEntry
+from app.utils.model_utils import PredictionResult, pack_probabilities, unpack_probabilities
+import datetime
+import hashlib
+import logging
+import threading
+import time
+
+def hash_image_file(image_path, chunk_size=1024 * 1024):
+    sha256 = hashlib.sha256()
+    with open(image_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+class PredictionCache:
+    """LRU/TTL cache of predictions keyed on image content hash and model version.
+
+    The in-memory tier is per process. When ``persistent`` is set, misses fall
+    back to the ``PredictionCacheEntry`` table so results survive restarts and
+    are shared between workers. Entries are written on a connection of their
+    own, so storing them never commits the caller's session.
+    """
+
+    def __init__(self, max_size=1024, ttl=86400, persistent=False):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.persistent = persistent
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.persistent_hits = 0
+        self.misses = 0
+
+    def get(self, content_hash, model_version):
+        key = (content_hash, model_version)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, stored_at = entry
+                if time.monotonic() - stored_at <= self.ttl:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+
+        if self.persistent:
+            value = self._get_persistent(content_hash, model_version)
+            if value is not None:
+                self._store(key, value)
+                with self._lock:
+                    self.persistent_hits += 1
+                return value
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, content_hash, model_version, value):
+        self.put_many([(content_hash, model_version, value)])
+
+    def put_many(self, entries):
+        """Store ``(content_hash, model_version, value)`` entries, in one transaction when persistent."""
+        for content_hash, model_version, value in entries:
+            self._store((content_hash, model_version), value)
+        if self.persistent and entries:
+            self._put_persistent(entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.persistent_hits + self.misses
+            return {
+                'hits': self.hits,
+                'persistent_hits': self.persistent_hits,
+                'misses': self.misses,
+                'hit_rate': round((self.hits + self.persistent_hits) / lookups, 4) if lookups else 0.0,
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'persistent': self.persistent
+            }
+
+    def _store(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def _get_persistent(self, content_hash, model_version):
+        entry = PredictionCacheEntry.query.filter_by(content_hash=content_hash, model_version=model_version).first()
+        if entry is None:
+            return None
+        if datetime.datetime.utcnow() - entry.create_date > datetime.timedelta(seconds=self.ttl):
+            return None
+        return PredictionResult(entry.predicted_class, entry.confidence_percentage, unpack_probabilities(entry.probabilities))
+
+    def _put_persistent(self, entries):
+        table = PredictionCacheEntry.__table__
+        try:
+            with db.engine.begin() as connection:
+                for content_hash, model_version, value in entries:
+                    predicted_class, confidence_percentage = value
+                    key = (table.c.content_hash == content_hash, table.c.model_version == model_version)
+                    values = {
+                        'predicted_class': predicted_class,
+                        'confidence_percentage': confidence_percentage,
+                        'probabilities': pack_probabilities(getattr(value, 'probabilities', None)),
+                        'create_date': datetime.datetime.utcnow()
+                    }
+                    if connection.execute(table.update().where(*key).values(**values)).rowcount:
+                        continue
+                    try:
+                        with connection.begin_nested():
+                            connection.execute(table.insert().values(content_hash=content_hash, model_version=model_version, **values))
+                    except IntegrityError:
+                        # Another worker stored the same image concurrently
+                        pass
+        except Exception as e:
+            logging.error(f"Error storing cached predictions: {e}")
+
+def get_prediction_cache():
+    cache = current_app.extensions.get('prediction_cache')
+    if cache is None:
+        cache = PredictionCache(
+            max_size=current_app.config.get('PREDICTION_CACHE_SIZE', 1024),
+            ttl=current_app.config.get('PREDICTION_CACHE_TTL', 86400),
+            persistent=current_app.config.get('PREDICTION_CACHE_PERSISTENT', False)
+        )
+        cache = current_app.extensions.setdefault('prediction_cache', cache)
+    return cache
@@ -0,0 +1,290 @@
+from flask import current_app
+from itertools import groupby
+from sqlalchemy import delete, exists, or_, select
+from app import db
+from app.models import Blob, Image, Prediction, PredictionJob
+from app.utils.image_utils import VARIANT_COLUMNS
+from app.utils.stat_utils import uncount_predictions
+from app.utils.storage_utils import BLOB_KEY, get_storage
+from app.utils.upload_utils import expire_chunked_uploads
+import datetime
+import logging
+import os
+
+IMAGE_FILE_COLUMNS = ('image_path',) + tuple(VARIANT_COLUMNS.values())
+
+class GarbageReport:
+    def __init__(self):
+        self.images_expired = 0
+        self.predictions_deleted = 0
+        self.orphan_images = 0
+        self.blobs_deleted = 0
+        self.files_deleted = 0
+        self.bytes_reclaimed = 0
+        self.missing_files = 0
+
+    def deleted_file(self, size):
+        self.files_deleted += 1
+        self.bytes_reclaimed += size or 0
+
+    def summary(self, dry_run=False):
+        verb = 'Would delete' if dry_run else 'Deleted'
+        return (
+            f"{verb} {self.files_deleted} file(s), {self.bytes_reclaimed / 1024 / 1024:.1f} MB; "
+            f"{self.images_expired} expired and {self.orphan_images} orphaned image(s), "
+            f"{self.predictions_deleted} prediction(s), {self.blobs_deleted} blob row(s); "
+            f"{self.missing_files} missing file(s) kept for their predictions"
+        )
+
+def collect_garbage(batch_size=1000, dry_run=False):
+    """Expire old images and delete stored files and rows nothing refers to.
+
+    Runs in short batches, each its own transaction, so no table is locked
+    for long and neither the storage listing nor a table is ever held in
+    memory. Rows are deleted first and files only once that has committed,
+    so a failure leaves at worst an orphan file for the next run. Nothing
+    younger than UPLOAD_GC_GRACE_PERIOD is touched: uploads move their file
+    into place before the Image row is committed. Blobs are only deleted
+    once they have had no references for that long, and an upload reusing
+    one restarts the clock (see storage_utils.claim_blob), so images
+    expired by this run free their files on a later one.
+    """
+    config = current_app.config
+    report = GarbageReport()
+    storage = get_storage()
+    now = datetime.datetime.utcnow()
+    grace_cutoff = now - datetime.timedelta(seconds=config.get('UPLOAD_GC_GRACE_PERIOD', 3600))
+
+    unpredicted_days = config.get('UPLOAD_UNPREDICTED_RETENTION_DAYS', 0)
+    if unpredicted_days:
+        cutoff = now - datetime.timedelta(days=unpredicted_days)
+        _delete_images(report, storage, _unpredicted(Image.upload_date < cutoff), batch_size, dry_run)
+    retention_days = config.get('UPLOAD_RETENTION_DAYS', 0)
+    if retention_days:
+        cutoff = now - datetime.timedelta(days=retention_days)
+        _delete_images(report, storage, Image.upload_date < cutoff, batch_size, dry_run)
+
+    _delete_missing_legacy_images(report, storage, grace_cutoff, batch_size, dry_run)
+    _scan_storage(report, storage, grace_cutoff, batch_size, dry_run)
+
+    _delete_stale_spool(report, storage, grace_cutoff, dry_run)
+    if not dry_run:
+        expire_chunked_uploads(config.get('CHUNKED_UPLOAD_TTL', 86400))
+    logging.info(report.summary(dry_run))
+    return report
+
+def _unpredicted(*criteria):
+    return db.and_(
+        *criteria,
+        ~exists().where(Prediction.image_id == Image.id),
+        ~exists().where(PredictionJob.image_id == Image.id)
+    )
+
+def _image_batches(criteria, batch_size):
+    # Keyset pages over the primary key; each page is read in its own short query
+    last_id = 0
+    while True:
+        images = Image.query.filter(Image.id > last_id, criteria).order_by(Image.id).limit(batch_size).all()
+        if not images:
+            return
+        last_id = images[-1].id
+        yield images
+
+def _delete_images(report, storage, criteria, batch_size, dry_run):
+    """Delete the matching images with their predictions and jobs. Blob files
+    are collected by the storage scan once their reference count is zero;
+    legacy files belong to their one image and go with it."""
+    for images in _image_batches(criteria, batch_size):
+        report.images_expired += len(images)
+        image_ids = [image.id for image in images]
+        legacy_paths = [
+            path for image in images if not image.content_hash
+            for path in (getattr(image, column) for column in IMAGE_FILE_COLUMNS) if path
+        ]
+        if dry_run:
+            report.predictions_deleted += Prediction.query.filter(Prediction.image_id.in_(image_ids)).count()
+            db.session.rollback()
+            continue
+
+        db.session.execute(delete(PredictionJob).where(PredictionJob.image_id.in_(image_ids)))
+        uncount_predictions(Prediction.image_id.in_(image_ids))
+        report.predictions_deleted += db.session.execute(delete(Prediction).where(Prediction.image_id.in_(image_ids))).rowcount
+        for image in images:
+            # One by one through the ORM, so the blob reference counts follow
+            db.session.delete(image)
+        db.session.commit()
+        for path in legacy_paths:
+            _delete_file(report, storage, storage.key_for(path))
+
+def _delete_missing_legacy_images(report, storage, grace_cutoff, batch_size, dry_run):
+    # Legacy uploads have no blob row: a missing file is only noticed from the Image side
+    criteria = db.and_(Image.content_hash.is_(None), Image.upload_date < grace_cutoff)
+    for images in _image_batches(criteria, batch_size):
+        missing = [image for image in images if not image.image_path or not storage.exists(storage.key_for(image.image_path))]
+        _delete_orphan_images(report, [image.id for image in missing], dry_run)
+
+def _delete_orphan_images(report, image_ids, dry_run):
+    # Images whose file is gone: dropped unless a prediction still shows them in a user's history
+    if not image_ids:
+        return
+    orphans = Image.query.filter(_unpredicted(Image.id.in_(image_ids))).all()
+    report.orphan_images += len(orphans)
+    report.missing_files += len(image_ids) - len(orphans)
+    if dry_run:
+        db.session.rollback()
+        return
+    for image in orphans:
+        db.session.delete(image)
+    db.session.commit()
+
+def _blob_rows(batch_size):
+    # Blob rows by ascending hash, in keyset pages; plain rows, so nothing piles up in the session
+    last_hash = ''
+    while True:
+        rows = db.session.execute(
+            select(Blob.content_hash, Blob.ref_count, Blob.create_date, Blob.unreferenced_since)
+            .where(Blob.content_hash > last_hash).order_by(Blob.content_hash).limit(batch_size)
+        ).all()
+        db.session.rollback()
+        if not rows:
+            return
+        last_hash = rows[-1].content_hash
+        yield from rows
+
+def _file_hash(stored_file):
+    match = BLOB_KEY.match(stored_file[0])
+    return match['hash'] if match else None
+
+def _scan_storage(report, storage, grace_cutoff, batch_size, dry_run):
+    """Merge the storage listing with the blob table, both in hash order.
+
+    Files with no blob row are orphans. Blobs nothing refers to any more are
+    deleted with their files. Blobs whose files are gone take their
+    unpredicted images with them. Files outside the blob layout (legacy
+    uploads) are looked up against the Image table a batch at a time.
+    """
+    cutoff = grace_cutoff.replace(tzinfo=datetime.timezone.utc).timestamp()
+    blobs = _blob_rows(batch_size)
+    blob = next(blobs, None)
+    unreferenced = []
+    legacy = []
+    missing = []
+
+    for content_hash, group in groupby(storage.iter_files(), key=_file_hash):
+        files = list(group)
+        if content_hash is None:
+            legacy.extend(files)
+            if len(legacy) >= batch_size:
+                _collect_legacy(report, storage, legacy, cutoff, dry_run)
+                legacy = []
+            continue
+
+        while blob is not None and blob.content_hash < content_hash:
+            missing.append(blob)
+            blob = next(blobs, None)
+        if blob is not None and blob.content_hash == content_hash:
+            if _unreferenced(blob, grace_cutoff):
+                unreferenced.append((blob.content_hash, files))
+            blob = next(blobs, None)
+        elif all(mtime < cutoff for _, _, mtime in files):
+            # Left behind by an upload that failed after storing its file
+            for key, size, _ in files:
+                _delete_file(report, storage, key, size, dry_run)
+
+        if len(unreferenced) >= batch_size:
+            _collect_blobs(report, storage, unreferenced, grace_cutoff, dry_run)
+            unreferenced = []
+        if len(missing) >= batch_size:
+            _collect_missing(report, missing, grace_cutoff, dry_run)
+            missing = []
+
+    while blob is not None:
+        missing.append(blob)
+        blob = next(blobs, None)
+        if len(missing) >= batch_size:
+            _collect_missing(report, missing, grace_cutoff, dry_run)
+            missing = []
+    _collect_blobs(report, storage, unreferenced, grace_cutoff, dry_run)
+    _collect_missing(report, missing, grace_cutoff, dry_run)
+    _collect_legacy(report, storage, legacy, cutoff, dry_run)
+
+def _unreferenced(blob, grace_cutoff):
+    return blob.ref_count <= 0 and blob.unreferenced_since is not None and blob.unreferenced_since < grace_cutoff
+
+def _unreferenced_criteria(grace_cutoff):
+    # The same test in SQL, re-checked by each delete: an upload may have just claimed the blob
+    return db.and_(Blob.ref_count <= 0, Blob.unreferenced_since < grace_cutoff)
+
+def _collect_blobs(report, storage, unreferenced, grace_cutoff, dry_run):
+    if not unreferenced:
+        return
+    collected = []
+    for content_hash, files in unreferenced:
+        if dry_run or db.session.execute(
+            delete(Blob).where(Blob.content_hash == content_hash, _unreferenced_criteria(grace_cutoff))
+        ).rowcount:
+            collected.append(files)
+    db.session.commit()
+    report.blobs_deleted += len(collected)
+    for files in collected:
+        for key, size, _ in files:
+            _delete_file(report, storage, key, size, dry_run)
+
+def _collect_missing(report, missing, grace_cutoff, dry_run):
+    if not missing:
+        return
+    old = [blob for blob in missing if blob.create_date < grace_cutoff]
+    image_ids = db.session.execute(
+        select(Image.id).where(Image.content_hash.in_([blob.content_hash for blob in old]))
+    ).scalars().all()
+    _delete_orphan_images(report, image_ids, dry_run)
+
+    # Rows left without files or images; the next run picks up blobs that only now lost their last image
+    empty = [blob.content_hash for blob in old if _unreferenced(blob, grace_cutoff)]
+    if empty:
+        if dry_run:
+            report.blobs_deleted += len(empty)
+        else:
+            report.blobs_deleted += db.session.execute(
+                delete(Blob).where(Blob.content_hash.in_(empty), _unreferenced_criteria(grace_cutoff))
+            ).rowcount
+            db.session.commit()
+
+def _collect_legacy(report, storage, files, cutoff, dry_run):
+    if not files:
+        return
+    locations = {storage.location(key): (key, size, mtime) for key, size, mtime in files}
+    columns = [getattr(Image, column) for column in IMAGE_FILE_COLUMNS]
+    referenced = set()
+    for row in db.session.execute(select(*columns).where(or_(*(column.in_(locations) for column in columns)))):
+        referenced.update(row)
+    db.session.rollback()
+    for location, (key, size, mtime) in locations.items():
+        if location not in referenced and mtime < cutoff:
+            _delete_file(report, storage, key, size, dry_run)
+
+def _delete_file(report, storage, key, size=None, dry_run=False):
+    try:
+        if size is None:
+            size = storage.size(key)
+        if not dry_run:
+            storage.delete(key)
+        report.deleted_file(size)
+    except OSError as e:
+        # Already gone, or removed by a concurrent run
+        logging.warning(f"Could not delete {key}: {e}")
+
+def _delete_stale_spool(report, storage, grace_cutoff, dry_run):
+    # Spool files of requests that died before storing or discarding them; resumable uploads have their own TTL
+    folder = storage.incoming_dir()
+    if not os.path.isdir(folder):
+        return
+    cutoff = grace_cutoff.replace(tzinfo=datetime.timezone.utc).timestamp()
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.is_file(follow_symlinks=False):
+                stat = entry.stat(follow_symlinks=False)
+                if stat.st_mtime < cutoff:
+                    if not dry_run:
+                        os.remove(entry.path)
+                    report.deleted_file(stat.st_size)
@@ -0,0 +1,111 @@
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from PIL import Image as PILImage, ImageOps
+from app import db
+from app.models import Image
+from app.utils.storage_utils import get_storage
+import io
+import logging
+import os
+
+# Derivatives written next to each upload: a small thumbnail for dashboards and
+# PDFs and a web-sized copy for viewing. Inference reads the original.
+IMAGE_VARIANTS = ('thumbnail', 'web')
+
+# Image column recording the file of each variant
+VARIANT_COLUMNS = {
+    'thumbnail': 'thumbnail_path',
+    'web': 'web_path'
+}
+
+def variant_filename(filename, variant):
+    if variant not in IMAGE_VARIANTS:
+        raise ValueError(f"Unknown image variant '{variant}', expected one of {', '.join(IMAGE_VARIANTS)}")
+    return f"{os.path.splitext(filename)[0]}_{variant}.jpg"
+
+def variant_path(image_path, variant):
+    return os.path.join(os.path.dirname(image_path), variant_filename(os.path.basename(image_path), variant))
+
+def existing_derivatives(image_path):
+    storage = get_storage()
+    paths = {variant: variant_path(image_path, variant) for variant in IMAGE_VARIANTS}
+    return paths if all(storage.exists(storage.key_for(path)) for path in paths.values()) else None
+
+def create_derivatives(image_path, thumbnail_size=150, web_size=1024):
+    """Write the thumbnail and web variants of an uploaded image.
+
+    The upload is decoded once, downscaled by the JPEG decoder to roughly the
+    web size, and rotated upright according to its EXIF orientation. Variants
+    are saved without EXIF (no GPS position or camera details) while the
+    original file is left byte for byte as uploaded. Returns the path of
+    each variant.
+    """
+    storage = get_storage()
+    key = storage.key_for(image_path)
+    # Remote objects are buffered: decoders need to seek
+    with PILImage.open(storage.local_path(key) or io.BytesIO(storage.read(key))) as img:
+        img.draft('RGB', (web_size, web_size))
+        img = ImageOps.exif_transpose(img).convert('RGB')
+
+    paths = {variant: variant_path(image_path, variant) for variant in IMAGE_VARIANTS}
+
+    web = img.copy()
+    web.thumbnail((web_size, web_size), PILImage.Resampling.LANCZOS)
+    _save(storage, web, paths['web'], 'JPEG', quality=85, optimize=True, progressive=True)
+
+    thumbnail = web.copy()
+    thumbnail.thumbnail((thumbnail_size, thumbnail_size), PILImage.Resampling.LANCZOS)
+    _save(storage, thumbnail, paths['thumbnail'], 'JPEG', quality=80, optimize=True)
+
+    return paths
+
+def _save(storage, img, path, image_format, **params):
+    # Encoded in memory and written in one go, so a half-written variant is never served
+    buffer = io.BytesIO()
+    img.save(buffer, format=image_format, **params)
+    storage.put_bytes(buffer.getvalue(), storage.key_for(path))
+
+def process_image(app, image_id):
+    with app.app_context():
+        try:
+            image = db.session.get(Image, image_id)
+            if image is None or not image.image_path:
+                return
+            # Duplicate uploads share one stored file, and so its variants too
+            paths = existing_derivatives(image.image_path) or create_derivatives(
+                image.image_path,
+                thumbnail_size=app.config.get('IMAGE_THUMBNAIL_SIZE', 150),
+                web_size=app.config.get('IMAGE_WEB_SIZE', 1024)
+            )
+            for variant, path in paths.items():
+                setattr(image, VARIANT_COLUMNS[variant], path)
+            db.session.commit()
+            logging.info(f"Image variants created for image {image_id}")
+        except Exception as e:
+            db.session.rollback()
+            logging.error(f"Error creating variants for image {image_id}: {e}")
+        finally:
+            db.session.remove()
+
+def schedule_derivatives(image_records):
+    """Create the variants of freshly committed uploads on the ingest thread pool."""
+    app = current_app._get_current_object()
+    for image_record in image_records:
+        if app.config.get('IMAGE_INGEST_EAGER'):
+            process_image(app, image_record.id)
+        else:
+            _get_executor(app).submit(process_image, app, image_record.id)
+
+def _get_executor(app):
+    executor = app.extensions.get('image_ingest')
+    if executor is None:
+        executor = ThreadPoolExecutor(max_workers=app.config.get('IMAGE_INGEST_WORKERS', 2), thread_name_prefix='image-ingest')
+        executor = app.extensions.setdefault('image_ingest', executor)
+    return executor
+
+def image_file_for(image_path, thumbnail_path=None):
+    # The thumbnail when it has been created, otherwise the original
+    storage = get_storage()
+    if thumbnail_path and storage.exists(storage.key_for(thumbnail_path)):
+        return thumbnail_path
+    return image_path
@@ -0,0 +1,198 @@
+import numpy as np
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+# Every backend takes a float32 batch of shape (n, 256, 256, 3) with pixel
+# values in [0, 255] and returns an (n, len(CLASS_NAMES)) array of probabilities.
+
+class KerasBackend:
+    name = 'keras'
+
+    def __init__(self, model_path, num_threads=None):
+        import tensorflow as tf
+        if num_threads:
+            _set_tensorflow_threads(tf, num_threads)
+        self.model = tf.keras.models.load_model(model_path)
+
+    def predict(self, batch):
+        return self.model.predict(batch, verbose=0)
+
+class TFLiteBackend:
+    name = 'tflite'
+
+    def __init__(self, model_path, num_threads=None):
+        self.interpreter = _tflite_interpreter_class()(model_path=model_path, num_threads=num_threads)
+        self.interpreter.allocate_tensors()
+        self.input_detail = self.interpreter.get_input_details()[0]
+        self.output_detail = self.interpreter.get_output_details()[0]
+        # An interpreter holds its tensors in place, so calls must not overlap
+        self._lock = threading.Lock()
+
+    def predict(self, batch):
+        with self._lock:
+            if tuple(self.input_detail['shape']) != batch.shape:
+                self.interpreter.resize_tensor_input(self.input_detail['index'], batch.shape)
+                self.interpreter.allocate_tensors()
+                self.input_detail = self.interpreter.get_input_details()[0]
+                self.output_detail = self.interpreter.get_output_details()[0]
+
+            self.interpreter.set_tensor(self.input_detail['index'], _quantize(batch, self.input_detail))
+            self.interpreter.invoke()
+            return _dequantize(self.interpreter.get_tensor(self.output_detail['index']), self.output_detail)
+
+class OnnxBackend:
+    name = 'onnx'
+
+    def __init__(self, model_path, num_threads=None):
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+            options.inter_op_num_threads = 1
+        self.session = ort.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def predict(self, batch):
+        return self.session.run(None, {self.input_name: batch.astype(np.float32, copy=False)})[0]
+
+BACKENDS = {
+    KerasBackend.name: KerasBackend,
+    TFLiteBackend.name: TFLiteBackend,
+    OnnxBackend.name: OnnxBackend
+}
+
+def create_backend(name, model_path, num_threads=None):
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown inference backend '{name}', expected one of {', '.join(BACKENDS)}")
+    logging.info(f"Loading {name} inference backend from {model_path}")
+    return BACKENDS[name](model_path, num_threads=num_threads)
+
+def _set_tensorflow_threads(tf, num_threads):
+    try:
+        tf.config.threading.set_intra_op_parallelism_threads(num_threads)
+        tf.config.threading.set_inter_op_parallelism_threads(1)
+    except RuntimeError:
+        # Thread pools can only be configured before TensorFlow initialises them
+        logging.warning("TensorFlow already initialised, ignoring inference thread count")
+
+def _tflite_interpreter_class():
+    # Prefer the standalone runtimes, which do not need the full TensorFlow install
+    try:
+        from ai_edge_litert.interpreter import Interpreter
+        return Interpreter
+    except ImportError:
+        pass
+    try:
+        from tflite_runtime.interpreter import Interpreter
+        return Interpreter
+    except ImportError:
+        import tensorflow as tf
+        return tf.lite.Interpreter
+
+def _quantize(batch, detail):
+    scale, zero_point = detail['quantization']
+    if detail['dtype'] in (np.int8, np.uint8) and scale:
+        info = np.iinfo(detail['dtype'])
+        return np.clip(np.round(batch / scale + zero_point), info.min, info.max).astype(detail['dtype'])
+    return batch.astype(detail['dtype'], copy=False)
+
+def _dequantize(output, detail):
+    scale, zero_point = detail['quantization']
+    if detail['dtype'] in (np.int8, np.uint8) and scale:
+        return (output.astype(np.float32) - zero_point) * scale
+    return output.astype(np.float32, copy=False)
+
+def convert_model(keras_model_path, output_path, target, quantization=None, sample_batches=None):
+    """Convert the Keras model to a TFLite or ONNX file.
+
+    ``quantization`` is ``None``, ``'float16'`` or ``'int8'``. Full int8
+    TFLite quantisation calibrates on ``sample_batches`` (an iterable of
+    float32 batches), which should be real leaf images for good accuracy.
+    """
+    import tensorflow as tf
+    model = tf.keras.models.load_model(keras_model_path)
+
+    if target == 'tflite':
+        saved_model_dir = tempfile.mkdtemp()
+        try:
+            model.export(saved_model_dir)
+            converter = tf.lite.TFLiteConverter.from_saved_model(saved_model_dir)
+            if quantization == 'float16':
+                converter.optimizations = [tf.lite.Optimize.DEFAULT]
+                converter.target_spec.supported_types = [tf.float16]
+            elif quantization == 'int8':
+                if sample_batches is None:
+                    raise ValueError("int8 quantisation needs sample images for calibration")
+                batches = list(sample_batches)
+                converter.optimizations = [tf.lite.Optimize.DEFAULT]
+                converter.representative_dataset = lambda: ([image[np.newaxis]] for batch in batches for image in batch)
+                converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+            elif quantization:
+                raise ValueError(f"Unsupported TFLite quantisation '{quantization}'")
+            with open(output_path, 'wb') as f:
+                f.write(converter.convert())
+        finally:
+            shutil.rmtree(saved_model_dir, ignore_errors=True)
+
+    elif target == 'onnx':
+        # Keras only exports models that have been built by a call
+        model.predict(np.zeros((1, *model.input_shape[1:]), dtype=np.float32), verbose=0)
+        if not quantization:
+            model.export(output_path, format='onnx')
+            return output_path
+
+        float_path = output_path + '.float32.tmp'
+        try:
+            model.export(float_path, format='onnx')
+            if quantization == 'int8':
+                from onnxruntime.quantization import quantize_dynamic, QuantType
+                quantize_dynamic(float_path, output_path, weight_type=QuantType.QInt8)
+            elif quantization == 'float16':
+                import onnx
+                from onnxconverter_common import float16
+                onnx.save(float16.convert_float_to_float16(onnx.load(float_path), keep_io_types=True), output_path)
+            else:
+                raise ValueError(f"Unsupported ONNX quantisation '{quantization}'")
+        finally:
+            if os.path.exists(float_path):
+                os.remove(float_path)
+
+    else:
+        raise ValueError(f"Unknown conversion target '{target}'")
+
+    return output_path
+
+def compare_backends(reference, candidate, batches):
+    """Compare a candidate backend's top-1 output against a reference backend.
+
+    Returns the number of images, top-1 agreement, the largest absolute
+    probability difference and the mean latency per image of both backends.
+    """
+    total = agreed = 0
+    max_abs_diff = 0.0
+    reference_time = candidate_time = 0.0
+
+    for batch in batches:
+        start = time.perf_counter()
+        expected = np.asarray(reference.predict(batch))
+        reference_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        actual = np.asarray(candidate.predict(batch))
+        candidate_time += time.perf_counter() - start
+
+        total += len(batch)
+        agreed += int(np.sum(np.argmax(expected, axis=1) == np.argmax(actual, axis=1)))
+        max_abs_diff = max(max_abs_diff, float(np.max(np.abs(expected - actual))))
+
+    return {
+        'images': total,
+        'top1_agreement': agreed / total if total else 0.0,
+        'max_abs_diff': max_abs_diff,
+        'reference_ms_per_image': 1000 * reference_time / total if total else 0.0,
+        'candidate_ms_per_image': 1000 * candidate_time / total if total else 0.0
+    }
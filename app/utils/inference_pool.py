@@ -0,0 +1,215 @@
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+import itertools
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+
+class InferencePoolBusy(Exception):
+    """Raised when the request queue stays full, so callers can shed load."""
+
+class InferencePoolTimeout(InferencePoolBusy):
+    """Raised when no result arrives in time; the request is forgotten."""
+
+class InferenceError(RuntimeError):
+    """The model failed on a batch, or the worker running it died."""
+
+class ImageDecodeError(ValueError):
+    """The image could not be decoded; the worker itself is fine."""
+
+class InferencePool:
+    """A pool of processes that each decode images and run their own model copy.
+
+    Image references travel to the workers over a bounded multiprocessing
+    queue (a pipe) and results come back over a second queue, so the Flask
+    process never touches TensorFlow and stays responsive. When the request
+    queue is full for ``submit_timeout`` seconds ``InferencePoolBusy`` is
+    raised instead of queueing more work. Each worker micro-batches whatever
+    is waiting in the queue, up to ``max_batch_size`` images, and returns
+    the probability vector for every image.
+
+    Workers run with the settings given here (``worker_settings`` holds the
+    rest, e.g. the preprocessing backend), never the environment's. A worker
+    that dies is replaced, and the requests it had taken fail with
+    ``InferenceError`` rather than waiting out their timeout.
+    """
+
+    def __init__(self, processes, backend_name, model_path, threads_per_process=1, queue_size=64,
+                 submit_timeout=0.5, max_batch_size=16, max_wait_ms=5, worker_settings=None, start=True,
+                 check_interval=1.0):
+        # Workers are spawned rather than forked: TensorFlow is not fork safe
+        self._context = multiprocessing.get_context('spawn')
+        self.submit_timeout = submit_timeout
+        self.check_interval = check_interval
+        self._requests = self._context.Queue(maxsize=queue_size)
+        self._results = self._context.Queue()
+        self._futures = {}
+        self._futures_lock = threading.Lock()
+        self._ids = itertools.count()
+        self._worker_args = (backend_name, model_path, threads_per_process, max_batch_size, max_wait_ms, worker_settings or {})
+        self._processes = [self._new_worker(i) for i in range(processes)]
+        self._taken = {}  # worker index -> request ids it is working on
+        self._started = self._closing = False
+        self._collector = threading.Thread(target=self._collect, name='inference-results', daemon=True)
+        self.pid = os.getpid()
+        if start:
+            self.start()
+
+    def _new_worker(self, index):
+        return self._context.Process(
+            target=_worker_main,
+            args=(self._requests, self._results, index, *self._worker_args),
+            name=f'inference-worker-{index}',
+            daemon=True
+        )
+
+    def start(self):
+        for process in self._processes:
+            process.start()
+        self._started = True
+        self._collector.start()
+
+    def submit(self, image, timeout=None):
+        if self._started and not self.alive_workers():
+            # Every worker is down (e.g. the model fails to load); answer now rather than after the timeout
+            raise InferencePoolBusy("No inference worker is running")
+        request_id = next(self._ids)
+        future = Future()
+        future.request_id = request_id
+        with self._futures_lock:
+            self._futures[request_id] = future
+        try:
+            self._requests.put((request_id, image), timeout=self.submit_timeout if timeout is None else timeout)
+        except queue.Full:
+            self._forget(request_id)
+            raise InferencePoolBusy("Inference queue is full")
+        return future
+
+    def result(self, future, timeout=None):
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeout:
+            self._forget(future.request_id)
+            raise InferencePoolTimeout(f"No inference result within {timeout}s")
+
+    def predict(self, image, timeout=None):
+        return self.result(self.submit(image), timeout=timeout)
+
+    def alive_workers(self):
+        return sum(process.is_alive() for process in self._processes)
+
+    def close(self):
+        self._closing = True
+        for _ in self._processes:
+            self._requests.put(None)
+        for process in self._processes:
+            process.join(timeout=5)
+
+    def _forget(self, request_id):
+        with self._futures_lock:
+            return self._futures.pop(request_id, None)
+
+    def _replace_dead_workers(self):
+        for index, process in enumerate(self._processes):
+            if process.is_alive() or self._closing:
+                continue
+            logging.error(f"Inference worker {process.name} exited with code {process.exitcode}, restarting it")
+            for request_id in self._taken.pop(index, ()):
+                future = self._forget(request_id)
+                if future is not None:
+                    future.set_exception(InferenceError(f"Inference worker exited with code {process.exitcode}"))
+            self._processes[index] = self._new_worker(index)
+            self._processes[index].start()
+
+    def _collect(self):
+        while not self._closing:
+            try:
+                request_id, result, error = self._results.get(timeout=self.check_interval)
+            except queue.Empty:
+                self._replace_dead_workers()
+                continue
+            if request_id is None:
+                # A worker announcing the batch it took: (None, worker index, request ids)
+                self._taken[result] = error
+                continue
+            future = self._forget(request_id)
+            if future is None:
+                continue
+            if error is not None:
+                future.set_exception(error if isinstance(error, Exception) else InferenceError(error))
+            else:
+                future.set_result(result)
+            self._replace_dead_workers()
+
+def _next_batch(requests, max_batch_size, max_wait):
+    batch = [requests.get()]
+    if batch[0] is None:
+        return batch
+    deadline = time.monotonic() + max_wait
+    while len(batch) < max_batch_size:
+        remaining = deadline - time.monotonic()
+        try:
+            item = requests.get(timeout=remaining) if remaining > 0 else requests.get_nowait()
+        except queue.Empty:
+            break
+        batch.append(item)
+        if item is None:
+            break
+    return batch
+
+def serve_requests(backend, requests, results, max_batch_size=16, max_wait_ms=5, preprocessing_backend=None, worker_index=None):
+    """Worker loop: decode and classify batches until a ``None`` sentinel arrives.
+
+    With a ``worker_index`` the ids of each batch are announced on ``results``
+    before work starts, so the pool can fail them if this process dies.
+    """
+    from app.utils.model_utils import IMAGE_SIZE, preprocess_image
+    import numpy as np
+
+    # Images are decoded straight into their slot of one reused batch array
+    batch_buffer = np.empty((max_batch_size, *IMAGE_SIZE, 3), dtype=np.float32)
+
+    while True:
+        batch = _next_batch(requests, max_batch_size, max_wait_ms / 1000.0)
+        stop = batch[-1] is None
+        batch = [item for item in batch if item is not None]
+        if worker_index is not None and batch:
+            results.put((None, worker_index, [request_id for request_id, _ in batch]))
+
+        decoded = []
+        for request_id, image in batch:
+            slot = batch_buffer[len(decoded)]
+            try:
+                # Image paths are decoded here; arrays (e.g. warm-up input) are copied as they are
+                if isinstance(image, np.ndarray):
+                    slot[...] = image
+                else:
+                    img = preprocess_image(image, out=slot, backend=preprocessing_backend)
+                    if img is not slot:
+                        slot[...] = img
+                decoded.append(request_id)
+            except Exception as e:
+                results.put((request_id, None, ImageDecodeError(f"Error preprocessing image: {e}")))
+
+        if decoded:
+            try:
+                predictions = backend.predict(batch_buffer[:len(decoded)])
+                for request_id, probabilities in zip(decoded, predictions):
+                    results.put((request_id, np.asarray(probabilities, dtype=np.float32), None))
+            except Exception as e:
+                logging.error(f"Error in inference worker: {e}")
+                for request_id in decoded:
+                    results.put((request_id, None, InferenceError(str(e))))
+
+        if stop:
+            return
+
+def _worker_main(requests, results, index, backend_name, model_path, num_threads, max_batch_size, max_wait_ms, settings):
+    from app.utils.inference_backends import create_backend
+    backend = create_backend(backend_name, model_path, num_threads=num_threads)
+    serve_requests(
+        backend, requests, results, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms,
+        preprocessing_backend=settings.get('PREPROCESSING_BACKEND'), worker_index=index
+    )
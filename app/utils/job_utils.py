@@ -0,0 +1,157 @@
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from app import db
+from app.models import PredictionJob
+import datetime
+import logging
+import threading
+
+class PredictionJobQueue:
+    """Runs prediction jobs on a background thread pool.
+
+    Job state lives in the ``PredictionJob`` table, which doubles as the queue:
+    a worker only runs a job after atomically moving it from ``queued`` to
+    ``running``, so several processes can share the same table safely.
+    ``recover`` picks up queued jobs left behind by a restart, and running
+    jobs that have not been updated for ``stale_after`` seconds, which were
+    lost with a crashed process. A worker refreshes its job's ``update_date``
+    every third of that while the handler runs, and records the result only
+    if the job is still the one it claimed, so a job requeued from a worker
+    that was merely slow is not finished twice.
+
+    The handler gets the job and returns a ``Prediction`` it added to the
+    session without committing; it is committed together with the result.
+    """
+
+    def __init__(self, app, handler, workers=2, eager=False, stale_after=600):
+        self.app = app
+        self.handler = handler
+        self.eager = eager
+        self.stale_after = stale_after
+        self._executor = None if eager else ThreadPoolExecutor(max_workers=workers, thread_name_prefix='prediction-job')
+
+    def submit(self, image_record):
+        job = PredictionJob(user_id=image_record.user_id, image_id=image_record.id)
+        db.session.add(job)
+        db.session.commit()
+        self.enqueue(job.id)
+        return job
+
+    def enqueue(self, job_id):
+        if self.eager:
+            self._run(job_id)
+        else:
+            self._executor.submit(self._run, job_id)
+
+    def recover(self):
+        with self.app.app_context():
+            now = datetime.datetime.utcnow()
+            # Requeued in one UPDATE, so only one of several recovering processes gets each job back
+            stale = PredictionJob.query.filter(
+                PredictionJob.status == 'running',
+                PredictionJob.update_date < now - datetime.timedelta(seconds=self.stale_after)
+            ).update({'status': 'queued', 'update_date': now}, synchronize_session=False)
+            db.session.commit()
+            if stale:
+                logging.warning(f"Requeued {stale} prediction job(s) left running by a stopped worker")
+            job_ids = [job.id for job in PredictionJob.query.filter_by(status='queued').all()]
+            db.session.remove()
+        for job_id in job_ids:
+            self.enqueue(job_id)
+        return len(job_ids)
+
+    def _claim(self, job_id):
+        # The claim's update_date, or None when another worker has the job
+        claimed_at = _now()
+        claimed = PredictionJob.query.filter_by(id=job_id, status='queued').update(
+            {'status': 'running', 'update_date': claimed_at},
+            synchronize_session=False
+        )
+        db.session.commit()
+        return claimed_at if claimed == 1 else None
+
+    def _run(self, job_id):
+        with self.app.app_context():
+            try:
+                claimed_at = self._claim(job_id)
+                if claimed_at is None:
+                    return
+                heartbeat = _Heartbeat(self.app, job_id, claimed_at, max(self.stale_after / 3, 1))
+                try:
+                    try:
+                        prediction = self.handler(db.session.get(PredictionJob, job_id))
+                        result = {'status': 'succeeded', 'prediction_id': prediction.id}
+                    except Exception as e:
+                        db.session.rollback()
+                        logging.error(f"Error in prediction job {job_id}: {e}")
+                        result = {'status': 'failed', 'error': str(e)}
+                finally:
+                    claimed_at = heartbeat.stop()
+                finished = PredictionJob.query.filter_by(id=job_id, status='running', update_date=claimed_at).update(
+                    dict(result, update_date=_now()), synchronize_session=False
+                )
+                if finished:
+                    db.session.commit()
+                else:
+                    # Requeued as lost meanwhile; whoever claimed it next records the result
+                    db.session.rollback()
+                    logging.warning(f"Prediction job {job_id} was requeued while running, dropping its result")
+            finally:
+                db.session.remove()
+
+class _Heartbeat:
+    """Refreshes a running job's ``update_date`` every ``interval`` seconds
+    until stopped; ``stop`` returns the value last written."""
+
+    def __init__(self, app, job_id, claimed_at, interval):
+        self.app = app
+        self.job_id = job_id
+        self.claimed_at = claimed_at
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._beat, name=f'prediction-job-heartbeat-{job_id}', daemon=True)
+        self._thread.start()
+
+    def _beat(self):
+        while not self._stopped.wait(self.interval):
+            now = _now()
+            with self.app.app_context():
+                try:
+                    beat = PredictionJob.query.filter_by(id=self.job_id, status='running', update_date=self.claimed_at).update(
+                        {'update_date': now}, synchronize_session=False
+                    )
+                    db.session.commit()
+                except Exception as e:
+                    db.session.rollback()
+                    logging.warning(f"Could not refresh prediction job {self.job_id}: {e}")
+                    continue
+                finally:
+                    db.session.remove()
+            if not beat:
+                return
+            self.claimed_at = now
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        return self.claimed_at
+
+def _now():
+    # Whole seconds, as MySQL DATETIME columns store them, so the claim compares equal when read back
+    return datetime.datetime.utcnow().replace(microsecond=0)
+
+def get_job_queue(handler):
+    # Created on the first job, or at start-up when PREDICTION_JOBS_RECOVER is set; both recover left-over jobs
+    queue = current_app.extensions.get('prediction_jobs')
+    if queue is None:
+        queue = PredictionJobQueue(
+            current_app._get_current_object(),
+            handler,
+            workers=current_app.config.get('PREDICTION_JOB_WORKERS', 2),
+            eager=current_app.config.get('PREDICTION_JOBS_EAGER', False),
+            stale_after=current_app.config.get('PREDICTION_JOB_STALE_AFTER', 600)
+        )
+        if current_app.extensions.setdefault('prediction_jobs', queue) is queue and not queue.eager:
+            queue.recover()
+        queue = current_app.extensions['prediction_jobs']
+    return queue
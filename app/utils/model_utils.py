@@ -1,10 +1,15 @@
 import numpy as np
-import tensorflow as tf
-from tensorflow.keras.models import load_model
+from flask import current_app, has_app_context
+from app.config import Config
+from app.utils.batch_utils import MicroBatcher
+from app.utils.inference_backends import create_backend
+from app.utils.inference_pool import ImageDecodeError, InferenceError, InferencePool
+from app.utils.preprocessing import image_buffer, preprocess_image_pillow, preprocess_image_tf
+from app.utils.storage_utils import get_storage, image_source
+from concurrent.futures import ThreadPoolExecutor
 import logging
-
-# Load the model once at the start
-model = load_model('best_model1_1.keras')
+import os
+import threading
 
 # Define class names
 CLASS_NAMES = [
@@ -20,24 +25,275 @@ CLASS_NAMES = [
     'Unknown___Unexpected_input'
 ]
 
+# Returned for an image that cannot be decoded. Inference failures raise instead,
+# so an outage is never stored as predictions.
+FALLBACK_PREDICTION = ('Unknown___Unexpected_input', 0.0)
+
+class PredictionResult(tuple):
+    """A (predicted_class, confidence_percentage) pair that also carries the
+    full probability vector of the forward pass it came from."""
+
+    def __new__(cls, predicted_class, confidence_percentage, probabilities=None):
+        result = super().__new__(cls, (predicted_class, confidence_percentage))
+        result.probabilities = probabilities
+        return result
+
+    def __getnewargs__(self):
+        return (self[0], self[1], self.probabilities)
+
+IMAGE_SIZE = (256, 256)
+
+# Config key holding the model file for each inference backend
+MODEL_PATH_SETTINGS = {
+    'keras': 'MODEL_PATH',
+    'tflite': 'TFLITE_MODEL_PATH',
+    'onnx': 'ONNX_MODEL_PATH'
+}
+
+# TensorFlow and the model are loaded on first use, so processes that never
+# predict (CLI commands, migrations, most tests) do not pay for them
+_backend = None
+_backend_lock = threading.Lock()
+
+_batcher = None
+_batcher_lock = threading.Lock()
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_setting(name, default=None):
+    # Prefer the running app's config so tests and instances can override it
+    if has_app_context():
+        return current_app.config.get(name, default)
+    return getattr(Config, name, default)
+
+def get_model_path(backend_name):
+    if backend_name not in MODEL_PATH_SETTINGS:
+        raise ValueError(f"Unknown inference backend '{backend_name}'")
+    return get_setting(MODEL_PATH_SETTINGS[backend_name])
+
+def _load_backend():
+    backend_name = get_setting('INFERENCE_BACKEND', 'keras')
+    return create_backend(backend_name, get_model_path(backend_name), num_threads=get_setting('INFERENCE_THREADS'))
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = _load_backend()
+    return _backend
+
+def get_model_version():
+    # Converted models give slightly different outputs, so they are cached separately
+    backend_name = get_setting('INFERENCE_BACKEND', 'keras')
+    model_version = get_setting('MODEL_VERSION')
+    return model_version if backend_name == 'keras' else f"{model_version}+{backend_name}"
+
+def warm_up_model():
+    # A dummy forward pass traces the graph before the first real request
+    logging.info("Warming up model")
+    dummy_image = np.zeros((*IMAGE_SIZE, 3), dtype=np.float32)
+    pool = get_inference_pool()
+    if pool is None:
+        predict_batch([dummy_image])
+        return
+    # Starts the worker processes and waits until they can serve requests
+    timeout = get_setting('INFERENCE_POOL_TIMEOUT', 30)
+    futures = [pool.submit(dummy_image, timeout=timeout) for _ in range(get_setting('INFERENCE_POOL_PROCESSES'))]
+    for future in futures:
+        future.result(timeout=timeout)
+
+def preprocess_image(image, out=None, backend=None):
+    # Accepts a file path or the encoded image bytes (e.g. an upload still in memory).
+    # The result is written into ``out`` when an array is given.
+    preprocessing_backend = backend or get_setting('PREPROCESSING_BACKEND', 'tf')
+    if preprocessing_backend == 'pillow':
+        return preprocess_image_pillow(image, IMAGE_SIZE, out=out)
+    if preprocessing_backend != 'tf':
+        raise ValueError(f"Unknown preprocessing backend '{preprocessing_backend}', expected tf or pillow")
+    img = preprocess_image_tf(image, IMAGE_SIZE)
+    if out is None:
+        return img
+    out[...] = img
+    return out
+
+def summarize_predictions(predictions):
+    # Turns model output rows into (class, confidence) results that keep the full vector
+    results = []
+    for probabilities in predictions:
+        probabilities = np.asarray(probabilities, dtype=np.float32)
+        predicted_class = CLASS_NAMES[int(np.argmax(probabilities))]
+        confidence_percentage = round(100 * float(np.max(probabilities)), 2)
+        results.append(PredictionResult(predicted_class, confidence_percentage, probabilities))
+    return results
+
+def top_k_predictions(probabilities, k):
+    probabilities = np.asarray(probabilities, dtype=np.float32)
+    k = max(1, min(int(k), len(CLASS_NAMES)))
+    return [{
+        'predicted_class': CLASS_NAMES[int(i)],
+        'confidence_percentage': round(100 * float(probabilities[i]), 2)
+    } for i in np.argsort(probabilities)[::-1][:k]]
+
+def pack_probabilities(probabilities):
+    # 10 classes as little-endian float16: 20 bytes per prediction
+    if probabilities is None:
+        return None
+    return np.asarray(probabilities, dtype='<f2').tobytes()
+
+def unpack_probabilities(blob):
+    if blob is None:
+        return None
+    return np.frombuffer(blob, dtype='<f2').astype(np.float32)
+
+def predict_batch(images):
+    # One forward pass for the whole batch; returns (class, confidence) per image
+    return summarize_predictions(get_backend().predict(np.stack(images).astype(np.float32, copy=False)))
+
+def get_batcher():
+    global _batcher
+    if _batcher is None:
+        with _batcher_lock:
+            if _batcher is None:
+                _batcher = MicroBatcher(
+                    predict_batch,
+                    max_batch_size=get_setting('INFERENCE_BATCH_SIZE', 16),
+                    max_wait_ms=get_setting('INFERENCE_BATCH_TIMEOUT_MS', 5)
+                )
+    return _batcher
+
+def get_inference_pool():
+    # None unless INFERENCE_POOL_PROCESSES is set; a forked child starts its own pool
+    global _pool
+    if not get_setting('INFERENCE_POOL_PROCESSES', 0):
+        return None
+    if _pool is None or _pool.pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool.pid != os.getpid():
+                backend_name = get_setting('INFERENCE_BACKEND', 'keras')
+                _pool = InferencePool(
+                    get_setting('INFERENCE_POOL_PROCESSES'),
+                    backend_name,
+                    get_model_path(backend_name),
+                    threads_per_process=get_setting('INFERENCE_POOL_THREADS', 1),
+                    queue_size=get_setting('INFERENCE_POOL_QUEUE_SIZE', 64),
+                    submit_timeout=get_setting('INFERENCE_POOL_SUBMIT_TIMEOUT', 0.5),
+                    max_batch_size=get_setting('INFERENCE_BATCH_SIZE', 16),
+                    max_wait_ms=get_setting('INFERENCE_BATCH_TIMEOUT_MS', 5),
+                    # Workers have no app context, so app-level settings are handed over here
+                    worker_settings={'PREPROCESSING_BACKEND': get_setting('PREPROCESSING_BACKEND', 'tf')}
+                )
+    return _pool
+
+def _image_source(image, storage=None):
+    # Stored images are read through the storage backend whenever the app is available
+    if isinstance(image, bytes) or (storage is None and not has_app_context()):
+        return image
+    return image_source(image, storage)
+
+def _load_image(image_path, storage=None):
+    try:
+        return preprocess_image(_image_source(image_path, storage))
+    except Exception as e:
+        logging.error(f"Error preprocessing image {image_path}: {str(e)}")
+        return None
+
+def predict_images(image_paths):
+    """Classify many images, decoding in parallel and running real batches.
+
+    Decoding of the next batch overlaps with the forward pass of the current
+    one, so at most two batches of decoded images are held in memory.
+    Images that fail to decode get ``FALLBACK_PREDICTION``; a failed forward
+    pass raises ``InferenceError`` for the whole request.
+    """
+    pool = get_inference_pool()
+    if pool is not None:
+        return _predict_images_in_pool(pool, image_paths)
+
+    # Decode threads have no app context, so they are handed the storage backend
+    storage = get_storage() if has_app_context() else None
+    batch_size = get_setting('INFERENCE_BATCH_SIZE', 16)
+    chunks = [list(range(start, min(start + batch_size, len(image_paths))))
+              for start in range(0, len(image_paths), batch_size)]
+    results = [FALLBACK_PREDICTION] * len(image_paths)
+
+    with ThreadPoolExecutor(max_workers=get_setting('INFERENCE_DECODE_WORKERS', 4)) as executor:
+        pending = [executor.submit(_load_image, image_paths[i], storage) for i in chunks[0]] if chunks else []
+        for position, chunk in enumerate(chunks):
+            images = [future.result() for future in pending]
+            if position + 1 < len(chunks):
+                pending = [executor.submit(_load_image, image_paths[i], storage) for i in chunks[position + 1]]
+
+            decoded = [(i, img) for i, img in zip(chunk, images) if img is not None]
+            if not decoded:
+                continue
+            try:
+                logging.info(f"Making batch prediction for {len(decoded)} image(s)")
+                batch_results = predict_batch([img for _, img in decoded])
+            except Exception as e:
+                logging.error(f"Error in batch prediction: {str(e)}")
+                raise InferenceError(str(e)) from e
+            for (i, _), result in zip(decoded, batch_results):
+                results[i] = result
+
+    return results
+
+def _predict_images_in_pool(pool, image_paths):
+    # Workers batch whatever is queued; a bulk request waits for queue room
+    timeout = get_setting('INFERENCE_POOL_TIMEOUT', 30)
+    futures = [pool.submit(_image_source(image_path), timeout=timeout) for image_path in image_paths]
+    results = []
+    for image_path, future in zip(image_paths, futures):
+        try:
+            results.append(summarize_predictions([pool.result(future, timeout=timeout)])[0])
+        except ImageDecodeError as e:
+            logging.error(f"Error predicting image {image_path}: {str(e)}")
+            results.append(FALLBACK_PREDICTION)
+    return results
+
+def _describe(image):
+    return f"<{len(image)} bytes in memory>" if isinstance(image, bytes) else image
+
 def predict_disease(image_path):
+    # image_path is a stored image location (see storage_utils) or the encoded image bytes.
+    # Only an undecodable image gives FALLBACK_PREDICTION; inference failures raise InferenceError,
+    # and a full or timed-out pool InferencePoolBusy, for the route to answer 500 or 503.
+    image = _image_source(image_path)
+
+    # Decoding and inference run in the worker processes when the pool is enabled
+    pool = get_inference_pool()
+    if pool is not None:
+        logging.info(f"Submitting image to inference pool: {_describe(image_path)}")
+        try:
+            probabilities = pool.predict(image, timeout=get_setting('INFERENCE_POOL_TIMEOUT', 30))
+        except ImageDecodeError as e:
+            logging.error(f"Error in prediction: {str(e)}")
+            return FALLBACK_PREDICTION
+        result = summarize_predictions([probabilities])[0]
+        logging.info(f"Prediction: {result[0]} with confidence {result[1]}%")
+        return result
+
+    # Load and preprocess the image into this thread's reused buffer
+    try:
+        logging.info(f"Loading and preprocessing image: {_describe(image_path)}")
+        img = preprocess_image(image, out=image_buffer(IMAGE_SIZE))
+    except Exception as e:
+        logging.error(f"Error preprocessing image: {str(e)}")
+        return FALLBACK_PREDICTION
+
+    # Make prediction, sharing the forward pass with concurrent requests.
+    # The model is loaded here, under the app config, not on the batcher thread.
     try:
-        # Load and preprocess the image
-        logging.info(f"Loading and preprocessing image: {image_path}")
-        img = tf.image.decode_image(tf.io.read_file(image_path), channels=3)
-        img = tf.image.resize(img, [256, 256])
-        img_array = tf.expand_dims(img, 0)  # Add batch dimension
-
-        # Make prediction
-        logging.info(f"Making prediction for image: {image_path}")
-        predictions = model.predict(img_array)
-        
-        predicted_class_idx = np.argmax(predictions[0])
-        predicted_class = CLASS_NAMES[predicted_class_idx]
-        confidence_percentage = round(100 * np.max(predictions[0]), 2)
-        
-        logging.info(f"Prediction: {predicted_class} with confidence {confidence_percentage}%")
-        return predicted_class, confidence_percentage
+        logging.info(f"Making prediction for image: {_describe(image_path)}")
+        get_backend()
+        if get_setting('INFERENCE_BATCHING', True):
+            result = get_batcher().predict(img)
+        else:
+            result = predict_batch([img])[0]
     except Exception as e:
         logging.error(f"Error in prediction: {str(e)}")
-        return "Unknown___Unexpected_input", 0.0
+        raise InferenceError(str(e)) from e
+    
+    logging.info(f"Prediction: {result[0]} with confidence {result[1]}%")
+    return result
@@ -0,0 +1,55 @@
+from sqlalchemy import and_, or_
+import base64
+import datetime
+import json
+
+
+def encode_cursor(date, row_id):
+    # Opaque to clients: the sort key of the last row they were sent; rows without a date have null
+    payload = json.dumps([date.isoformat() if date is not None else None, row_id], separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(payload).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """The ``(date, id)`` in a cursor from ``encode_cursor``; raises ``ValueError``."""
+    try:
+        payload = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        date, row_id = json.loads(payload)
+        date = datetime.datetime.fromisoformat(date) if date is not None else None
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Invalid cursor: {e}")
+    if not isinstance(row_id, int) or isinstance(row_id, bool):
+        raise ValueError('Invalid cursor')
+    return date, row_id
+
+
+def keyset_page(query, date_column, id_column, cursor=None, limit=50, undated=True):
+    """One page of ``query``, newest first, and the cursor of the next page or None.
+
+    Rows come after the cursor by ``(date, id)``, so a page is an index range
+    read however deep into the results it is, unlike OFFSET, which reads and
+    throws away every row before the page. The id breaks ties between rows
+    with the same date, so none is skipped or repeated across pages. Rows
+    without a date come after all dated ones, newest id first; they are read
+    separately, as databases disagree on where NULLs sort. Pass
+    ``undated=False`` when the query already filters on the date.
+    """
+    date, row_id = decode_cursor(cursor) if cursor else (None, None)
+    rows = []
+    if not cursor or date is not None:
+        dated = query.filter(date_column.isnot(None))
+        if cursor:
+            # Spelled out rather than a row-value comparison, which MySQL does not turn into a range
+            dated = dated.filter(or_(date_column < date, and_(date_column == date, id_column < row_id)))
+        rows = dated.order_by(date_column.desc(), id_column.desc()).limit(limit + 1).all()
+        row_id = None
+    if undated and len(rows) <= limit:
+        query = query.filter(date_column.is_(None))
+        if row_id is not None:
+            query = query.filter(id_column < row_id)
+        rows += query.order_by(id_column.desc()).limit(limit + 1 - len(rows)).all()
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    last = rows[-1]
+    return rows, encode_cursor(getattr(last, date_column.key), getattr(last, id_column.key))
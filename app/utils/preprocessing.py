@@ -0,0 +1,70 @@
+from functools import lru_cache
+from PIL import Image
+import io
+import numpy as np
+import threading
+
+# The Pillow pipeline matches the TensorFlow one (decode_image + bilinear
+# resize) to within these mean absolute differences, in pixel values on the
+# [0, 255] scale. Images decoded at full size only differ by JPEG decoder
+# rounding; large JPEGs are downscaled by the decoder (draft mode), which
+# averages pixel blocks where TensorFlow samples single pixels.
+PILLOW_TOLERANCE_FULL_DECODE = 1.5
+PILLOW_TOLERANCE_DRAFT_DECODE = 4.0
+
+_buffers = threading.local()
+
+def image_buffer(size):
+    """A float32 (height, width, 3) array reused by every call on this thread."""
+    buffer = getattr(_buffers, 'image', None)
+    if buffer is None or buffer.shape[:2] != tuple(size):
+        buffer = _buffers.image = np.empty((*size, 3), dtype=np.float32)
+    return buffer
+
+def preprocess_image_tf(image, size):
+    import tensorflow as tf
+    contents = image if isinstance(image, bytes) else tf.io.read_file(image)
+    img = tf.image.decode_image(contents, channels=3)
+    img = tf.image.resize(img, size)
+    return img.numpy()
+
+def preprocess_image_pillow(image, size, out=None, draft=True):
+    """Decode ``image`` (a path or encoded bytes) and resize it to ``size``.
+
+    JPEGs are decoded straight at the smallest DCT scale (1/2, 1/4 or 1/8)
+    that is still at least ``size``, so a phone photo never exists as a full
+    resolution bitmap. The resize reproduces ``tf.image.resize`` (bilinear,
+    half-pixel centres, no antialiasing) and writes into ``out`` when given.
+    """
+    with Image.open(io.BytesIO(image) if isinstance(image, bytes) else image) as img:
+        if draft:
+            img.draft('RGB', (size[1], size[0]))
+        pixels = np.asarray(img.convert('RGB'))
+    if out is None:
+        out = np.empty((*size, 3), dtype=np.float32)
+    return resize_bilinear(pixels, size, out)
+
+@lru_cache(maxsize=64)
+def _sample_points(in_size, out_size):
+    # Same source coordinates as TensorFlow's half_pixel_centers bilinear kernel
+    coords = (np.arange(out_size, dtype=np.float32) + 0.5) * np.float32(in_size / out_size) - 0.5
+    lower = np.floor(coords)
+    lerp = (coords - lower).astype(np.float32)
+    return (np.clip(lower, 0, in_size - 1).astype(np.intp),
+            np.clip(lower + 1, 0, in_size - 1).astype(np.intp),
+            lerp)
+
+def resize_bilinear(pixels, size, out):
+    y0, y1, y_lerp = _sample_points(pixels.shape[0], size[0])
+    x0, x1, x_lerp = _sample_points(pixels.shape[1], size[1])
+    x_lerp = x_lerp[np.newaxis, :, np.newaxis]
+
+    top_rows, bottom_rows = pixels[y0], pixels[y1]
+    top_left = top_rows[:, x0].astype(np.float32)
+    top = top_left + (top_rows[:, x1] - top_left) * x_lerp
+    bottom_left = bottom_rows[:, x0].astype(np.float32)
+    bottom = bottom_left + (bottom_rows[:, x1] - bottom_left) * x_lerp
+
+    np.multiply(bottom - top, y_lerp[:, np.newaxis, np.newaxis], out=out)
+    out += top
+    return out
@@ -0,0 +1,102 @@
+from flask import abort, current_app, redirect, request
+from functools import lru_cache
+from urllib.parse import quote
+from werkzeug.utils import send_file
+from app.utils.image_utils import variant_filename
+from app.utils.storage_utils import BLOB_KEY, CHUNK_SIZE, get_storage
+import hashlib
+import mimetypes
+import os
+
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+def name_etag(key):
+    # Strong ETag read off a content-addressed name without touching the file, or None.
+    # The name changes whenever the content does.
+    match = BLOB_KEY.match(key)
+    if not match:
+        return None
+    return f"{match['hash']}-{match['variant']}" if match['variant'] else match['hash']
+
+@lru_cache(maxsize=4096)
+def _file_digest(path, size, mtime_ns):
+    # Keyed on size and mtime, so a replaced file is hashed again
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def file_etag(path):
+    stat = os.stat(path)
+    return _file_digest(path, stat.st_size, stat.st_mtime_ns)
+
+def _cache_headers(response, etag, immutable):
+    response.set_etag(etag)
+    if immutable:
+        response.cache_control.public = True
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        # Legacy names and not-yet-created variants may change: cache, but revalidate
+        response.cache_control.public = True
+        response.cache_control.no_cache = True
+    return response
+
+def serve_upload(filename, variant=None):
+    """Response for GET /static/uploads/<filename>, optionally of an image variant.
+
+    Content-addressed names get a strong ETag from the hash in the name and
+    are cached as immutable, and a matching If-None-Match is answered 304
+    without any file access. The bytes themselves are sent by whatever is
+    cheapest: the front web server (UPLOAD_SENDFILE), a redirect to the
+    object store, or Werkzeug with Range support as the fallback.
+    """
+    storage = get_storage()
+    key = filename
+    if variant:
+        derivative = variant_filename(filename, variant)
+        # Until the variant exists the original is served under its URL, so it must not be cached for good
+        if storage.exists(derivative):
+            key = derivative
+    etag = name_etag(key)
+    immutable = etag is not None and not (variant and key == filename)
+
+    if etag and request.if_none_match.contains(etag):
+        return _cache_headers(current_app.response_class(status=304), etag, immutable)
+
+    mimetype = mimetypes.guess_type(key)[0] or 'application/octet-stream'
+    path = storage.local_path(key)
+    if path is None:
+        return _redirect_to_object(storage, key, etag, immutable)
+    if not os.path.isfile(path):
+        abort(404)
+    etag = etag or file_etag(path)
+
+    mode = current_app.config.get('UPLOAD_SENDFILE')
+    if mode == 'x-accel-redirect':
+        # nginx serves the file from an internal location mapped onto UPLOAD_FOLDER, Range included
+        response = current_app.response_class(mimetype=mimetype)
+        response.headers['X-Accel-Redirect'] = current_app.config['UPLOAD_ACCEL_PREFIX'].rstrip('/') + '/' + quote(key)
+        if request.if_none_match.contains(etag):
+            response.status_code = 304
+        return _cache_headers(response, etag, immutable)
+
+    response = send_file(
+        path, request.environ, mimetype=mimetype, etag=etag, conditional=True,
+        use_x_sendfile=mode == 'x-sendfile', response_class=current_app.response_class
+    )
+    return _cache_headers(response, etag, immutable)
+
+def _redirect_to_object(storage, key, etag, immutable):
+    if not storage.exists(key):
+        abort(404)
+    expires_in = current_app.config.get('S3_PRESIGN_EXPIRES', 3600)
+    cache_control = f'public, max-age={IMMUTABLE_MAX_AGE}, immutable' if immutable else 'public, no-cache'
+    response = redirect(storage.url(key, expires_in, cache_control=cache_control), 302)
+    if etag:
+        response.set_etag(etag)
+    # The redirect can be reused for part of the signature's lifetime
+    response.cache_control.private = True
+    response.cache_control.max_age = expires_in // 2
+    return response
@@ -0,0 +1,314 @@
+from sqlalchemy import Date, Integer, case, cast, func
+from app import db
+from app.models import (
+    DISEASED, HEALTHY, SINGLE_CHOICE_QUESTIONS, ConfidenceCount, DailyPredictionCount, Prediction, PredictionCount,
+    SurveyAnswer, SurveyOptionCount, UserSatisfactionSurvey,
+    count_prediction, count_prediction_confidence, count_prediction_day, health_status_for, plant_name_for
+)
+import datetime
+
+GRANULARITIES = ('day', 'week', 'month')
+
+
+def health_counts(user_id=None):
+    """Predictions made, healthy and diseased, for one user or everyone.
+
+    Summed from the per-class counters: a handful of rows per user, however
+    many predictions they have made.
+    """
+    query = db.session.query(PredictionCount.health_status, func.sum(PredictionCount.count))
+    if user_id is not None:
+        query = query.filter(PredictionCount.user_id == user_id)
+    counts = {status: int(total or 0) for status, total in query.group_by(PredictionCount.health_status)}
+    return {
+        'predictions_made': sum(counts.values()),
+        'healthy_plants': counts.get(HEALTHY, 0),
+        'diseased_plants': counts.get(DISEASED, 0)
+    }
+
+def class_counts(user_id):
+    # (predicted_class, count) of the classes a user has predictions for
+    return db.session.query(PredictionCount.predicted_class, PredictionCount.count).filter(
+        PredictionCount.user_id == user_id, PredictionCount.count > 0
+    ).order_by(PredictionCount.predicted_class).all()
+
+def plant_counts(user_id):
+    query = db.session.query(PredictionCount.plant_name, func.sum(PredictionCount.count)).filter(
+        PredictionCount.user_id == user_id
+    ).group_by(PredictionCount.plant_name)
+    return {plant_name: int(total or 0) for plant_name, total in query}
+
+def date_bucket(expression, granularity='day', dialect=None):
+    """SQL for the first day of the day, ISO week (from Monday) or month of
+    a date or datetime expression, on SQLite, MySQL or PostgreSQL. The
+    database returns a date, or a YYYY-MM-DD string on SQLite; see ``as_date``."""
+    if granularity not in GRANULARITIES:
+        raise ValueError(f"granularity must be one of {', '.join(GRANULARITIES)}")
+    dialect = dialect or db.session.get_bind().dialect.name
+    if dialect == 'sqlite':
+        return {
+            'day': func.date(expression),
+            'week': func.date(expression, 'weekday 0', '-6 days'),
+            'month': func.date(expression, 'start of month')
+        }[granularity]
+    if dialect == 'mysql':
+        day = func.date(expression)
+        return {
+            'day': day,
+            'week': func.subdate(day, func.weekday(day)),  # WEEKDAY() is 0 on Monday
+            'month': func.subdate(day, func.dayofmonth(day) - 1)
+        }[granularity]
+    # PostgreSQL, and anything else with the standard date_trunc
+    return cast(func.date_trunc(granularity, expression), Date)
+
+def as_date(value):
+    # Bucket values come back as dates, or as strings from SQLite
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    if isinstance(value, str):
+        return datetime.date.fromisoformat(value[:10])
+    return value
+
+def prediction_time_series(user_id, granularity='day', start_date=None, end_date=None):
+    """(first day of bucket, count) pairs in date order, for buckets with predictions.
+
+    Summed from the daily counters, so a month costs at most 31 index rows
+    however many predictions were made in it. Dates are whole UTC days,
+    both ends included.
+    """
+    bucket = date_bucket(DailyPredictionCount.day, granularity).label('bucket')
+    query = db.session.query(bucket, func.sum(DailyPredictionCount.count)).filter(
+        DailyPredictionCount.user_id == user_id, DailyPredictionCount.count > 0
+    )
+    if start_date:
+        query = query.filter(DailyPredictionCount.day >= start_date)
+    if end_date:
+        query = query.filter(DailyPredictionCount.day <= end_date)
+    return [(as_date(day), int(count)) for day, count in query.group_by(bucket).order_by(bucket)]
+
+def percent_bucket(expression, dialect=None):
+    # SQL for models.confidence_percent: the whole percent, 0 to 99
+    dialect = dialect or db.session.get_bind().dialect.name
+    # SQLite may be built without FLOOR; its CAST truncates, which is the same for percentages
+    whole = cast(expression, Integer) if dialect == 'sqlite' else cast(func.floor(expression), Integer)
+    return case((expression >= 100, 99), (expression < 0, 0), else_=whole)
+
+def confidence_histogram(user_id, bin_width=10, by_class=False):
+    """Prediction counts per confidence bin of ``bin_width`` percent, and per class if asked.
+
+    Bins start at 0, bin_width, ... below 100; 100% falls in the last one.
+    Summed from the per-percent counters in SQL, so at most 100 rows per
+    class are read however many predictions the user has made.
+    Returns ``(bins, frequency, frequency_by_class or None)``.
+    """
+    bins = list(range(0, 100, bin_width))
+    start = (ConfidenceCount.percent - ConfidenceCount.percent % bin_width).label('bin')
+    columns = [start, func.sum(ConfidenceCount.count)]
+    if by_class:
+        columns.insert(0, ConfidenceCount.predicted_class)
+    query = db.session.query(*columns).filter(ConfidenceCount.user_id == user_id, ConfidenceCount.count > 0)
+    group = [ConfidenceCount.predicted_class, start] if by_class else [start]
+
+    frequency = [0] * len(bins)
+    by_class_frequency = {} if by_class else None
+    for row in query.group_by(*group):
+        index = int(row[-2]) // bin_width
+        frequency[index] += int(row[-1])
+        if by_class:
+            by_class_frequency.setdefault(row[0], [0] * len(bins))[index] += int(row[-1])
+    return bins, frequency, by_class_frequency
+
+def survey_option_counts():
+    # {question: {option: surveys giving it}}, from the option counters: one row per option, however many surveys
+    counts = {}
+    query = db.session.query(SurveyOptionCount.question, SurveyOptionCount.option, SurveyOptionCount.count).filter(
+        SurveyOptionCount.count > 0
+    ).order_by(SurveyOptionCount.question, SurveyOptionCount.option)
+    for question, option, count in query:
+        counts.setdefault(question, {})[option] = count
+    return counts
+
+def uncount_predictions(criteria):
+    """Take the predictions matching ``criteria`` off the counters. For bulk
+    deletes, which bypass the mapper events; call it in the same transaction,
+    just before the delete."""
+    connection = db.session.connection()
+    rows = db.session.query(Prediction.user_id, Prediction.predicted_class, func.count(Prediction.id)).filter(
+        criteria
+    ).group_by(Prediction.user_id, Prediction.predicted_class).all()
+    for user_id, predicted_class, count in rows:
+        count_prediction(connection, user_id, predicted_class, -count)
+
+    day = date_bucket(Prediction.prediction_date)
+    rows = db.session.query(Prediction.user_id, day, func.count(Prediction.id)).filter(criteria).group_by(Prediction.user_id, day).all()
+    for user_id, prediction_day, count in rows:
+        count_prediction_day(connection, user_id, as_date(prediction_day), -count)
+
+    percent = percent_bucket(Prediction.confidence_percentage)
+    rows = db.session.query(Prediction.user_id, Prediction.predicted_class, percent, func.count(Prediction.id)).filter(
+        criteria
+    ).group_by(Prediction.user_id, Prediction.predicted_class, percent).all()
+    for user_id, predicted_class, confidence, count in rows:
+        count_prediction_confidence(connection, user_id, predicted_class, confidence, -count)
+
+def reconcile_prediction_counts(dry_run=False):
+    """Make the counters match the predictions; returns how many counter rows were wrong.
+
+    One grouped pass over the predictions, compared with the counters in a
+    single transaction. The counters are locked first (FOR UPDATE), so on
+    databases with row locks a prediction made meanwhile waits and is counted
+    on top of the corrected value.
+    """
+    counters = PredictionCount.query.with_for_update().all()
+    actual = {
+        (user_id, predicted_class): count
+        for user_id, predicted_class, count in db.session.query(
+            Prediction.user_id, Prediction.predicted_class, func.count(Prediction.id)
+        ).filter(
+            Prediction.user_id.isnot(None), Prediction.predicted_class.isnot(None)
+        ).group_by(Prediction.user_id, Prediction.predicted_class)
+    }
+    fixed = 0
+    for counter in counters:
+        count = actual.pop((counter.user_id, counter.predicted_class), 0)
+        expected = (count, plant_name_for(counter.predicted_class), health_status_for(counter.predicted_class))
+        if (counter.count, counter.plant_name, counter.health_status) == expected:
+            continue
+        fixed += 1
+        if not dry_run:
+            counter.count, counter.plant_name, counter.health_status = expected
+    for (user_id, predicted_class), count in actual.items():
+        fixed += 1
+        if not dry_run:
+            db.session.add(PredictionCount(
+                user_id=user_id, predicted_class=predicted_class, count=count,
+                plant_name=plant_name_for(predicted_class), health_status=health_status_for(predicted_class)
+            ))
+    if dry_run:
+        db.session.rollback()
+    else:
+        db.session.commit()
+    return fixed
+
+def reconcile_daily_counts(since=None, dry_run=False, window_days=31):
+    """Make the daily counters match the predictions, from ``since`` (a date)
+    or the first prediction; returns how many counter rows were wrong.
+
+    Also the backfill: on an empty table it creates every row. Works through
+    the history a window of days at a time, each in its own transaction, so
+    only one window's counters are held in memory or locked at once.
+    """
+    bounds = [
+        *db.session.query(func.min(Prediction.prediction_date), func.max(Prediction.prediction_date)).one(),
+        *db.session.query(func.min(DailyPredictionCount.day), func.max(DailyPredictionCount.day)).one()
+    ]
+    db.session.rollback()
+    days = [as_date(value) for value in bounds if value is not None]
+    if not days:
+        return 0
+    first, last = since or min(days), max(days)
+    day = date_bucket(Prediction.prediction_date)
+    fixed = 0
+
+    while first <= last:
+        end = first + datetime.timedelta(days=window_days)
+        counters = DailyPredictionCount.query.filter(
+            DailyPredictionCount.day >= first, DailyPredictionCount.day < end
+        ).with_for_update().all()
+        actual = {
+            (user_id, as_date(prediction_day)): count
+            for user_id, prediction_day, count in db.session.query(Prediction.user_id, day, func.count(Prediction.id)).filter(
+                Prediction.user_id.isnot(None),
+                Prediction.prediction_date >= datetime.datetime.combine(first, datetime.time()),
+                Prediction.prediction_date < datetime.datetime.combine(end, datetime.time())
+            ).group_by(Prediction.user_id, day)
+        }
+        for counter in counters:
+            count = actual.pop((counter.user_id, counter.day), 0)
+            if counter.count != count:
+                fixed += 1
+                if not dry_run:
+                    counter.count = count
+        fixed += len(actual)
+        if not dry_run:
+            db.session.add_all(DailyPredictionCount(user_id=user_id, day=prediction_day, count=count)
+                               for (user_id, prediction_day), count in actual.items())
+            db.session.commit()
+        else:
+            db.session.rollback()
+        first = end
+    return fixed
+
+def reconcile_confidence_counts(dry_run=False, users_per_batch=100):
+    """Make the confidence counters match the predictions; returns how many counter rows were wrong.
+
+    Up to 100 rows per user and class, so users are taken a range of ids at
+    a time, each range in its own transaction.
+    """
+    bounds = [
+        *db.session.query(func.min(Prediction.user_id), func.max(Prediction.user_id)).one(),
+        *db.session.query(func.min(ConfidenceCount.user_id), func.max(ConfidenceCount.user_id)).one()
+    ]
+    db.session.rollback()
+    user_ids = [value for value in bounds if value is not None]
+    if not user_ids:
+        return 0
+    percent = percent_bucket(Prediction.confidence_percentage)
+    fixed = 0
+
+    for first in range(min(user_ids), max(user_ids) + 1, users_per_batch):
+        last = first + users_per_batch
+        counters = ConfidenceCount.query.filter(ConfidenceCount.user_id >= first, ConfidenceCount.user_id < last).with_for_update().all()
+        actual = {
+            (user_id, predicted_class, int(confidence)): count
+            for user_id, predicted_class, confidence, count in db.session.query(
+                Prediction.user_id, Prediction.predicted_class, percent, func.count(Prediction.id)
+            ).filter(
+                Prediction.user_id >= first, Prediction.user_id < last,
+                Prediction.predicted_class.isnot(None), Prediction.confidence_percentage.isnot(None)
+            ).group_by(Prediction.user_id, Prediction.predicted_class, percent)
+        }
+        for counter in counters:
+            count = actual.pop((counter.user_id, counter.predicted_class, counter.percent), 0)
+            if counter.count != count:
+                fixed += 1
+                if not dry_run:
+                    counter.count = count
+        fixed += len(actual)
+        if not dry_run:
+            db.session.add_all(ConfidenceCount(user_id=user_id, predicted_class=predicted_class, percent=confidence, count=count)
+                               for (user_id, predicted_class, confidence), count in actual.items())
+            db.session.commit()
+        else:
+            db.session.rollback()
+    return fixed
+
+def reconcile_survey_counts(dry_run=False):
+    """Make the survey option counters match the surveys; returns how many counter rows were wrong."""
+    counters = SurveyOptionCount.query.with_for_update().all()
+    actual = {
+        (question, option): count
+        for question, option, count in db.session.query(
+            SurveyAnswer.question, SurveyAnswer.option, func.count(SurveyAnswer.id)
+        ).group_by(SurveyAnswer.question, SurveyAnswer.option)
+    }
+    for question in SINGLE_CHOICE_QUESTIONS:
+        column = getattr(UserSatisfactionSurvey, question)
+        actual.update(
+            ((question, option), count)
+            for option, count in db.session.query(column, func.count(UserSatisfactionSurvey.id)).filter(column.isnot(None)).group_by(column)
+        )
+    fixed = 0
+    for counter in counters:
+        count = actual.pop((counter.question, counter.option), 0)
+        if counter.count != count:
+            fixed += 1
+            if not dry_run:
+                counter.count = count
+    fixed += len(actual)
+    if dry_run:
+        db.session.rollback()
+    else:
+        db.session.add_all(SurveyOptionCount(question=question, option=option, count=count) for (question, option), count in actual.items())
+        db.session.commit()
+    return fixed
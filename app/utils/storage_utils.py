@@ -0,0 +1,357 @@
+from flask import current_app
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
+from werkzeug.utils import secure_filename
+from app import db
+from app.models import Blob
+import datetime
+import hashlib
+import logging
+import mimetypes
+import os
+import re
+import tempfile
+import uuid
+from urllib.parse import quote
+
+# Blobs live under <2 hex>/<2 hex>/<sha256><ext>, so no directory holds more
+# than 256 entries until there are millions of files
+SHARD_DEPTH = 2
+SHARD_WIDTH = 2
+CHUNK_SIZE = 1024 * 1024
+
+# ab/cd/<sha256>.jpg, and its variants ab/cd/<sha256>_thumbnail.jpg...
+BLOB_KEY = re.compile(r'^[0-9a-f]{2}/[0-9a-f]{2}/(?P<hash>[0-9a-f]{64})(?:_(?P<variant>[a-z]+))?\.\w+$')
+INCOMING_FOLDER = '.incoming'
+
+# Storage keys are relative, '/'-separated paths such as ab/cd/abcd...jpg.
+# Image rows record a backend's location for a key: the absolute file path on
+# local disk (as before there were backends) and the key itself on S3.
+
+class LocalStorage:
+    name = 'local'
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+
+    def local_path(self, key):
+        # os.path.join keeps legacy absolute paths outside the root as they are
+        return os.path.join(self.root, *key.split('/'))
+
+    def location(self, key):
+        return self.local_path(key)
+
+    def key_for(self, location):
+        location = os.path.abspath(location)
+        if os.path.commonpath([self.root, location]) == self.root:
+            return os.path.relpath(location, self.root).replace(os.sep, '/')
+        return location
+
+    def incoming_dir(self):
+        # Same file system as the blobs, so moving a finished upload into place is atomic
+        return os.path.join(self.root, INCOMING_FOLDER)
+
+    def exists(self, key):
+        return os.path.exists(self.local_path(key))
+
+    def size(self, key):
+        return os.path.getsize(self.local_path(key))
+
+    def open(self, key):
+        return open(self.local_path(key), 'rb')
+
+    def read(self, key):
+        with self.open(key) as f:
+            return f.read()
+
+    def put_file(self, path, key):
+        # Moves the file into place; the source is gone afterwards
+        target = self.local_path(key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(path, target)
+
+    def put_bytes(self, data, key):
+        target = self.local_path(key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        temporary_path = f"{target}.tmp"
+        with open(temporary_path, 'wb') as f:
+            f.write(data)
+        os.replace(temporary_path, target)
+
+    def delete(self, key):
+        if self.exists(key):
+            os.remove(self.local_path(key))
+
+    def url(self, key, expires_in=3600, cache_control=None):
+        # Local files are sent by the app or the front web server, not fetched from elsewhere
+        return None
+
+    def iter_files(self):
+        """Yield ``(key, size, mtime)`` for every stored file, one directory at a time.
+
+        Shard directories are walked in sorted order and sorted within, so
+        blob files come out by ascending hash with a blob's variants next to
+        it. Other files are yielded in directory order. The incoming area is
+        skipped.
+        """
+        yield from self._walk(self.root, '')
+
+    def _walk(self, directory, prefix):
+        subdirectories = []
+        files = []
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if prefix or entry.name != INCOMING_FOLDER:
+                        subdirectories.append(entry.name)
+                elif entry.is_file(follow_symlinks=False):
+                    stat = entry.stat(follow_symlinks=False)
+                    if prefix.count('/') < SHARD_DEPTH:
+                        # Flat legacy folders can be huge: stream them unsorted
+                        yield prefix + entry.name, stat.st_size, stat.st_mtime
+                    else:
+                        files.append((prefix + entry.name, stat.st_size, stat.st_mtime))
+        yield from sorted(files)
+        for name in sorted(subdirectories):
+            yield from self._walk(os.path.join(directory, name), prefix + name + '/')
+
+class S3Storage:
+    """Objects in an S3 bucket, or any S3-compatible store through ``endpoint_url``
+    (MinIO, Ceph, LocalStack...). Reads and writes stream in chunks; large
+    files are uploaded in parts by boto3's transfer manager."""
+
+    name = 's3'
+
+    def __init__(self, bucket, prefix='', endpoint_url=None, region_name=None, spool_folder=None, public_url=None, client=None):
+        if client is None:
+            import boto3
+            client = boto3.client('s3', endpoint_url=endpoint_url, region_name=region_name)
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix.strip('/') + '/' if prefix.strip('/') else ''
+        self.spool_folder = spool_folder or tempfile.gettempdir()
+        self.public_url = public_url.rstrip('/') if public_url else None
+
+    def _object_key(self, key):
+        return self.prefix + key
+
+    def local_path(self, key):
+        return None
+
+    def location(self, key):
+        return key
+
+    def key_for(self, location):
+        return location
+
+    def incoming_dir(self):
+        return self.spool_folder
+
+    def exists(self, key):
+        from botocore.exceptions import ClientError
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._object_key(key))
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+
+    def size(self, key):
+        return self.client.head_object(Bucket=self.bucket, Key=self._object_key(key))['ContentLength']
+
+    def open(self, key):
+        # A streaming body: read(n) pulls the object from the network chunk by chunk
+        return self.client.get_object(Bucket=self.bucket, Key=self._object_key(key))['Body']
+
+    def read(self, key):
+        return self.open(key).read()
+
+    def put_file(self, path, key):
+        self.client.upload_file(path, self.bucket, self._object_key(key), ExtraArgs=_object_args(key))
+        os.remove(path)
+
+    def put_bytes(self, data, key):
+        self.client.put_object(Bucket=self.bucket, Key=self._object_key(key), Body=data, **_object_args(key))
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self._object_key(key))
+
+    def url(self, key, expires_in=3600, cache_control=None):
+        """Where a browser can fetch the object itself: under ``public_url`` (a CDN
+        or public bucket) when set, otherwise a presigned URL valid for
+        ``expires_in`` seconds whose response carries ``cache_control``."""
+        if self.public_url:
+            return f"{self.public_url}/{quote(self._object_key(key))}"
+        params = {'Bucket': self.bucket, 'Key': self._object_key(key)}
+        if cache_control:
+            params['ResponseCacheControl'] = cache_control
+        return self.client.generate_presigned_url('get_object', Params=params, ExpiresIn=expires_in)
+
+    def iter_files(self):
+        # S3 lists keys in ascending order, a page of 1000 at a time
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+            for item in page.get('Contents', []):
+                yield item['Key'][len(self.prefix):], item['Size'], item['LastModified'].timestamp()
+
+def _object_args(key):
+    content_type = mimetypes.guess_type(key)[0]
+    return {'ContentType': content_type} if content_type else {}
+
+def create_storage(config):
+    backend = config.get('STORAGE_BACKEND', 'local')
+    if backend == 'local':
+        return LocalStorage(config['UPLOAD_FOLDER'])
+    if backend == 's3':
+        return S3Storage(
+            config['S3_BUCKET'],
+            prefix=config.get('S3_PREFIX') or '',
+            endpoint_url=config.get('S3_ENDPOINT_URL'),
+            region_name=config.get('S3_REGION'),
+            spool_folder=config.get('UPLOAD_SPOOL_FOLDER'),
+            public_url=config.get('S3_PUBLIC_URL')
+        )
+    raise ValueError(f"Unknown storage backend '{backend}', expected local or s3")
+
+def get_storage():
+    storage = current_app.extensions.get('storage')
+    if storage is None:
+        storage = current_app.extensions.setdefault('storage', create_storage(current_app.config))
+    return storage
+
+def file_extension(filename):
+    extension = os.path.splitext(secure_filename(filename or ''))[1].lower()
+    return '.jpg' if extension == '.jpeg' else extension
+
+def storage_key_for(content_hash, extension=''):
+    shards = [content_hash[i * SHARD_WIDTH:(i + 1) * SHARD_WIDTH] for i in range(SHARD_DEPTH)]
+    return '/'.join(shards + [content_hash + extension])
+
+def upload_url_path(image_path):
+    # Path of an upload below /static/uploads/; legacy files outside the folder keep their file name
+    key = get_storage().key_for(image_path)
+    return os.path.basename(key) if os.path.isabs(key) else key
+
+def image_source(image_path, storage=None):
+    """What the image decoders read for a stored image: a local file path, or
+    the object's bytes when it lives in a remote store. Pass ``storage`` when
+    calling from a thread without an app context."""
+    storage = storage or get_storage()
+    key = storage.key_for(image_path)
+    return storage.local_path(key) or storage.read(key)
+
+def incoming_path():
+    incoming = get_storage().incoming_dir()
+    os.makedirs(incoming, exist_ok=True)
+    return os.path.join(incoming, uuid.uuid4().hex)
+
+def store_stream(stream, filename):
+    """Hash and write an upload in one pass and file it under its content hash.
+
+    Returns ``(image_path, content_hash)``. Content that is already stored is
+    not written twice: the new copy is dropped and the existing blob reused.
+    The ``Blob`` row is added to the session; its reference count goes up
+    when an ``Image`` row with the same ``content_hash`` is inserted.
+    """
+    incoming = incoming_path()
+    sha256 = hashlib.sha256()
+    size = 0
+    try:
+        with open(incoming, 'wb') as f:
+            for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+                sha256.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+    except Exception:
+        os.remove(incoming)
+        raise
+    return file_incoming(incoming, sha256.hexdigest(), size, filename)
+
+def store_bytes(data, filename):
+    return file_incoming(write_incoming(data, incoming_path()), hashlib.sha256(data).hexdigest(), len(data), filename)
+
+def write_incoming(data, incoming):
+    # Plain file I/O with no app or database access, so it can run on another thread
+    with open(incoming, 'wb') as f:
+        f.write(data)
+    return incoming
+
+def file_incoming(incoming, content_hash, size, filename):
+    return file_incoming_async(incoming, content_hash, size, filename)()
+
+def file_incoming_async(incoming, content_hash, size, filename, executor=None):
+    """Start filing an incoming file under its content hash.
+
+    The bytes are written to storage on ``executor`` (inline without one),
+    so the caller can carry on meanwhile. Returns a function to call from
+    the request's thread: it waits for the write, adds the ``Blob`` row to
+    the session and returns ``(image_path, content_hash)``.
+    """
+    storage = get_storage()
+    blob = claim_blob(content_hash)
+    storage_key = blob.storage_key if blob else storage_key_for(content_hash, file_extension(filename))
+    if executor is None:
+        _put_incoming(storage, incoming, storage_key)
+        write = None
+    else:
+        write = executor.submit(_put_incoming, storage, incoming, storage_key)
+
+    def finish():
+        if write is not None:
+            write.result()
+        key = storage_key if blob is not None else ensure_blob(content_hash, storage_key, size)
+        return storage.location(key), content_hash
+    return finish
+
+def claim_blob(content_hash):
+    """The blob with this content, held for an upload about to reuse it, or None.
+
+    A blob nothing refers to is claimed before its file is looked at: its
+    unreferenced clock restarts, so the garbage collector leaves it (and its
+    file) alone until the new Image row has committed or the grace period
+    has passed. The claim is committed on a connection of its own, so no
+    lock is held while the upload is predicted. A blob the collector deleted
+    first is reported as None, and the upload writes a new one.
+    """
+    blob = db.session.get(Blob, content_hash)
+    if blob is None or blob.ref_count > 0:
+        # Referenced blobs that lose their last image meanwhile start a fresh clock too
+        return blob
+    with db.engine.begin() as connection:
+        connection.execute(
+            update(Blob).where(Blob.content_hash == content_hash, Blob.ref_count <= 0)
+            .values(unreferenced_since=datetime.datetime.utcnow())
+        )
+    return db.session.get(Blob, content_hash, populate_existing=True)
+
+def _put_incoming(storage, incoming, storage_key):
+    # Storage I/O only, no app or database access, so it can run on another thread
+    try:
+        if storage.exists(storage_key):
+            logging.info(f"Upload already stored as {storage_key}")
+        else:
+            storage.put_file(incoming, storage_key)
+            logging.info(f"File saved successfully: {storage_key}")
+    finally:
+        if os.path.exists(incoming):
+            os.remove(incoming)
+
+def ensure_blob(content_hash, storage_key, size):
+    # Returns the storage key of the blob, which may have been created concurrently
+    try:
+        with db.session.begin_nested():
+            db.session.add(Blob(content_hash=content_hash, storage_key=storage_key, size=size, ref_count=0))
+        return storage_key
+    except IntegrityError:
+        logging.info(f"Blob {content_hash} created concurrently")
+        return db.session.get(Blob, content_hash).storage_key
+
+def discard_upload(image_path, content_hash):
+    """Remove a stored file after its transaction was rolled back, unless other images share it."""
+    if not image_path:
+        return
+    blob = db.session.get(Blob, content_hash) if content_hash else None
+    if blob is None or blob.ref_count <= 0:
+        storage = get_storage()
+        storage.delete(storage.key_for(image_path))
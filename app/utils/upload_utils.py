@@ -0,0 +1,360 @@
+from flask import Request, after_this_request, current_app, request
+from PIL import ImageFile
+from werkzeug.exceptions import RequestEntityTooLarge
+from app.utils.storage_utils import CHUNK_SIZE, file_incoming, file_incoming_async, get_storage, incoming_path
+from contextlib import contextmanager
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+import uuid
+
+try:
+    import fcntl
+except ImportError:  # Windows: chunks of one upload are not guarded against concurrent writers
+    fcntl = None
+
+# Leading bytes of the formats both preprocessing backends can decode
+IMAGE_SIGNATURES = {
+    'JPEG': (b'\xff\xd8\xff',),
+    'PNG': (b'\x89PNG\r\n\x1a\n',),
+    'GIF': (b'GIF87a', b'GIF89a'),
+    'BMP': (b'BM',)
+}
+SIGNATURE_LENGTH = 8
+
+# Resumable uploads keep <id>.part and <id>.json in this folder of the storage's incoming area
+PARTIAL_FOLDER = 'partial'
+UPLOAD_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+# How far into a file the dimensions may be; JPEG EXIF and ICC segments come before them
+HEADER_LIMIT = 1024 * 1024
+
+class UploadRejected(Exception):
+    # Not a ValueError: Werkzeug's form parser silently swallows those
+    def __init__(self, message, status_code=400, offset=None):
+        super().__init__(message)
+        self.status_code = status_code
+        # Where a resumable upload stood when a chunk was refused, for the Upload-Offset header
+        self.offset = offset
+
+def sniff_format(header):
+    for image_format, signatures in IMAGE_SIGNATURES.items():
+        if header.startswith(signatures):
+            return image_format
+    return None
+
+class ImageInspector:
+    """Checks the start of a file as it is fed in: the signature must be one of
+    ``IMAGE_SIGNATURES`` and the header must give dimensions within
+    ``max_pixels``. Raises ``UploadRejected``; ``dimensions`` is set once known."""
+
+    def __init__(self, max_pixels=None):
+        self.max_pixels = max_pixels
+        self.size = 0
+        self.image_format = None
+        self.dimensions = None
+        self._header = b''
+        self._parser = ImageFile.Parser()
+
+    def feed(self, data):
+        if self.dimensions is not None:
+            return
+        self.size += len(data)
+        if self.image_format is None:
+            self._header += data
+            if len(self._header) < SIGNATURE_LENGTH:
+                return
+            self.image_format = sniff_format(self._header)
+            if self.image_format is None:
+                raise UploadRejected(f"Unsupported file type, expected one of {', '.join(IMAGE_SIGNATURES)}", 415)
+            data, self._header = self._header, b''
+
+        # The parser buffers until the header is complete; it is dropped before decoding pixels
+        self._parser.feed(data)
+        if self._parser.image is None:
+            if self.size > HEADER_LIMIT:
+                raise UploadRejected('Could not read the image dimensions')
+            return
+        self.dimensions = self._parser.image.size
+        self._parser = None
+
+        width, height = self.dimensions
+        if self.max_pixels and width * height > self.max_pixels:
+            raise UploadRejected(f"Image is {width}x{height}, larger than the {self.max_pixels} pixel limit", 413)
+
+    def finish(self):
+        # Files shorter than their header never reached a verdict
+        if self.dimensions is None:
+            raise UploadRejected('File is not a complete image')
+
+class IncomingUpload:
+    """Sink that Werkzeug writes one uploaded file into while it reads the body.
+
+    The first bytes are checked against the image signatures and the header
+    is parsed for the dimensions as soon as it has arrived, so a non-image or
+    an oversized photo is refused after a few kilobytes rather than after the
+    whole upload. Every chunk is hashed on its way to a spool file in the
+    storage backend's incoming folder, from where ``store`` moves it into
+    place under its content hash. With ``keep_bytes`` the chunks are also
+    kept in memory, for decoding without reading the spool file back.
+    """
+
+    def __init__(self, path, max_bytes=None, max_pixels=None, keep_bytes=False):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._chunks = [] if keep_bytes else None
+        self._inspector = ImageInspector(max_pixels)
+        self._sha256 = hashlib.sha256()
+        self._file = open(path, 'w+b')
+
+    def __getattr__(self, name):
+        # read, seek, tell... for FileStorage and the route reading the upload back
+        return getattr(self._file, name)
+
+    @property
+    def content_hash(self):
+        return self._sha256.hexdigest()
+
+    @property
+    def image_format(self):
+        return self._inspector.image_format
+
+    @property
+    def dimensions(self):
+        return self._inspector.dimensions
+
+    def write(self, data):
+        self.size += len(data)
+        if self.max_bytes and self.size > self.max_bytes:
+            raise UploadRejected(f"Image is larger than the {self.max_bytes} byte limit", 413)
+        self._inspector.feed(data)
+        self._sha256.update(data)
+        if self._chunks is not None:
+            self._chunks.append(bytes(data))
+        return self._file.write(data)
+
+    def finish(self):
+        self._inspector.finish()
+        self._file.flush()
+        self._file.seek(0)
+
+    def getvalue(self):
+        # The whole upload, from memory; needs keep_bytes
+        self.finish()
+        return b''.join(self._chunks)
+
+    def store(self, filename):
+        """File the upload under its content hash; returns ``(image_path, content_hash)``."""
+        return self.store_async(filename)()
+
+    def store_async(self, filename, executor=None):
+        # See storage_utils.file_incoming_async
+        self.finish()
+        self._file.close()
+        return file_incoming_async(self.path, self.content_hash, self.size, filename, executor)
+
+    def discard(self):
+        self._file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+class UploadRequest(Request):
+    """Request whose multipart files go into ``upload_sink_factory`` sinks when a
+    route has set one, rather than into Werkzeug's temporary files."""
+
+    upload_sink_factory = None
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if self.upload_sink_factory is not None:
+            return self.upload_sink_factory()
+        return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+
+def receive_uploads(name, keep_bytes=False, max_files=None):
+    """The files of form field ``name``, each streamed into an ``IncomingUpload``.
+
+    Must run before anything else touches ``request.files`` or ``request.form``.
+    Requests over ``MAX_CONTENT_LENGTH`` are refused from their headers, before
+    any of the body is read, and requests with more than ``max_files`` files
+    as the first file too many arrives. Spool files that were not stored are
+    removed once the response is ready. Raises ``UploadRejected``.
+    """
+    config = current_app.config
+    sinks = []
+
+    def open_sink():
+        if max_files is not None and len(sinks) >= max_files:
+            raise UploadRejected(f"At most {max_files} images can be uploaded per request", 400)
+        sinks.append(IncomingUpload(incoming_path(), config.get('UPLOAD_MAX_BYTES'), config.get('UPLOAD_MAX_PIXELS'), keep_bytes))
+        return sinks[-1]
+
+    @after_this_request
+    def remove_spooled(response):
+        for sink in sinks:
+            sink.discard()
+        return response
+
+    request.upload_sink_factory = open_sink
+    try:
+        return request.files.getlist(name)
+    except RequestEntityTooLarge:
+        raise UploadRejected(f"Request is larger than the {request.max_content_length} byte limit", 413)
+
+def partial_folder():
+    folder = os.path.join(get_storage().incoming_dir(), PARTIAL_FOLDER)
+    os.makedirs(folder, exist_ok=True)
+    return folder
+
+class ChunkedUpload:
+    """A resumable upload, sent as chunks at increasing offsets.
+
+    All state is on disk: ``<id>.part`` holds the bytes received so far, so
+    its size is the offset the next chunk must start at, and ``<id>.json``
+    records the owner, file name and announced length. A client whose
+    connection dropped asks for the offset and carries on from there; what
+    had arrived before the drop is kept. Chunks are written with
+    ``os.pwrite`` straight from the request stream, so nothing is buffered
+    beyond one read.
+    """
+
+    def __init__(self, upload_id, folder, metadata):
+        self.id = upload_id
+        self.part_path = os.path.join(folder, f"{upload_id}.part")
+        self.metadata_path = os.path.join(folder, f"{upload_id}.json")
+        self.user_id = metadata['user_id']
+        self.filename = metadata['filename']
+        self.length = metadata['length']
+
+    @classmethod
+    def create(cls, user_id, filename, length):
+        folder = partial_folder()
+        upload_id = uuid.uuid4().hex
+        metadata = {'user_id': user_id, 'filename': filename, 'length': length, 'created': time.time()}
+        upload = cls(upload_id, folder, metadata)
+        open(upload.part_path, 'wb').close()
+        with open(upload.metadata_path, 'w') as f:
+            json.dump(metadata, f)
+        return upload
+
+    @classmethod
+    def load(cls, upload_id):
+        # None for unknown, expired or malformed ids
+        if not UPLOAD_ID_PATTERN.match(upload_id):
+            return None
+        folder = partial_folder()
+        try:
+            with open(os.path.join(folder, f"{upload_id}.json")) as f:
+                upload = cls(upload_id, folder, json.load(f))
+        except (OSError, ValueError, KeyError):
+            return None
+        return upload if os.path.exists(upload.part_path) else None
+
+    @property
+    def offset(self):
+        return os.path.getsize(self.part_path)
+
+    @contextmanager
+    def _open_part(self):
+        # One writer at a time: a retried chunk may arrive while the dropped request is still reading
+        try:
+            fd = os.open(self.part_path, os.O_RDWR)
+        except FileNotFoundError:
+            raise UploadRejected('Upload not found', 404)
+        try:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    raise UploadRejected('Another request is writing to this upload', 409, offset=os.fstat(fd).st_size)
+                # A finalize that held the lock before us may have filed the .part away meanwhile
+                try:
+                    current = os.stat(self.part_path).st_ino
+                except FileNotFoundError:
+                    current = None
+                if current != os.fstat(fd).st_ino:
+                    raise UploadRejected('Upload not found', 404)
+            yield fd
+        finally:
+            os.close(fd)
+
+    def write_chunk(self, offset, stream):
+        """Append the chunk read from ``stream`` at ``offset``; returns the new offset."""
+        with self._open_part() as fd:
+            position = os.fstat(fd).st_size
+            if offset != position:
+                raise UploadRejected(f"Upload is at offset {position}, not {offset}", 409, offset=position)
+            for data in iter(lambda: stream.read(CHUNK_SIZE), b''):
+                if position + len(data) > self.length:
+                    raise UploadRejected(f"Chunk runs past the announced length of {self.length} bytes", 413)
+                written = os.pwrite(fd, data, position)
+                # Refuse a non-image once its signature is in, rather than after the last chunk
+                if position < SIGNATURE_LENGTH <= position + written and sniff_format(os.pread(fd, SIGNATURE_LENGTH, 0)) is None:
+                    self.discard()
+                    raise UploadRejected(f"Unsupported file type, expected one of {', '.join(IMAGE_SIGNATURES)}", 415)
+                position += written
+            return position
+
+    def store(self, max_pixels=None):
+        """Check and hash the complete file and file it under its content hash.
+
+        Returns ``(image_path, content_hash)``. An upload that is not a valid
+        image is discarded; one that is still incomplete is kept for resuming.
+        The lock is held until the file is stored, so a second finalize of the
+        same upload gets a 409 while this one runs and a 404 after it.
+        """
+        with self._open_part() as fd:
+            received = os.fstat(fd).st_size
+            if received != self.length:
+                raise UploadRejected(f"Upload is incomplete, {received} of {self.length} bytes received", 409)
+            inspector = ImageInspector(max_pixels)
+            sha256 = hashlib.sha256()
+            try:
+                for position in range(0, self.length, CHUNK_SIZE):
+                    data = os.pread(fd, CHUNK_SIZE, position)
+                    inspector.feed(data)
+                    sha256.update(data)
+                inspector.finish()
+            except UploadRejected:
+                self.discard()
+                raise
+            result = file_incoming(self.part_path, sha256.hexdigest(), self.length, self.filename)
+            os.remove(self.metadata_path)
+            return result
+
+    def discard(self):
+        for path in (self.part_path, self.metadata_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+def expire_chunked_uploads(ttl):
+    """Remove resumable uploads that received nothing for ``ttl`` seconds; returns how many."""
+    folder = partial_folder()
+    cutoff = time.time() - ttl
+    expired = 0
+    for name in os.listdir(folder):
+        path = os.path.join(folder, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                # A new chunk touches the .part file, so the upload's age is that of its .part
+                upload_id = os.path.splitext(name)[0]
+                part_path = os.path.join(folder, f"{upload_id}.part")
+                if not os.path.exists(part_path) or os.path.getmtime(part_path) < cutoff:
+                    os.remove(path)
+                    expired += name.endswith('.part')
+        except FileNotFoundError:
+            continue
+    if expired:
+        logging.info(f"Expired {expired} resumable upload(s)")
+    return expired
+
+def sweep_chunked_uploads():
+    # Called when uploads start; lists the folder at most once per sweep interval in each process
+    config = current_app.config
+    now = time.monotonic()
+    last_sweep = current_app.extensions.get('chunked_upload_sweep')
+    if last_sweep is None or now - last_sweep >= config.get('CHUNKED_UPLOAD_SWEEP_INTERVAL', 600):
+        current_app.extensions['chunked_upload_sweep'] = now
+        expire_chunked_uploads(config.get('CHUNKED_UPLOAD_TTL', 86400))
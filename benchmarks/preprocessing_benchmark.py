@@ -0,0 +1,90 @@
+"""Compare the TensorFlow and Pillow preprocessing pipelines on large photos.
+
+Run from the project root:
+
+    python -m benchmarks.preprocessing_benchmark --count 10
+    python -m benchmarks.preprocessing_benchmark --images path/to/photos
+
+Without --images, phone-sized JPEGs (4000x3000) are generated in a
+temporary directory. Reports ms per image for each pipeline, the peak
+decoded bitmap size and the mean/max absolute difference from TensorFlow.
+"""
+import argparse
+import os
+import tempfile
+import time
+import numpy as np
+from PIL import Image
+from app.utils.preprocessing import image_buffer, preprocess_image_pillow, preprocess_image_tf
+
+IMAGE_SIZE = (256, 256)
+
+def generate_images(directory, count, width, height):
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    paths = []
+    for i in range(count):
+        pixels = np.stack([128 + 100 * np.sin(x / (250 + 40 * i) + c) * np.cos(y / (350 + 20 * c)) for c in range(3)], axis=-1)
+        pixels += rng.normal(0, 6, pixels.shape)
+        path = os.path.join(directory, f'photo_{i}.jpg')
+        Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8)).save(path, quality=90)
+        paths.append(path)
+    return paths
+
+def time_pipeline(preprocess, paths, repeats):
+    outputs = [np.array(preprocess(path)) for path in paths]  # warm-up, and copies for comparison
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for path in paths:
+            preprocess(path)
+    return 1000 * (time.perf_counter() - start) / (repeats * len(paths)), outputs
+
+def decoded_megabytes(path, draft):
+    with Image.open(path) as img:
+        if draft:
+            img.draft('RGB', IMAGE_SIZE)
+        return img.size[0] * img.size[1] * 3 / 1024 / 1024
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--images', help='Directory of JPEGs to use instead of generated ones')
+    parser.add_argument('--count', type=int, default=5, help='Number of images to generate')
+    parser.add_argument('--width', type=int, default=4000)
+    parser.add_argument('--height', type=int, default=3000)
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        if args.images:
+            paths = sorted(os.path.join(args.images, name) for name in os.listdir(args.images)
+                           if name.lower().endswith(('.jpg', '.jpeg', '.png')))
+        else:
+            paths = generate_images(directory, args.count, args.width, args.height)
+
+        buffer = image_buffer(IMAGE_SIZE)
+        pipelines = {
+            'tf': lambda path: preprocess_image_tf(path, IMAGE_SIZE),
+            'pillow': lambda path: preprocess_image_pillow(path, IMAGE_SIZE, draft=False).copy(),
+            'pillow+draft': lambda path: preprocess_image_pillow(path, IMAGE_SIZE).copy(),
+            'pillow+draft (reused buffer)': lambda path: preprocess_image_pillow(path, IMAGE_SIZE, out=buffer)
+        }
+
+        timings = {}
+        outputs = {}
+        for name, preprocess in pipelines.items():
+            timings[name], outputs[name] = time_pipeline(preprocess, paths, args.repeats)
+
+        full_mb = max(decoded_megabytes(path, False) for path in paths)
+        draft_mb = max(decoded_megabytes(path, True) for path in paths)
+
+        print(f"{len(paths)} image(s), {args.repeats} repeat(s)")
+        print(f"{'pipeline':<30}{'ms/image':>10}{'speedup':>10}{'mean diff':>11}{'max diff':>10}")
+        for name, ms in timings.items():
+            diffs = [np.abs(actual - expected) for actual, expected in zip(outputs[name], outputs['tf'])]
+            mean_diff = np.mean([diff.mean() for diff in diffs])
+            max_diff = max(diff.max() for diff in diffs)
+            print(f"{name:<30}{ms:>10.1f}{timings['tf'] / ms:>9.2f}x{mean_diff:>11.3f}{max_diff:>10.1f}")
+        print(f"Largest decoded bitmap: {full_mb:.1f} MB full size, {draft_mb:.1f} MB with draft decoding")
+
+if __name__ == '__main__':
+    main()
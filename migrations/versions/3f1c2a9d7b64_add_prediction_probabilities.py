@@ -0,0 +1,39 @@
+"""add packed probability vectors to predictions
+
+Revision ID: 3f1c2a9d7b64
+Revises: 
+Create Date: 2026-10-18 11:20:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c2a9d7b64'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def _has_column(table, column):
+    # create_app() runs db.create_all(), so new databases may already have it
+    return column in [c['name'] for c in sa.inspect(op.get_bind()).get_columns(table)]
+
+
+def upgrade():
+    if not _has_column('prediction', 'probabilities'):
+        with op.batch_alter_table('prediction') as batch_op:
+            batch_op.add_column(sa.Column('probabilities', sa.LargeBinary(), nullable=True))
+
+    if not _has_column('prediction_cache_entry', 'probabilities'):
+        with op.batch_alter_table('prediction_cache_entry') as batch_op:
+            batch_op.add_column(sa.Column('probabilities', sa.LargeBinary(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('prediction_cache_entry') as batch_op:
+        batch_op.drop_column('probabilities')
+
+    with op.batch_alter_table('prediction') as batch_op:
+        batch_op.drop_column('probabilities')
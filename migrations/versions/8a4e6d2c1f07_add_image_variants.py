@@ -0,0 +1,37 @@
+"""add thumbnail, web and model-input variant paths to images
+
+Revision ID: 8a4e6d2c1f07
+Revises: 3f1c2a9d7b64
+Create Date: 2026-10-18 14:05:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8a4e6d2c1f07'
+down_revision = '3f1c2a9d7b64'
+branch_labels = None
+depends_on = None
+
+VARIANT_COLUMNS = ('thumbnail_path', 'web_path', 'model_input_path')
+
+
+def _has_column(table, column):
+    # create_app() runs db.create_all(), so new databases may already have it
+    return column in [c['name'] for c in sa.inspect(op.get_bind()).get_columns(table)]
+
+
+def upgrade():
+    missing = [column for column in VARIANT_COLUMNS if not _has_column('image', column)]
+    if missing:
+        with op.batch_alter_table('image') as batch_op:
+            for column in missing:
+                batch_op.add_column(sa.Column(column, sa.String(length=255), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('image') as batch_op:
+        for column in reversed(VARIANT_COLUMNS):
+            batch_op.drop_column(column)
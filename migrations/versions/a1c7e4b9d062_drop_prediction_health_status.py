@@ -0,0 +1,39 @@
+"""drop the health status of predictions, which the per-class counters replaced
+
+Revision ID: a1c7e4b9d062
+Revises: f4d9a2c6e813
+Create Date: 2026-10-19 09:40:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a1c7e4b9d062'
+down_revision = 'f4d9a2c6e813'
+branch_labels = None
+depends_on = None
+
+
+def _has_column(table, column):
+    return column in {c['name'] for c in sa.inspect(op.get_bind()).get_columns(table)}
+
+
+def _has_index(table, name):
+    return name in {index['name'] for index in sa.inspect(op.get_bind()).get_indexes(table)}
+
+
+def upgrade():
+    # Only databases migrated while the column existed have it; the overview reads PredictionCount
+    for name in ('ix_prediction_user_id_health_status', 'ix_prediction_health_status'):
+        if _has_index('prediction', name):
+            op.drop_index(name, table_name='prediction')
+    if _has_column('prediction', 'health_status'):
+        with op.batch_alter_table('prediction') as batch_op:
+            batch_op.drop_column('health_status')
+
+
+def downgrade():
+    # Nothing to restore: earlier revisions no longer create the column
+    pass
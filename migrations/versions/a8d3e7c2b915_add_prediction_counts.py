@@ -0,0 +1,84 @@
+"""add per-user, per-class prediction counters, filled from existing predictions
+
+Revision ID: a8d3e7c2b915
+Revises: e5a9c3f8d214
+Create Date: 2026-10-18 20:05:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a8d3e7c2b915'
+down_revision = 'e5a9c3f8d214'
+branch_labels = None
+depends_on = None
+
+prediction = sa.table(
+    'prediction',
+    sa.column('id', sa.Integer),
+    sa.column('user_id', sa.Integer),
+    sa.column('predicted_class', sa.String)
+)
+
+
+def _has_table(table):
+    # create_app() runs db.create_all(), so new databases may already have it
+    return sa.inspect(op.get_bind()).has_table(table)
+
+
+def _health_status(predicted_class):
+    # Same rules as models.health_status_for
+    name = predicted_class.lower()
+    if 'healthy' in name:
+        return 'healthy'
+    if 'unknown' in name:
+        return 'unknown'
+    return 'diseased'
+
+
+def upgrade():
+    if not _has_table('prediction_count'):
+        op.create_table(
+            'prediction_count',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('user_id', sa.Integer(), nullable=False),
+            sa.Column('plant_name', sa.String(length=50), nullable=True),
+            sa.Column('predicted_class', sa.String(length=100), nullable=False),
+            sa.Column('health_status', sa.String(length=20), nullable=True),
+            sa.Column('count', sa.Integer(), nullable=False),
+            sa.ForeignKeyConstraint(['user_id'], ['user.id']),
+            sa.PrimaryKeyConstraint('id'),
+            sa.UniqueConstraint('user_id', 'predicted_class')
+        )
+
+    # Rebuilt from scratch: an app started before the migration may already have counted some predictions.
+    # One row per user and class, so the grouped result is small whatever the table size.
+    bind = op.get_bind()
+    bind.execute(sa.text('DELETE FROM prediction_count'))
+    groups = bind.execute(
+        sa.select(prediction.c.user_id, prediction.c.predicted_class, sa.func.count(prediction.c.id))
+        .where(prediction.c.user_id.isnot(None), prediction.c.predicted_class.isnot(None))
+        .group_by(prediction.c.user_id, prediction.c.predicted_class)
+    ).all()
+    counts = [{
+        'user_id': user_id,
+        'predicted_class': predicted_class,
+        'plant_name': predicted_class.split('___', 1)[0] if '___' in predicted_class else None,
+        'health_status': _health_status(predicted_class),
+        'count': count
+    } for user_id, predicted_class, count in groups]
+    if counts:
+        op.bulk_insert(sa.table(
+            'prediction_count',
+            sa.column('user_id', sa.Integer),
+            sa.column('plant_name', sa.String),
+            sa.column('predicted_class', sa.String),
+            sa.column('health_status', sa.String),
+            sa.column('count', sa.Integer)
+        ), counts)
+
+
+def downgrade():
+    op.drop_table('prediction_count')
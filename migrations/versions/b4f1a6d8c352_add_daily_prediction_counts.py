@@ -0,0 +1,68 @@
+"""add per-user daily prediction counts, filled from existing predictions
+
+Revision ID: b4f1a6d8c352
+Revises: a8d3e7c2b915
+Create Date: 2026-10-18 20:50:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b4f1a6d8c352'
+down_revision = 'a8d3e7c2b915'
+branch_labels = None
+depends_on = None
+
+prediction = sa.table(
+    'prediction',
+    sa.column('id', sa.Integer),
+    sa.column('user_id', sa.Integer),
+    sa.column('prediction_date', sa.DateTime)
+)
+
+daily_prediction_count = sa.table(
+    'daily_prediction_count',
+    sa.column('user_id', sa.Integer),
+    sa.column('day', sa.Date),
+    sa.column('count', sa.Integer)
+)
+
+
+def _has_table(table):
+    # create_app() runs db.create_all(), so new databases may already have it
+    return sa.inspect(op.get_bind()).has_table(table)
+
+
+def upgrade():
+    if not _has_table('daily_prediction_count'):
+        op.create_table(
+            'daily_prediction_count',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('user_id', sa.Integer(), nullable=False),
+            sa.Column('day', sa.Date(), nullable=False),
+            sa.Column('count', sa.Integer(), nullable=False),
+            sa.ForeignKeyConstraint(['user_id'], ['user.id']),
+            sa.PrimaryKeyConstraint('id'),
+            sa.UniqueConstraint('user_id', 'day')
+        )
+
+    # Rebuilt in one INSERT ... SELECT, as an app started before the migration may already have counted some.
+    # CAST(... AS DATE) would give the year alone on SQLite.
+    bind = op.get_bind()
+    if bind.dialect.name in ('sqlite', 'mysql'):
+        day = sa.func.date(prediction.c.prediction_date)
+    else:
+        day = sa.cast(prediction.c.prediction_date, sa.Date)
+    bind.execute(daily_prediction_count.delete())
+    bind.execute(daily_prediction_count.insert().from_select(
+        ['user_id', 'day', 'count'],
+        sa.select(prediction.c.user_id, day, sa.func.count(prediction.c.id))
+        .where(prediction.c.user_id.isnot(None), prediction.c.prediction_date.isnot(None))
+        .group_by(prediction.c.user_id, day)
+    ))
+
+
+def downgrade():
+    op.drop_table('daily_prediction_count')
@@ -0,0 +1,58 @@
+"""add content-addressed blobs referenced by images
+
+Revision ID: c71d0e5b9a23
+Revises: 8a4e6d2c1f07
+Create Date: 2026-10-18 16:40:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c71d0e5b9a23'
+down_revision = '8a4e6d2c1f07'
+branch_labels = None
+depends_on = None
+
+
+def _has_table(table):
+    # create_app() runs db.create_all(), so new databases may already have it
+    return sa.inspect(op.get_bind()).has_table(table)
+
+
+def _has_column(table, column):
+    return column in [c['name'] for c in sa.inspect(op.get_bind()).get_columns(table)]
+
+
+def upgrade():
+    if not _has_table('blob'):
+        op.create_table(
+            'blob',
+            sa.Column('content_hash', sa.String(length=64), nullable=False),
+            sa.Column('storage_key', sa.String(length=255), nullable=False),
+            sa.Column('size', sa.BigInteger(), nullable=True),
+            sa.Column('ref_count', sa.Integer(), nullable=False),
+            sa.Column('create_date', sa.DateTime(), nullable=True),
+            sa.PrimaryKeyConstraint('content_hash')
+        )
+
+    # Existing uploads keep an empty hash until `flask uploads rehash` moves them
+    if not _has_column('image', 'content_hash'):
+        with op.batch_alter_table('image') as batch_op:
+            batch_op.add_column(sa.Column('content_hash', sa.String(length=64), nullable=True))
+            batch_op.create_index('ix_image_content_hash', ['content_hash'])
+            batch_op.create_foreign_key('fk_image_content_hash_blob', 'blob', ['content_hash'], ['content_hash'])
+
+
+def downgrade():
+    # Tables made by create_all() have an unnamed foreign key, which goes with the column
+    foreign_keys = [fk['name'] for fk in sa.inspect(op.get_bind()).get_foreign_keys('image')
+                    if fk['constrained_columns'] == ['content_hash'] and fk['name']]
+    with op.batch_alter_table('image') as batch_op:
+        for name in foreign_keys:
+            batch_op.drop_constraint(name, type_='foreignkey')
+        batch_op.drop_index('ix_image_content_hash')
+        batch_op.drop_column('content_hash')
+
+    op.drop_table('blob')
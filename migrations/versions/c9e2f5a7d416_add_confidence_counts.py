@@ -0,0 +1,70 @@
+"""add per-user, per-class confidence percent counts, filled from existing predictions
+
+Revision ID: c9e2f5a7d416
+Revises: b4f1a6d8c352
+Create Date: 2026-10-18 21:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c9e2f5a7d416'
+down_revision = 'b4f1a6d8c352'
+branch_labels = None
+depends_on = None
+
+prediction = sa.table(
+    'prediction',
+    sa.column('id', sa.Integer),
+    sa.column('user_id', sa.Integer),
+    sa.column('predicted_class', sa.String),
+    sa.column('confidence_percentage', sa.Float)
+)
+
+confidence_count = sa.table(
+    'confidence_count',
+    sa.column('user_id', sa.Integer),
+    sa.column('predicted_class', sa.String),
+    sa.column('percent', sa.Integer),
+    sa.column('count', sa.Integer)
+)
+
+
+def _has_table(table):
+    # create_app() runs db.create_all(), so new databases may already have it
+    return sa.inspect(op.get_bind()).has_table(table)
+
+
+def upgrade():
+    if not _has_table('confidence_count'):
+        op.create_table(
+            'confidence_count',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('user_id', sa.Integer(), nullable=False),
+            sa.Column('predicted_class', sa.String(length=100), nullable=False),
+            sa.Column('percent', sa.Integer(), nullable=False),
+            sa.Column('count', sa.Integer(), nullable=False),
+            sa.ForeignKeyConstraint(['user_id'], ['user.id']),
+            sa.PrimaryKeyConstraint('id'),
+            sa.UniqueConstraint('user_id', 'predicted_class', 'percent')
+        )
+
+    # Rebuilt in one INSERT ... SELECT, as an app started before the migration may already have counted some.
+    # The whole percent, 0 to 99 with 100% in 99, as stat_utils.percent_bucket computes it.
+    bind = op.get_bind()
+    confidence = prediction.c.confidence_percentage
+    whole = sa.cast(confidence, sa.Integer) if bind.dialect.name == 'sqlite' else sa.cast(sa.func.floor(confidence), sa.Integer)
+    percent = sa.case((confidence >= 100, 99), (confidence < 0, 0), else_=whole)
+    bind.execute(confidence_count.delete())
+    bind.execute(confidence_count.insert().from_select(
+        ['user_id', 'predicted_class', 'percent', 'count'],
+        sa.select(prediction.c.user_id, prediction.c.predicted_class, percent, sa.func.count(prediction.c.id))
+        .where(prediction.c.user_id.isnot(None), prediction.c.predicted_class.isnot(None), confidence.isnot(None))
+        .group_by(prediction.c.user_id, prediction.c.predicted_class, percent)
+    ))
+
+
+def downgrade():
+    op.drop_table('confidence_count')
@@ -0,0 +1,127 @@
+"""move multiple-choice survey answers into survey_answer rows and count survey options
+
+Revision ID: d3a8b6e1f925
+Revises: c9e2f5a7d416
+Create Date: 2026-10-18 22:15:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd3a8b6e1f925'
+down_revision = 'c9e2f5a7d416'
+branch_labels = None
+depends_on = None
+
+MULTIPLE_CHOICE_QUESTIONS = ('usefulness', 'desired_features')
+SINGLE_CHOICE_QUESTIONS = ('satisfaction', 'recommendation')
+
+survey = sa.table(
+    'user_satisfaction_survey',
+    sa.column('id', sa.Integer),
+    sa.column('satisfaction', sa.String),
+    sa.column('recommendation', sa.String),
+    sa.column('usefulness', sa.Text),
+    sa.column('desired_features', sa.Text)
+)
+
+survey_answer = sa.table(
+    'survey_answer',
+    sa.column('id', sa.Integer),
+    sa.column('survey_id', sa.Integer),
+    sa.column('question', sa.String),
+    sa.column('option', sa.String)
+)
+
+survey_option_count = sa.table(
+    'survey_option_count',
+    sa.column('question', sa.String),
+    sa.column('option', sa.String),
+    sa.column('count', sa.Integer)
+)
+
+
+def _has_table(table):
+    # create_app() runs db.create_all(), so new databases may already have it
+    return sa.inspect(op.get_bind()).has_table(table)
+
+
+def _has_column(table, column):
+    return column in {c['name'] for c in sa.inspect(op.get_bind()).get_columns(table)}
+
+
+def upgrade():
+    if not _has_table('survey_answer'):
+        op.create_table(
+            'survey_answer',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('survey_id', sa.Integer(), nullable=False),
+            sa.Column('question', sa.String(length=50), nullable=False),
+            sa.Column('option', sa.String(length=255), nullable=False),
+            sa.ForeignKeyConstraint(['survey_id'], ['user_satisfaction_survey.id']),
+            sa.PrimaryKeyConstraint('id'),
+            sa.UniqueConstraint('survey_id', 'question', 'option')
+        )
+    if not _has_table('survey_option_count'):
+        op.create_table(
+            'survey_option_count',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('question', sa.String(length=50), nullable=False),
+            sa.Column('option', sa.String(length=255), nullable=False),
+            sa.Column('count', sa.Integer(), nullable=False),
+            sa.PrimaryKeyConstraint('id'),
+            sa.UniqueConstraint('question', 'option')
+        )
+
+    bind = op.get_bind()
+    if _has_column('user_satisfaction_survey', 'usefulness'):
+        # Surveys already answered through an app started before the migration have their rows
+        converted = set(bind.execute(sa.select(survey_answer.c.survey_id).distinct()).scalars())
+        rows = []
+        for survey_id, *answers in bind.execute(sa.select(survey.c.id, survey.c.usefulness, survey.c.desired_features)).all():
+            if survey_id in converted:
+                continue
+            for question, value in zip(MULTIPLE_CHOICE_QUESTIONS, answers):
+                options = dict.fromkeys(option for option in (value or '').split(',') if option)
+                rows.extend({'survey_id': survey_id, 'question': question, 'option': option} for option in options)
+        if rows:
+            op.bulk_insert(survey_answer, rows)
+        with op.batch_alter_table('user_satisfaction_survey') as batch_op:
+            batch_op.drop_column('usefulness')
+            batch_op.drop_column('desired_features')
+
+    # Rebuilt from scratch, one grouped INSERT ... SELECT per source
+    bind.execute(survey_option_count.delete())
+    bind.execute(survey_option_count.insert().from_select(
+        ['question', 'option', 'count'],
+        sa.select(survey_answer.c.question, survey_answer.c.option, sa.func.count(survey_answer.c.id))
+        .group_by(survey_answer.c.question, survey_answer.c.option)
+    ))
+    for question in SINGLE_CHOICE_QUESTIONS:
+        column = survey.c[question]
+        bind.execute(survey_option_count.insert().from_select(
+            ['question', 'option', 'count'],
+            sa.select(sa.literal(question), column, sa.func.count(survey.c.id)).where(column.isnot(None)).group_by(column)
+        ))
+
+
+def downgrade():
+    with op.batch_alter_table('user_satisfaction_survey') as batch_op:
+        batch_op.add_column(sa.Column('usefulness', sa.Text(), nullable=True))
+        batch_op.add_column(sa.Column('desired_features', sa.Text(), nullable=True))
+
+    bind = op.get_bind()
+    values = {}
+    for survey_id, question, option in bind.execute(
+        sa.select(survey_answer.c.survey_id, survey_answer.c.question, survey_answer.c.option).order_by(survey_answer.c.id)
+    ):
+        values.setdefault(survey_id, {}).setdefault(question, []).append(option)
+    for survey_id, answers in values.items():
+        bind.execute(survey.update().where(survey.c.id == survey_id).values(
+            **{question: ','.join(options) for question, options in answers.items()}
+        ))
+
+    op.drop_table('survey_option_count')
+    op.drop_table('survey_answer')
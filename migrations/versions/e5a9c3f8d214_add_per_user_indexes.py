@@ -0,0 +1,41 @@
+"""add composite indexes for per-user, time-ordered queries
+
+Revision ID: e5a9c3f8d214
+Revises: c71d0e5b9a23
+Create Date: 2026-10-18 18:10:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5a9c3f8d214'
+down_revision = 'c71d0e5b9a23'
+branch_labels = None
+depends_on = None
+
+INDEXES = [
+    ('prediction', 'ix_prediction_user_id_prediction_date', ['user_id', 'prediction_date']),
+    ('prediction', 'ix_prediction_user_id_predicted_class', ['user_id', 'predicted_class']),
+    ('prediction', 'ix_prediction_image_id', ['image_id']),
+    ('image', 'ix_image_user_id_upload_date', ['user_id', 'upload_date']),
+    ('cure_suggestion', 'ix_cure_suggestion_disease_id', ['disease_id']),
+]
+
+
+def _has_index(table, name):
+    # create_app() runs db.create_all(), so new databases may already have them
+    return name in [index['name'] for index in sa.inspect(op.get_bind()).get_indexes(table)]
+
+
+def upgrade():
+    for table, name, columns in INDEXES:
+        if not _has_index(table, name):
+            op.create_index(name, table, columns)
+
+
+def downgrade():
+    for table, name, columns in reversed(INDEXES):
+        if _has_index(table, name):
+            op.drop_index(name, table_name=table)
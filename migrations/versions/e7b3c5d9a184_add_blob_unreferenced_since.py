@@ -0,0 +1,46 @@
+"""record since when each blob has had no images, so garbage collection waits out the grace period
+
+Revision ID: e7b3c5d9a184
+Revises: d3a8b6e1f925
+Create Date: 2026-10-18 23:00:00.000000
+
+"""
+from datetime import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e7b3c5d9a184'
+down_revision = 'd3a8b6e1f925'
+branch_labels = None
+depends_on = None
+
+blob = sa.table(
+    'blob',
+    sa.column('ref_count', sa.Integer),
+    sa.column('unreferenced_since', sa.DateTime)
+)
+
+
+def _has_column(table, column):
+    # create_app() runs db.create_all(), but that never adds columns to existing tables
+    return column in {c['name'] for c in sa.inspect(op.get_bind()).get_columns(table)}
+
+
+def upgrade():
+    if not _has_column('blob', 'unreferenced_since'):
+        with op.batch_alter_table('blob') as batch_op:
+            batch_op.add_column(sa.Column('unreferenced_since', sa.DateTime(), nullable=True))
+
+    # When existing blobs lost their images is unknown, so their grace period starts now
+    op.get_bind().execute(
+        blob.update().where(blob.c.ref_count <= 0, blob.c.unreferenced_since.is_(None))
+        .values(unreferenced_since=datetime.utcnow())
+    )
+
+
+def downgrade():
+    with op.batch_alter_table('blob') as batch_op:
+        batch_op.drop_column('unreferenced_since')
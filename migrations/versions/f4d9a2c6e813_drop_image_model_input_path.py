@@ -0,0 +1,33 @@
+"""drop the model-input variant path of images, which inference never read
+
+Revision ID: f4d9a2c6e813
+Revises: e7b3c5d9a184
+Create Date: 2026-10-19 09:10:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f4d9a2c6e813'
+down_revision = 'e7b3c5d9a184'
+branch_labels = None
+depends_on = None
+
+
+def _has_column(table, column):
+    return column in {c['name'] for c in sa.inspect(op.get_bind()).get_columns(table)}
+
+
+def upgrade():
+    # The files stay next to their blob until garbage collection removes the blob with its variants
+    if _has_column('image', 'model_input_path'):
+        with op.batch_alter_table('image') as batch_op:
+            batch_op.drop_column('model_input_path')
+
+
+def downgrade():
+    if not _has_column('image', 'model_input_path'):
+        with op.batch_alter_table('image') as batch_op:
+            batch_op.add_column(sa.Column('model_input_path', sa.String(length=255), nullable=True))
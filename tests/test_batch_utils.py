@@ -0,0 +1,48 @@
+import threading
+import pytest
+from app.utils.batch_utils import MicroBatcher
+
+def test_micro_batcher_groups_concurrent_requests():
+    batch_sizes = []
+
+    def predict_fn(items):
+        batch_sizes.append(len(items))
+        return [item * 2 for item in items]
+
+    batcher = MicroBatcher(predict_fn, max_batch_size=8, max_wait_ms=200)
+    results = {}
+    start = threading.Barrier(8)
+
+    def worker(value):
+        start.wait()
+        results[value] = batcher.predict(value, timeout=5)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == {i: i * 2 for i in range(8)}
+    assert sum(batch_sizes) == 8
+    assert len(batch_sizes) < 8
+
+def test_micro_batcher_respects_max_batch_size():
+    batch_sizes = []
+
+    def predict_fn(items):
+        batch_sizes.append(len(items))
+        return items
+
+    batcher = MicroBatcher(predict_fn, max_batch_size=2, max_wait_ms=50)
+    futures = [batcher.submit(i) for i in range(5)]
+    assert [future.result(timeout=5) for future in futures] == [0, 1, 2, 3, 4]
+    assert max(batch_sizes) <= 2
+
+def test_micro_batcher_propagates_errors():
+    def predict_fn(items):
+        raise ValueError("Test error")
+
+    batcher = MicroBatcher(predict_fn, max_batch_size=4, max_wait_ms=1)
+    with pytest.raises(ValueError):
+        batcher.predict('image', timeout=5)
@@ -6,8 +6,12 @@ from flask_jwt_extended import create_access_token
 from datetime import datetime
 
 @pytest.fixture
-def app():
-    app = create_app(TestingConfig)
+def app(tmp_path):
+    class Config(TestingConfig):
+        UPLOAD_FOLDER = str(tmp_path / 'uploads')
+        UPLOAD_SPOOL_FOLDER = str(tmp_path / 'spool')
+
+    app = create_app(Config)
     with app.app_context():
         db.create_all()
         yield app
@@ -65,6 +69,27 @@ def test_get_dashboard_overview(client, token):
     assert data['healthy_plants'] == 1
     assert data['diseased_plants'] == 1
 
+def test_get_dashboard_overview_health_categories(client, token):
+    user = User.query.first()
+    db.session.add_all([
+        Prediction(user_id=user.id, predicted_class='Corn___healthy'),
+        Prediction(user_id=user.id, predicted_class='Potato___Late_blight'),
+        Prediction(user_id=user.id, predicted_class='Unknown___Unexpected_input'),
+        Prediction(user_id=user.id + 1, predicted_class='Corn___Common_rust')
+    ])
+    db.session.commit()
+
+    # Unknown inputs count as predictions but neither healthy nor diseased
+    response = client.get('/dashboard/overview', headers={"Authorization": f"Bearer {token}"})
+    assert response.get_json() == {'predictions_made': 3, 'healthy_plants': 1, 'diseased_plants': 1}
+
+    # The counts follow the class when a prediction is corrected
+    prediction = Prediction.query.filter_by(predicted_class='Potato___Late_blight').first()
+    prediction.predicted_class = 'Potato___healthy'
+    db.session.commit()
+    response = client.get('/dashboard/overview', headers={"Authorization": f"Bearer {token}"})
+    assert response.get_json() == {'predictions_made': 3, 'healthy_plants': 2, 'diseased_plants': 0}
+
 def test_get_recent_activity(client, token):
     user = User.query.first()
     
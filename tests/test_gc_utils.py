@@ -0,0 +1,148 @@
+import datetime
+import os
+import pytest
+import time
+from app import create_app, db
+from app.commands import gc
+from app.config import TestingConfig
+from app.models import Blob, Image, Prediction
+from app.utils.gc_utils import collect_garbage
+from app.utils.storage_utils import get_storage, store_bytes, storage_key_for
+
+@pytest.fixture
+def app(tmp_path):
+    class Config(TestingConfig):
+        UPLOAD_FOLDER = str(tmp_path / 'uploads')
+        UPLOAD_GC_GRACE_PERIOD = 3600
+        UPLOAD_UNPREDICTED_RETENTION_DAYS = 30
+
+    app = create_app(Config)
+    with app.app_context():
+        db.create_all()
+        yield app
+        db.session.remove()
+        db.drop_all()
+
+DAYS_AGO = datetime.datetime.utcnow() - datetime.timedelta(days=60)
+
+def make_old(*paths):
+    old = time.time() - 7200
+    for path in paths:
+        os.utime(path, (old, old))
+
+def add_image(content, predicted=False, upload_date=DAYS_AGO):
+    image_path, content_hash = store_bytes(content, 'leaf.jpg')
+    image = Image(user_id=1, image_path=image_path, content_hash=content_hash, upload_date=upload_date)
+    db.session.add(image)
+    db.session.flush()
+    if predicted:
+        db.session.add(Prediction(user_id=1, image_id=image.id, predicted_class='Corn___healthy', confidence_percentage=90.0))
+    db.session.get(Blob, content_hash).create_date = DAYS_AGO
+    db.session.commit()
+    make_old(image_path)
+    return image
+
+def age_unreferenced():
+    # As if the grace period had passed since the blobs lost their last image
+    Blob.query.filter(Blob.ref_count <= 0).update({Blob.unreferenced_since: DAYS_AGO})
+    db.session.commit()
+
+def write_file(folder, name, content=b"leaf", old=True):
+    path = os.path.join(folder, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(content)
+    if old:
+        make_old(path)
+    return path
+
+def test_collect_garbage(app):
+    folder = app.config['UPLOAD_FOLDER']
+    kept = add_image(b"predicted leaf", predicted=True)
+    recent = add_image(b"recent leaf", upload_date=datetime.datetime.utcnow())
+    expired = add_image(b"forgotten leaf")
+    expired_path = expired.image_path
+    with open(expired_path[:-4] + '_thumbnail.jpg', 'wb') as f:
+        f.write(b"thumb")
+    make_old(expired_path[:-4] + '_thumbnail.jpg')
+
+    # A blob whose file vanished takes its unpredicted image along
+    vanished = add_image(b"vanished leaf", upload_date=datetime.datetime.utcnow() - datetime.timedelta(days=2))
+    os.remove(vanished.image_path)
+
+    # Files left by failed uploads: old ones go, an in-flight one stays
+    orphan = write_file(folder, storage_key_for('a' * 64, '.jpg'), b"x" * 1000)
+    in_flight = write_file(folder, storage_key_for('b' * 64, '.jpg'), old=False)
+
+    # Legacy flat uploads
+    legacy_kept = write_file(folder, 'legacy_kept.jpg')
+    legacy_orphan = write_file(folder, 'legacy_orphan.jpg', b"y" * 500)
+    db.session.add(Image(user_id=1, image_path=legacy_kept, upload_date=datetime.datetime.utcnow()))
+    two_days_ago = datetime.datetime.utcnow() - datetime.timedelta(days=2)
+    legacy_missing = Image(user_id=1, image_path=os.path.join(folder, 'gone.jpg'), upload_date=two_days_ago)
+    legacy_missing_predicted = Image(user_id=1, image_path=os.path.join(folder, 'gone_too.jpg'), upload_date=DAYS_AGO)
+    db.session.add_all([legacy_missing, legacy_missing_predicted])
+    db.session.flush()
+    db.session.add(Prediction(user_id=1, image_id=legacy_missing_predicted.id, predicted_class='Corn___healthy'))
+    db.session.commit()
+    ids = {'kept': kept.id, 'recent': recent.id, 'expired': expired.id, 'vanished': vanished.id, 'legacy_missing': legacy_missing.id}
+
+    # A dry run does not expire rows, so the blobs they would free are not counted
+    report = collect_garbage(batch_size=2, dry_run=True)
+    assert report.files_deleted == 2 and report.images_expired == 1
+    assert Image.query.count() == 7 and os.path.exists(orphan) and os.path.exists(legacy_orphan)
+
+    report = collect_garbage(batch_size=2)
+    assert report.images_expired == 1
+    assert report.orphan_images == 2  # the vanished blob's image and the missing legacy upload
+    assert report.missing_files == 1
+    # The orphan blob file and the legacy orphan; the expired image's blob has only just lost its image
+    assert report.files_deleted == 2
+    assert report.bytes_reclaimed == 1000 + 500
+    assert report.blobs_deleted == 0
+
+    remaining = {image.id for image in Image.query}
+    assert remaining == {ids['kept'], ids['recent'], legacy_missing_predicted.id} | {
+        image.id for image in Image.query.filter_by(image_path=legacy_kept)}
+    assert os.path.exists(expired_path) and not os.path.exists(orphan) and not os.path.exists(legacy_orphan)
+    assert os.path.exists(in_flight) and os.path.exists(legacy_kept)
+    assert all(os.path.exists(db.session.get(Image, ids[name]).image_path) for name in ('kept', 'recent'))
+    assert Blob.query.count() == 4
+
+    # Once the grace period has passed, the expired image's blob and thumbnail go, and the vanished blob's row
+    age_unreferenced()
+    report = collect_garbage()
+    assert report.blobs_deleted == 2 and report.files_deleted == 2
+    assert report.bytes_reclaimed == len(b"forgotten leaf") + len(b"thumb")
+    assert not os.path.exists(expired_path) and Blob.query.count() == 2
+
+def test_reused_blob_is_not_collected(app):
+    image = add_image(b"leaf uploaded twice")
+    content_hash = image.content_hash
+    db.session.delete(image)
+    db.session.commit()
+    age_unreferenced()
+
+    # An upload of the same content claims the blob before it sees the file and skips writing it.
+    # The claim is committed on its own, while the upload's transaction stays open.
+    image_path, _ = store_bytes(b"leaf uploaded twice", 'leaf.jpg')
+    db.session.rollback()
+    report = collect_garbage()
+    assert report.blobs_deleted == 0 and os.path.exists(image_path)
+
+    db.session.add(Image(user_id=1, image_path=image_path, content_hash=content_hash))
+    db.session.commit()
+    assert db.session.get(Blob, content_hash).ref_count == 1
+    assert db.session.get(Blob, content_hash).unreferenced_since is None
+
+def test_retention_deletes_predictions(app):
+    app.config['UPLOAD_RETENTION_DAYS'] = 30
+    image = add_image(b"old predicted leaf", predicted=True)
+    result = app.test_cli_runner().invoke(gc, ['--batch-size', '10'])
+    assert result.exit_code == 0, result.output
+    assert '1 prediction(s)' in result.output
+    assert Image.query.count() == 0 and Prediction.query.count() == 0
+    age_unreferenced()
+    result = app.test_cli_runner().invoke(gc, ['--batch-size', '10'])
+    assert 'Deleted 1 file(s)' in result.output
+    assert not get_storage().exists(storage_key_for(image.content_hash, '.jpg'))
@@ -1,14 +1,20 @@
 import pytest
 from app import create_app, db
-from app.models import Prediction, Image
+from app.models import Prediction, Image, User
 from app.config import TestingConfig
 from flask_jwt_extended import create_access_token
-from io import BytesIO
+from io import BytesIO, StringIO
 from datetime import datetime
+import csv
+import json
 
 @pytest.fixture
-def app():
-    app = create_app(TestingConfig)
+def app(tmp_path):
+    class Config(TestingConfig):
+        UPLOAD_FOLDER = str(tmp_path / 'uploads')
+        UPLOAD_SPOOL_FOLDER = str(tmp_path / 'spool')
+
+    app = create_app(Config)
     with app.app_context():
         db.create_all()
         # Add some sample data
@@ -50,7 +56,7 @@ def token(client):
 def test_view_prediction_history_success(client, token):
     response = client.get('/history/view_prediction_history?start_date=2024-07-15&end_date=2024-07-17', headers={"Authorization": f"Bearer {token}"})
     assert response.status_code == 200
-    response_data = response.get_json()
+    response_data = response.get_json()['predictions']
 
     # Sort the response data by prediction_date
     response_data.sort(key=lambda x: x['prediction_date'])
@@ -63,6 +69,78 @@ def test_view_prediction_history_success(client, token):
     assert response_data[0]['predicted_class'] == 'Tomato Leaf Spot'
     assert response_data[1]['predicted_class'] == 'Tomato Early Blight'
 
+def test_view_prediction_history_pages(client, token):
+    # Two more on the same date as an existing one: ties are broken by id
+    image = Image.query.first()
+    for predicted_class in ('Tomato Healthy', 'Tomato Mosaic'):
+        db.session.add(Prediction(user_id=1, image_id=image.id, predicted_class=predicted_class,
+                                  confidence_percentage=90.0, prediction_date=datetime(2024, 7, 16, 10, 0, 0)))
+    db.session.add(Prediction(user_id=2, image_id=image.id, predicted_class='Other User', prediction_date=datetime(2024, 7, 16)))
+    db.session.commit()
+
+    seen = []
+    cursor = None
+    pages = 0
+    while True:
+        query_string = {'limit': 2}
+        if cursor:
+            query_string['cursor'] = cursor
+        response = client.get('/history/view_prediction_history', query_string=query_string, headers={"Authorization": f"Bearer {token}"})
+        assert response.status_code == 200
+        data = response.get_json()
+        assert len(data['predictions']) <= 2
+        seen.extend(data['predictions'])
+        pages += 1
+        cursor = data['next_cursor']
+        if cursor is None:
+            break
+
+    assert pages == 2
+    assert len({p['id'] for p in seen}) == len(seen) == 4
+    assert [p['predicted_class'] for p in seen] == ['Tomato Mosaic', 'Tomato Healthy', 'Tomato Early Blight', 'Tomato Leaf Spot']
+
+def test_view_prediction_history_pages_through_undated_predictions(client, token):
+    # Undated rows come last, newest id first, and can end a page
+    image = Image.query.first()
+    undated = [Prediction(user_id=1, image_id=image.id, predicted_class=f'Undated {i}') for i in range(3)]
+    db.session.add_all(undated)
+    db.session.flush()
+    for prediction in undated:
+        prediction.prediction_date = None
+    db.session.commit()
+
+    seen = []
+    cursor = None
+    while True:
+        query_string = {'limit': 2, 'cursor': cursor} if cursor else {'limit': 2}
+        response = client.get('/history/view_prediction_history', query_string=query_string, headers={"Authorization": f"Bearer {token}"})
+        assert response.status_code == 200, f"Response: {response.data}"
+        data = response.get_json()
+        seen.extend(p['predicted_class'] for p in data['predictions'])
+        cursor = data['next_cursor']
+        if cursor is None:
+            break
+
+    assert seen == ['Tomato Early Blight', 'Tomato Leaf Spot', 'Undated 2', 'Undated 1', 'Undated 0']
+
+def test_view_prediction_history_page_within_date_range(client, token):
+    response = client.get('/history/view_prediction_history?start_date=2024-07-15&end_date=2024-07-17&limit=1', headers={"Authorization": f"Bearer {token}"})
+    data = response.get_json()
+    assert [p['predicted_class'] for p in data['predictions']] == ['Tomato Early Blight']
+
+    response = client.get('/history/view_prediction_history', query_string={
+        'start_date': '2024-07-15', 'end_date': '2024-07-17', 'limit': 1, 'cursor': data['next_cursor']
+    }, headers={"Authorization": f"Bearer {token}"})
+    data = response.get_json()
+    assert [p['predicted_class'] for p in data['predictions']] == ['Tomato Leaf Spot']
+    assert data['next_cursor'] is None
+
+def test_view_prediction_history_invalid_page(client, token):
+    response = client.get('/history/view_prediction_history?cursor=not-a-cursor', headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == 400
+    response = client.get('/history/view_prediction_history?limit=0', headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == 400
+
 def test_download_prediction_history_pdf_success(client, token):
     response = client.get('/history/download_prediction_history_pdf?start_date=2024-07-15&end_date=2024-07-17', headers={"Authorization": f"Bearer {token}"})
     assert response.status_code == 200
@@ -74,7 +152,7 @@ def test_view_prediction_history_no_records(client, token):
     response = client.get('/history/view_prediction_history?start_date=2024-07-01&end_date=2024-07-10', headers={"Authorization": f"Bearer {token}"})
     assert response.status_code == 200
     response_data = response.get_json()
-    assert response_data == []
+    assert response_data == {'predictions': [], 'next_cursor': None}
 
 def test_download_prediction_history_pdf_no_records(client, token):
     response = client.get('/history/download_prediction_history_pdf?start_date=2024-07-01&end_date=2024-07-10', headers={"Authorization": f"Bearer {token}"})
@@ -82,3 +160,56 @@ def test_download_prediction_history_pdf_no_records(client, token):
     assert response.headers['Content-Type'] == 'application/pdf'
     assert response.headers['Content-Disposition'] == 'attachment; filename=prediction_history.pdf'
     assert isinstance(BytesIO(response.data), BytesIO)  # Corrected to check if response.data is a BytesIO object
+
+def test_export_prediction_history_ndjson(app, client, token):
+    db.session.add(Prediction(user_id=2, image_id=1, predicted_class='Other User', prediction_date=datetime(2024, 7, 16)))
+    db.session.commit()
+    app.config['EXPORT_BATCH_SIZE'] = 1
+
+    response = client.get('/history/export', headers={"Authorization": f"Bearer {token}"}, buffered=False)
+    assert response.status_code == 200
+    assert response.is_streamed
+    assert response.mimetype == 'application/x-ndjson'
+    assert response.headers['Content-Disposition'] == 'attachment; filename=prediction_history.ndjson'
+    # One chunk per batch fetched from the cursor
+    chunks = list(response.response)
+    assert len(chunks) == 2
+
+    rows = [json.loads(line) for line in b''.join(chunks).decode().splitlines()]
+    assert [row['predicted_class'] for row in rows] == ['Tomato Early Blight', 'Tomato Leaf Spot']
+    assert rows[0]['prediction_date'] == '2024-07-16T10:00:00'
+    assert rows[0]['image_url'].startswith('http://localhost/static/uploads/')
+    assert {row['user_id'] for row in rows} == {1}
+
+def test_export_prediction_history_csv(client, token):
+    response = client.get('/history/export?format=csv&start_date=2024-07-16', headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == 200
+    assert response.mimetype == 'text/csv'
+    rows = list(csv.DictReader(StringIO(response.get_data(as_text=True))))
+    assert len(rows) == 1
+    assert rows[0]['predicted_class'] == 'Tomato Early Blight'
+    assert rows[0]['confidence_percentage'] == '75.0'
+
+def test_export_prediction_history_csv_empty(client, token):
+    response = client.get('/history/export?format=csv&start_date=2025-01-01', headers={"Authorization": f"Bearer {token}"})
+    assert response.get_data(as_text=True).strip() == 'id,user_id,image_id,predicted_class,confidence_percentage,prediction_date,image_url'
+
+def test_export_all_predictions_requires_admin(app, client, token):
+    db.session.add(User(id=1, email='Grower@Example.com'))
+    db.session.add(Prediction(user_id=2, image_id=1, predicted_class='Other User', prediction_date=datetime(2024, 7, 16)))
+    db.session.commit()
+
+    response = client.get('/history/export?scope=all', headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == 403
+
+    app.config['ADMIN_EMAILS'] = ['grower@example.com']
+    response = client.get('/history/export?scope=all', headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == 200
+    rows = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert [row['user_id'] for row in rows] == [1, 1, 2]
+
+def test_export_prediction_history_invalid_arguments(client, token):
+    headers = {"Authorization": f"Bearer {token}"}
+    assert client.get('/history/export?format=xml', headers=headers).status_code == 400
+    assert client.get('/history/export?scope=everyone', headers=headers).status_code == 400
+    assert client.get('/history/export?start_date=16-07-2024', headers=headers).status_code == 400
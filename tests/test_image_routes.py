@@ -1,15 +1,22 @@
+import hashlib
 import pytest
 import io
 import os
 from app import create_app, db
 from app.models import Image
+from app.utils.storage_utils import upload_url_path
 from app.config import TestingConfig
 from flask_jwt_extended import create_access_token
 import tempfile
+from PIL import Image as PILImage
 
 @pytest.fixture
-def app():
-    app = create_app(TestingConfig)
+def app(tmp_path):
+    class Config(TestingConfig):
+        UPLOAD_FOLDER = str(tmp_path / 'uploads')
+        UPLOAD_SPOOL_FOLDER = str(tmp_path / 'spool')
+
+    app = create_app(Config)
     with app.app_context():
         db.create_all()
         yield app
@@ -25,9 +32,14 @@ def token(client):
     access_token = create_access_token(identity={'id': 1})
     return access_token
 
+def leaf_photo(color=(40, 160, 60), size=(64, 48)):
+    buffer = io.BytesIO()
+    PILImage.new('RGB', size, color).save(buffer, format='JPEG')
+    return buffer.getvalue()
+
 @pytest.fixture
 def image_file():
-    file = io.BytesIO(b"fake image content")
+    file = io.BytesIO(leaf_photo())
     file.name = 'test_image.jpg'
     return file
 
@@ -65,7 +77,234 @@ def test_upload_image_failure(client, token, monkeypatch):
 
     response = client.post('/image/upload_image', headers={"Authorization": f"Bearer {token}"}, 
                            content_type='multipart/form-data',
-                           data={'image': (io.BytesIO(b"fake image content"), 'test_image.jpg')})
+                           data={'image': (io.BytesIO(leaf_photo()), 'test_image.jpg')})
     assert response.status_code == 500, f"Response: {response.data}"
     assert response.get_json()['message'] == 'Image upload failed'
     assert 'error' in response.get_json()
+
+def test_upload_image_creates_variants(client, token):
+    buffer = io.BytesIO()
+    PILImage.new('RGB', (1200, 900), (40, 160, 60)).save(buffer, format='JPEG')
+    response = client.post('/image/upload_image', headers={"Authorization": f"Bearer {token}"},
+                           content_type='multipart/form-data',
+                           data={'image': (io.BytesIO(buffer.getvalue()), 'leaf.jpg')})
+    assert response.status_code == 201, f"Response: {response.data}"
+
+    image_record = db.session.get(Image, response.get_json()['image_id'])
+    assert os.path.isfile(image_record.thumbnail_path)
+    assert os.path.isfile(image_record.web_path)
+
+    filename = upload_url_path(image_record.image_path)
+    thumbnail = client.get(f'/static/uploads/{filename}?variant=thumbnail')
+    assert thumbnail.status_code == 200
+    assert PILImage.open(io.BytesIO(thumbnail.data)).size == (150, 113)
+    assert len(thumbnail.data) < len(client.get(f'/static/uploads/{filename}').data)
+
+    assert client.get(f'/static/uploads/{filename}?variant=huge').status_code == 400
+
+def test_variant_falls_back_to_original(client, token, monkeypatch):
+    # Variants not created yet
+    monkeypatch.setattr('app.routes.image_routes.schedule_derivatives', lambda image_records: None)
+    photo = leaf_photo((10, 90, 20))
+    response = client.post('/image/upload_image', headers={"Authorization": f"Bearer {token}"},
+                           content_type='multipart/form-data',
+                           data={'image': (io.BytesIO(photo), 'test_image.jpg')})
+    image_record = db.session.get(Image, response.get_json()['image_id'])
+    assert image_record.thumbnail_path is None
+
+    filename = upload_url_path(image_record.image_path)
+    response = client.get(f'/static/uploads/{filename}?variant=thumbnail')
+    assert response.status_code == 200
+    assert response.data == photo
+
+def post_image(client, token, content, filename='leaf.jpg'):
+    return client.post('/image/upload_image', headers={"Authorization": f"Bearer {token}"},
+                       content_type='multipart/form-data',
+                       data={'image': (io.BytesIO(content), filename)})
+
+def test_upload_rejects_non_images_and_oversized_files(app, client, token):
+    response = post_image(client, token, b"%PDF-1.7 not a leaf" * 100, 'leaf.jpg')
+    assert response.status_code == 415, f"Response: {response.data}"
+    assert post_image(client, token, leaf_photo()[:20]).status_code == 400
+
+    app.config['UPLOAD_MAX_PIXELS'] = 1000
+    response = post_image(client, token, leaf_photo(size=(64, 48)))
+    assert response.status_code == 413 and '64x48' in response.get_json()['message']
+
+    app.config['UPLOAD_MAX_PIXELS'] = None
+    app.config['UPLOAD_MAX_BYTES'] = 500
+    assert post_image(client, token, leaf_photo(size=(400, 300))).status_code == 413
+
+    # Refused from Content-Length, before the body is read
+    app.config['MAX_CONTENT_LENGTH'] = 1000
+    assert post_image(client, token, leaf_photo(size=(400, 300))).status_code == 413
+
+    assert Image.query.count() == 0
+    assert not os.listdir(os.path.join(app.config['UPLOAD_FOLDER'], '.incoming'))
+
+def test_incoming_upload_checks_first_chunk(tmp_path):
+    from app.utils.upload_utils import IncomingUpload, UploadRejected
+
+    # A non-image is refused on its first chunk
+    upload = IncomingUpload(str(tmp_path / 'spool'))
+    with pytest.raises(UploadRejected) as error:
+        upload.write(b"MZ\x90\x00 executable" + b"\x00" * 64 * 1024)
+    assert error.value.status_code == 415 and os.path.getsize(upload.path) == 0
+    upload.discard()
+
+    # The PNG header alone gives away the size of a 40 megapixel image
+    png = io.BytesIO()
+    PILImage.new('RGB', (8000, 5000)).save(png, format='PNG')
+    upload = IncomingUpload(str(tmp_path / 'spool'), max_pixels=100_000)
+    with pytest.raises(UploadRejected) as error:
+        upload.write(png.getvalue()[:4096])
+    assert error.value.status_code == 413 and upload.dimensions == (8000, 5000)
+    upload.discard()
+    assert not os.path.exists(tmp_path / 'spool')
+
+    # Accepted files are hashed as they are written
+    photo = leaf_photo()
+    upload = IncomingUpload(str(tmp_path / 'spool'))
+    for i in range(0, len(photo), 5):
+        upload.write(photo[i:i + 5])
+    upload.finish()
+    assert upload.image_format == 'JPEG' and upload.dimensions == (64, 48)
+    assert upload.content_hash == hashlib.sha256(photo).hexdigest()
+    assert upload.read() == photo
+    upload.discard()
+
+def test_chunked_upload_resumes_after_dropped_connection(app, client, token):
+    headers = {"Authorization": f"Bearer {token}"}
+    photo = leaf_photo((30, 120, 70), size=(640, 480))
+    response = client.post('/image/uploads', headers=headers, json={'filename': 'leaf.jpg', 'length': len(photo)})
+    assert response.status_code == 201, f"Response: {response.data}"
+    upload_id = response.get_json()['upload_id']
+    assert response.headers['Location'] == f'/image/uploads/{upload_id}'
+
+    # The connection drops after 1000 bytes of the first chunk; what arrived is kept
+    response = client.patch(f'/image/uploads/{upload_id}', headers={**headers, 'Upload-Offset': '0'},
+                            input_stream=io.BytesIO(photo[:1000]), environ_overrides={'CONTENT_LENGTH': str(len(photo))})
+    assert response.status_code == 400
+    response = client.head(f'/image/uploads/{upload_id}', headers=headers)
+    assert response.headers['Upload-Offset'] == '1000'
+    assert client.post(f'/image/uploads/{upload_id}/finalize', headers=headers).status_code == 409
+
+    # A chunk sent from the wrong offset is refused with the right one
+    response = client.patch(f'/image/uploads/{upload_id}', headers={**headers, 'Upload-Offset': '0'}, data=photo)
+    assert response.status_code == 409 and response.headers['Upload-Offset'] == '1000'
+
+    response = client.patch(f'/image/uploads/{upload_id}', headers={**headers, 'Upload-Offset': '1000'}, data=photo[1000:])
+    assert response.status_code == 200 and response.get_json()['offset'] == len(photo)
+
+    response = client.post(f'/image/uploads/{upload_id}/finalize', headers=headers)
+    assert response.status_code == 201, f"Response: {response.data}"
+    image_record = db.session.get(Image, response.get_json()['image_id'])
+    with open(image_record.image_path, 'rb') as f:
+        assert f.read() == photo
+    assert image_record.thumbnail_path is not None
+    assert client.get(f'/image/uploads/{upload_id}', headers=headers).status_code == 404
+
+def test_chunked_upload_finalized_once(app, client, token, monkeypatch):
+    from app.utils import upload_utils
+
+    headers = {"Authorization": f"Bearer {token}"}
+    photo = leaf_photo()
+    upload_id = client.post('/image/uploads', headers=headers, json={'filename': 'leaf.jpg', 'length': len(photo)}).get_json()['upload_id']
+    client.patch(f'/image/uploads/{upload_id}', headers={**headers, 'Upload-Offset': '0'}, data=photo)
+
+    # A second finalize arriving while the first stores the file is refused, and so is one after it
+    file_incoming = upload_utils.file_incoming
+    concurrent = []
+    def store_with_concurrent_finalize(*args):
+        concurrent.append(client.post(f'/image/uploads/{upload_id}/finalize', headers=headers).status_code)
+        # A retried last chunk is refused with the offset seen under the lock, not read again after the store
+        response = client.patch(f'/image/uploads/{upload_id}', headers={**headers, 'Upload-Offset': '0'}, data=photo)
+        concurrent.append((response.status_code, response.headers['Upload-Offset']))
+        return file_incoming(*args)
+    monkeypatch.setattr(upload_utils, 'file_incoming', store_with_concurrent_finalize)
+    upload = upload_utils.ChunkedUpload.load(upload_id)
+    assert client.post(f'/image/uploads/{upload_id}/finalize', headers=headers).status_code == 201
+    assert concurrent == [409, (409, str(len(photo)))]
+    with pytest.raises(upload_utils.UploadRejected) as e:
+        upload.store()
+    assert e.value.status_code == 404
+    assert Image.query.count() == 1
+
+def test_chunked_upload_rejections(app, client, token):
+    headers = {"Authorization": f"Bearer {token}"}
+    photo = leaf_photo()
+    assert client.post('/image/uploads', headers=headers, json={'filename': 'leaf.jpg'}).status_code == 400
+    app.config['UPLOAD_MAX_BYTES'] = 100
+    assert client.post('/image/uploads', headers=headers, json={'filename': 'leaf.jpg', 'length': 101}).status_code == 413
+    app.config['UPLOAD_MAX_BYTES'] = None
+
+    upload_id = client.post('/image/uploads', headers=headers, json={'filename': 'leaf.jpg', 'length': 100}).get_json()['upload_id']
+    # Not the owner
+    other = create_access_token(identity={'id': 2})
+    assert client.get(f'/image/uploads/{upload_id}', headers={"Authorization": f"Bearer {other}"}).status_code == 404
+    assert client.patch(f'/image/uploads/{upload_id}', headers=headers, data=photo[:10]).status_code == 400
+    response = client.patch(f'/image/uploads/{upload_id}', headers={**headers, 'Upload-Offset': '0'}, data=photo[:101])
+    assert response.status_code == 413
+    # A non-image is dropped as soon as its signature is in
+    response = client.patch(f'/image/uploads/{upload_id}', headers={**headers, 'Upload-Offset': '0'}, data=b"%PDF-1.7 document")
+    assert response.status_code == 415
+    assert client.get(f'/image/uploads/{upload_id}', headers=headers).status_code == 404
+
+def test_abandoned_chunked_uploads_expire(app, client, token):
+    from app.commands import expire_partial
+    from app.utils.upload_utils import ChunkedUpload
+
+    headers = {"Authorization": f"Bearer {token}"}
+    stale = ChunkedUpload.create(1, 'leaf.jpg', 500)
+    fresh = ChunkedUpload.create(1, 'leaf.jpg', 500)
+    for path in (stale.part_path, stale.metadata_path):
+        os.utime(path, (0, 0))
+
+    result = app.test_cli_runner().invoke(expire_partial)
+    assert 'Removed 1 abandoned upload(s)' in result.output
+    assert client.get(f'/image/uploads/{stale.id}', headers=headers).status_code == 404
+    assert client.get(f'/image/uploads/{fresh.id}', headers=headers).status_code == 200
+    assert client.delete(f'/image/uploads/{fresh.id}', headers=headers).status_code == 200
+    assert ChunkedUpload.load(fresh.id) is None
+
+def test_upload_serving_caching_and_ranges(app, client, token):
+    photo = leaf_photo((60, 140, 90), size=(320, 240))
+    image_path = post_image(client, token, photo).get_json()['file_path']
+    url = f'/static/uploads/{upload_url_path(image_path)}'
+    content_hash = os.path.basename(image_path).split('.')[0]
+
+    response = client.get(url)
+    assert response.status_code == 200 and response.data == photo
+    assert response.headers['ETag'] == f'"{content_hash}"'
+    assert response.cache_control.immutable and response.cache_control.max_age == 365 * 24 * 3600
+    response.close()
+
+    assert client.get(url, headers={'If-None-Match': f'"{content_hash}"'}).status_code == 304
+    response = client.get(url, headers={'Range': 'bytes=0-99'})
+    assert response.status_code == 206 and response.data == photo[:100]
+    response.close()
+
+    thumbnail = client.get(f'{url}?variant=thumbnail')
+    assert thumbnail.headers['ETag'] == f'"{content_hash}-thumbnail"'
+    thumbnail.close()
+
+    # The front web server sends the bytes
+    app.config['UPLOAD_SENDFILE'] = 'x-accel-redirect'
+    response = client.get(url)
+    assert response.headers['X-Accel-Redirect'] == f'/protected-uploads/{upload_url_path(image_path)}'
+    assert response.data == b'' and response.mimetype == 'image/jpeg'
+    app.config['UPLOAD_SENDFILE'] = 'x-sendfile'
+    response = client.get(url)
+    assert response.headers['X-Sendfile'] == image_path and response.data == b''
+
+def test_legacy_upload_etag_comes_from_content(app, client):
+    folder = app.config['UPLOAD_FOLDER']
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, 'legacy_leaf.jpg'), 'wb') as f:
+        f.write(b"legacy leaf")
+
+    response = client.get('/static/uploads/legacy_leaf.jpg')
+    assert response.headers['ETag'] == '"' + hashlib.sha256(b"legacy leaf").hexdigest() + '"'
+    assert response.cache_control.no_cache and not response.cache_control.immutable
+    response.close()
+    os.remove(os.path.join(folder, 'legacy_leaf.jpg'))
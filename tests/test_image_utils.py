@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+from PIL import Image as PILImage
+from app import create_app
+from app.config import TestingConfig
+from app.utils.image_utils import create_derivatives, image_file_for, variant_filename
+
+@pytest.fixture
+def app(tmp_path):
+    class Config(TestingConfig):
+        UPLOAD_FOLDER = str(tmp_path)
+
+    app = create_app(Config)
+    with app.app_context():
+        yield app
+
+def write_rotated_photo(path, width=1600, height=1200):
+    # Stored landscape with orientation 6: cameras write this for portrait shots
+    pixels = np.zeros((height, width, 3), dtype=np.uint8)
+    pixels[:, :width // 2] = (200, 30, 30)
+    pixels[:, width // 2:] = (30, 200, 30)
+    exif = PILImage.Exif()
+    exif[0x0112] = 6
+    exif[0x010F] = 'PhoneMaker'
+    PILImage.fromarray(pixels).save(path, format='JPEG', exif=exif.tobytes())
+
+def test_create_derivatives_orients_and_strips_exif(app, tmp_path):
+    original = tmp_path / 'abc_leaf.jpg'
+    write_rotated_photo(original)
+    original_bytes = original.read_bytes()
+
+    paths = create_derivatives(str(original), thumbnail_size=150, web_size=1024)
+
+    assert paths['thumbnail'] == str(tmp_path / 'abc_leaf_thumbnail.jpg')
+    with PILImage.open(paths['web']) as web:
+        assert web.size == (768, 1024)  # upright portrait
+        assert not web.getexif()
+    with PILImage.open(paths['thumbnail']) as thumbnail:
+        assert thumbnail.size[1] == 150 and thumbnail.size[0] < thumbnail.size[1]
+        assert not thumbnail.getexif()
+        # After rotating a quarter turn clockwise the red half is on top
+        assert thumbnail.getpixel((56, 10))[0] > 150 and thumbnail.getpixel((56, 140))[1] > 150
+
+    assert original.read_bytes() == original_bytes
+
+def test_variant_filename_and_fallback(app, tmp_path):
+    assert variant_filename('abc_leaf.jpeg', 'web') == 'abc_leaf_web.jpg'
+    original = tmp_path / 'leaf.jpg'
+    thumbnail = tmp_path / 'leaf_thumbnail.jpg'
+    assert image_file_for(str(original), str(thumbnail)) == str(original)
+    thumbnail.write_bytes(b'jpeg')
+    assert image_file_for(str(original), str(thumbnail)) == str(thumbnail)
+    assert image_file_for(str(original), None) == str(original)
@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+from app.utils.inference_backends import create_backend, convert_model, compare_backends
+
+@pytest.fixture(scope='module')
+def keras_model_path(tmp_path_factory):
+    tf = pytest.importorskip('tensorflow')
+    model = tf.keras.Sequential([
+        tf.keras.Input((256, 256, 3)),
+        tf.keras.layers.Rescaling(1 / 255.0),
+        tf.keras.layers.Conv2D(4, 3, strides=4, activation='relu'),
+        tf.keras.layers.GlobalAveragePooling2D(),
+        tf.keras.layers.Dense(10, activation='softmax')
+    ])
+    path = tmp_path_factory.mktemp('model') / 'model.keras'
+    model.save(path)
+    return str(path)
+
+@pytest.fixture(scope='module')
+def sample_batches():
+    rng = np.random.default_rng(0)
+    return [rng.uniform(0, 255, size=(4, 256, 256, 3)).astype(np.float32) for _ in range(2)]
+
+def test_create_backend_unknown_name():
+    with pytest.raises(ValueError):
+        create_backend('caffe', 'model.caffemodel')
+
+@pytest.mark.parametrize('quantization', [None, 'float16', 'int8'])
+def test_tflite_backend_matches_keras(keras_model_path, sample_batches, tmp_path, quantization):
+    output_path = str(tmp_path / 'model.tflite')
+    convert_model(keras_model_path, output_path, 'tflite', quantization=quantization, sample_batches=sample_batches)
+
+    reference = create_backend('keras', keras_model_path)
+    candidate = create_backend('tflite', output_path, num_threads=1)
+    report = compare_backends(reference, candidate, sample_batches)
+
+    assert report['images'] == 8
+    assert report['max_abs_diff'] < (0.05 if quantization == 'int8' else 0.01)
+
+def test_tflite_int8_requires_calibration_images(keras_model_path, tmp_path):
+    with pytest.raises(ValueError):
+        convert_model(keras_model_path, str(tmp_path / 'model.tflite'), 'tflite', quantization='int8')
@@ -0,0 +1,82 @@
+import queue
+import numpy as np
+import pytest
+from app.utils.inference_pool import ImageDecodeError, InferenceError, InferencePool, InferencePoolBusy, InferencePoolTimeout, serve_requests
+
+class MockBackend:
+    def __init__(self):
+        self.batch_sizes = []
+
+    def predict(self, batch):
+        self.batch_sizes.append(len(batch))
+        probabilities = np.zeros((len(batch), 10), dtype=np.float32)
+        probabilities[:, 3] = 0.9
+        return probabilities
+
+def test_serve_requests_batches_queued_images(monkeypatch):
+    def mock_preprocess_image(image_path, out=None, backend=None):
+        assert backend == 'pillow'
+        if image_path == 'broken.jpg':
+            raise ValueError("Cannot decode")
+        return np.zeros((256, 256, 3), dtype=np.float32)
+
+    monkeypatch.setattr('app.utils.model_utils.preprocess_image', mock_preprocess_image)
+
+    requests, results = queue.Queue(), queue.Queue()
+    for request_id, image_path in enumerate(['a.jpg', 'broken.jpg', 'b.jpg']):
+        requests.put((request_id, image_path))
+    requests.put(None)
+
+    backend = MockBackend()
+    serve_requests(backend, requests, results, max_batch_size=8, max_wait_ms=10, preprocessing_backend='pillow', worker_index=0)
+
+    assert results.get() == (None, 0, [0, 1, 2])  # the batch is announced before work starts
+    responses = {}
+    while not results.empty():
+        request_id, result, error = results.get()
+        responses[request_id] = (result, error)
+
+    assert backend.batch_sizes == [2]
+    assert responses[0][1] is None and responses[2][1] is None
+    assert np.argmax(responses[0][0]) == 3 and np.argmax(responses[2][0]) == 3
+    assert responses[1][0] is None and isinstance(responses[1][1], ImageDecodeError) and 'Cannot decode' in str(responses[1][1])
+
+def test_inference_pool_applies_back_pressure():
+    pool = InferencePool(1, 'keras', 'model.keras', queue_size=1, submit_timeout=0.05, start=False)
+    pool.submit('a.jpg')
+    with pytest.raises(InferencePoolBusy):
+        pool.submit('b.jpg')
+
+def test_inference_pool_forgets_timed_out_requests():
+    pool = InferencePool(1, 'keras', 'model.keras', start=False)
+    with pytest.raises(InferencePoolTimeout):
+        pool.predict('a.jpg', timeout=0.01)
+    assert pool._futures == {}
+
+class DeadProcess:
+    name = 'inference-worker-0'
+    exitcode = -9
+
+    def is_alive(self):
+        return False
+
+def test_inference_pool_replaces_dead_workers(monkeypatch):
+    pool = InferencePool(1, 'keras', 'model.keras', start=False)
+    started = []
+    monkeypatch.setattr(pool, '_new_worker', lambda index: type('Worker', (), {'start': lambda self: started.append(index)})())
+    lost, waiting = pool.submit('a.jpg'), pool.submit('b.jpg')
+    pool._processes[0] = DeadProcess()
+    pool._taken[0] = [lost.request_id]
+
+    pool._replace_dead_workers()
+    assert started == [0]
+    with pytest.raises(InferenceError, match='exited with code -9'):
+        lost.result(timeout=0)
+    assert not waiting.done() and list(pool._futures) == [waiting.request_id]
+
+def test_inference_pool_fails_fast_without_workers():
+    pool = InferencePool(1, 'keras', 'model.keras', start=False)
+    pool._started = True
+    pool._processes[0] = DeadProcess()
+    with pytest.raises(InferencePoolBusy, match='No inference worker'):
+        pool.submit('a.jpg')
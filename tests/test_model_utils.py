@@ -0,0 +1,90 @@
+import threading
+import numpy as np
+import pytest
+from app.utils import model_utils
+from app.utils.inference_pool import InferenceError
+
+def test_predict_images_runs_real_batches(monkeypatch):
+    batch_sizes = []
+
+    def mock_preprocess_image(image_path):
+        if image_path == 'broken.jpg':
+            raise ValueError("Cannot decode")
+        return np.zeros((256, 256, 3), dtype=np.float32)
+
+    def mock_predict_batch(images):
+        batch_sizes.append(len(images))
+        return [('Corn___healthy', 90.0)] * len(images)
+
+    monkeypatch.setattr(model_utils, 'preprocess_image', mock_preprocess_image)
+    monkeypatch.setattr(model_utils, 'predict_batch', mock_predict_batch)
+    monkeypatch.setattr(model_utils, 'get_setting', lambda name, default=None: {'INFERENCE_BATCH_SIZE': 2}.get(name, default))
+
+    results = model_utils.predict_images(['a.jpg', 'broken.jpg', 'b.jpg', 'c.jpg', 'd.jpg'])
+    assert results[1] == model_utils.FALLBACK_PREDICTION
+    assert results[0] == results[2] == results[3] == results[4] == ('Corn___healthy', 90.0)
+    assert batch_sizes == [1, 2, 1]
+
+def test_inference_failures_raise_instead_of_falling_back(monkeypatch):
+    def mock_predict_batch(images):
+        raise RuntimeError("Out of memory")
+
+    monkeypatch.setattr(model_utils, 'preprocess_image', lambda image_path, out=None: np.zeros((256, 256, 3), dtype=np.float32))
+    monkeypatch.setattr(model_utils, 'predict_batch', mock_predict_batch)
+    monkeypatch.setattr(model_utils, '_backend', object())
+    monkeypatch.setattr(model_utils, 'get_setting', lambda name, default=None: {'INFERENCE_BATCHING': False}.get(name, default))
+
+    with pytest.raises(InferenceError, match='Out of memory'):
+        model_utils.predict_images(['a.jpg', 'b.jpg'])
+    with pytest.raises(InferenceError, match='Out of memory'):
+        model_utils.predict_disease(b'image bytes')
+
+def test_model_is_loaded_lazily_once(monkeypatch):
+    loaded = []
+
+    def mock_create_backend(name, model_path, num_threads=None):
+        loaded.append((name, model_path))
+        return object()
+
+    settings = {'INFERENCE_BACKEND': 'tflite', 'TFLITE_MODEL_PATH': '/models/test.tflite'}
+    monkeypatch.setattr(model_utils, '_backend', None)
+    monkeypatch.setattr(model_utils, 'create_backend', mock_create_backend)
+    monkeypatch.setattr(model_utils, 'get_setting', lambda name, default=None: settings.get(name, default))
+
+    threads = [threading.Thread(target=model_utils.get_backend) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert loaded == [('tflite', '/models/test.tflite')]
+    assert model_utils.get_backend() is model_utils._backend
+
+def test_warm_up_model_runs_dummy_forward_pass(monkeypatch):
+    class MockModel:
+        def __init__(self):
+            self.shapes = []
+
+        def predict(self, batch):
+            self.shapes.append(batch.shape)
+            return np.full((len(batch), len(model_utils.CLASS_NAMES)), 0.1)
+
+    mock_model = MockModel()
+    monkeypatch.setattr(model_utils, '_backend', mock_model)
+    model_utils.warm_up_model()
+    assert mock_model.shapes == [(1, 256, 256, 3)]
+
+def test_prediction_result_keeps_probability_vector():
+    probabilities = np.array([0.05, 0.7, 0.2, 0.05, 0, 0, 0, 0, 0, 0], dtype=np.float32)
+    result = model_utils.summarize_predictions([probabilities])[0]
+
+    predicted_class, confidence_percentage = result
+    assert (predicted_class, confidence_percentage) == ('Corn___Gray_leaf_spot', 70.0)
+    assert result == ('Corn___Gray_leaf_spot', 70.0)
+
+    top_k = model_utils.top_k_predictions(result.probabilities, 2)
+    assert [p['predicted_class'] for p in top_k] == ['Corn___Gray_leaf_spot', 'Corn___Northern_Leaf_Blight']
+
+    blob = model_utils.pack_probabilities(result.probabilities)
+    assert len(blob) == 2 * len(model_utils.CLASS_NAMES)
+    np.testing.assert_allclose(model_utils.unpack_probabilities(blob), probabilities, atol=1e-3)
@@ -1,14 +1,22 @@
 import pytest
 import io
+import os
 from app import create_app, db
 from app.models import Image, Prediction
 from app.config import TestingConfig
 from flask_jwt_extended import create_access_token
+import numpy as np
 import tempfile
+import threading
+from PIL import Image as PILImage
 
 @pytest.fixture
-def app():
-    app = create_app(TestingConfig)
+def app(tmp_path):
+    class Config(TestingConfig):
+        UPLOAD_FOLDER = str(tmp_path / 'uploads')
+        UPLOAD_SPOOL_FOLDER = str(tmp_path / 'spool')
+
+    app = create_app(Config)
     with app.app_context():
         db.create_all()
         yield app
@@ -24,9 +32,14 @@ def token(client):
     access_token = create_access_token(identity={'id': 1})
     return access_token
 
+def leaf_photo(color=(40, 160, 60), size=(64, 48)):
+    buffer = io.BytesIO()
+    PILImage.new('RGB', size, color).save(buffer, format='JPEG')
+    return buffer.getvalue()
+
 @pytest.fixture
 def image_file():
-    file = io.BytesIO(b"fake image content")
+    file = io.BytesIO(leaf_photo())
     file.name = 'test_image.jpg'
     return file
 
@@ -38,9 +51,15 @@ def uploaded_image(client, token, image_file):
     response_data = response.get_json()
     return response_data.get('image_id', None)
 
-def test_predict_disease_success(client, token, uploaded_image):
+class StubBackend:
+    # Stands in for the model file, which is not part of the repository
+    def predict(self, batch):
+        return np.tile(np.linspace(0.01, 0.1, 10, dtype=np.float32), (len(batch), 1))
+
+def test_predict_disease_success(client, token, uploaded_image, monkeypatch):
     if uploaded_image is None:
         pytest.skip("Image upload failed, skipping predict_disease_success test.")
+    monkeypatch.setattr('app.utils.model_utils._backend', StubBackend())
     
     response = client.get(f'/prediction/predict_disease/{uploaded_image}', headers={"Authorization": f"Bearer {token}"})
     assert response.status_code == 200, f"Response: {response.data}"
@@ -84,3 +103,357 @@ def test_predict_disease_failure(client, token, monkeypatch):
     assert response_data is not None
     assert response_data.get('message') == 'Prediction failed'
     assert 'error' in response_data
+
+def test_predict_disease_cache_hit_skips_model(client, token, monkeypatch):
+    calls = []
+
+    def mock_predict_disease(image_path):
+        calls.append(image_path)
+        return 'Corn___healthy', 97.5
+
+    monkeypatch.setattr('app.routes.prediction_routes.predict_disease', mock_predict_disease)
+
+    image_ids = []
+    for _ in range(2):
+        response = client.post('/image/upload_image', headers={"Authorization": f"Bearer {token}"},
+                               content_type='multipart/form-data',
+                               data={'image': (io.BytesIO(leaf_photo()), 'leaf.jpg')})
+        image_ids.append(response.get_json()['image_id'])
+
+    first = client.get(f'/prediction/predict_disease/{image_ids[0]}', headers={"Authorization": f"Bearer {token}"})
+    second = client.get(f'/prediction/predict_disease/{image_ids[1]}', headers={"Authorization": f"Bearer {token}"})
+    assert first.status_code == 200 and second.status_code == 200
+    assert first.get_json()['cached'] is False
+    assert second.get_json()['cached'] is True
+    assert second.get_json()['predicted_class'] == 'Corn___healthy'
+    assert len(calls) == 1
+
+    # A cache hit still records a prediction for the new image
+    assert Prediction.query.filter_by(image_id=image_ids[1]).count() == 1
+
+    stats = client.get('/prediction/cache_stats', headers={"Authorization": f"Bearer {token}"}).get_json()
+    assert stats['hits'] == 1
+    assert stats['misses'] == 1
+
+def test_predict_disease_persistent_cache(app, client, token, monkeypatch):
+    app.config['PREDICTION_CACHE_PERSISTENT'] = True
+    calls = []
+
+    def mock_predict_disease(image_path):
+        calls.append(image_path)
+        return 'Potato___Late_blight', 88.0
+
+    monkeypatch.setattr('app.routes.prediction_routes.predict_disease', mock_predict_disease)
+
+    response = client.post('/image/upload_image', headers={"Authorization": f"Bearer {token}"},
+                           content_type='multipart/form-data',
+                           data={'image': (io.BytesIO(leaf_photo((90, 140, 40))), 'leaf.jpg')})
+    image_id = response.get_json()['image_id']
+    client.get(f'/prediction/predict_disease/{image_id}', headers={"Authorization": f"Bearer {token}"})
+
+    # Simulate a restarted worker with an empty in-memory tier
+    app.extensions['prediction_cache'].clear()
+    response = client.get(f'/prediction/predict_disease/{image_id}', headers={"Authorization": f"Bearer {token}"})
+    assert response.get_json()['cached'] is True
+    assert len(calls) == 1
+    assert app.extensions['prediction_cache'].stats()['persistent_hits'] == 1
+
+def test_persistent_cache_writes_on_its_own_connection(app, monkeypatch):
+    from sqlalchemy import event
+    from app.models import PredictionCacheEntry
+    from app.utils.cache_utils import PredictionCache
+
+    cache = PredictionCache(persistent=True)
+    commits = []
+    def record(connection):
+        commits.append(connection)
+    event.listen(db.engine, 'commit', record)
+    try:
+        # Something the request has not committed yet stays uncommitted
+        db.session.add(Image(user_id=1, image_path='pending.jpg'))
+        cache.put_many([('a' * 64, 'v1', ('Corn___healthy', 97.0)), ('b' * 64, 'v1', ('Corn___Common_rust', 81.0))])
+        cache.put('a' * 64, 'v1', ('Corn___healthy', 98.0))
+    finally:
+        event.remove(db.engine, 'commit', record)
+    db.session.rollback()
+    assert len(commits) == 2  # one per put_many, however many entries
+    assert Image.query.count() == 0
+    entries = {entry.content_hash[0]: entry.confidence_percentage for entry in PredictionCacheEntry.query}
+    assert entries == {'a': 98.0, 'b': 81.0}
+
+def test_prediction_job_submit_and_poll(app, client, token, uploaded_image, monkeypatch):
+    app.config['PREDICTION_JOBS_EAGER'] = True
+    monkeypatch.setattr('app.routes.prediction_routes.predict_disease', lambda image_path: ('Strawberry___healthy', 91.0))
+
+    response = client.post(f'/prediction/predict_disease_async/{uploaded_image}', headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == 202, f"Response: {response.data}"
+    job_id = response.get_json()['job_id']
+
+    response = client.get(f'/prediction/jobs/{job_id}', headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == 200
+    data = response.get_json()
+    assert data['status'] == 'succeeded'
+    assert data['predicted_class'] == 'Strawberry___healthy'
+    assert Prediction.query.filter_by(id=data['prediction_id'], image_id=uploaded_image).first() is not None
+
+def test_prediction_job_failure_is_reported(app, client, token, uploaded_image, monkeypatch):
+    app.config['PREDICTION_JOBS_EAGER'] = True
+
+    def mock_predict_disease(image_path):
+        raise Exception("Test error")
+
+    monkeypatch.setattr('app.routes.prediction_routes.predict_disease', mock_predict_disease)
+
+    response = client.post(f'/prediction/predict_disease_async/{uploaded_image}', headers={"Authorization": f"Bearer {token}"})
+    job_id = response.get_json()['job_id']
+
+    data = client.get(f'/prediction/jobs/{job_id}', headers={"Authorization": f"Bearer {token}"}).get_json()
+    assert data['status'] == 'failed'
+    assert data['error'] == 'Test error'
+
+def test_recover_requeues_stale_running_jobs(app, uploaded_image, monkeypatch):
+    from datetime import datetime, timedelta
+    from app.commands import recover_jobs
+    from app.models import PredictionJob
+
+    monkeypatch.setattr('app.routes.prediction_routes.predict_disease', lambda image_path: ('Corn___healthy', 88.0))
+    now = datetime.utcnow()
+    jobs = {
+        'queued': PredictionJob(user_id=1, image_id=uploaded_image, status='queued'),
+        'lost': PredictionJob(user_id=1, image_id=uploaded_image, status='running', update_date=now - timedelta(hours=1)),
+        'busy': PredictionJob(user_id=1, image_id=uploaded_image, status='running', update_date=now)
+    }
+    db.session.add_all(jobs.values())
+    db.session.commit()
+    job_ids = {name: job.id for name, job in jobs.items()}
+
+    result = app.test_cli_runner().invoke(recover_jobs)
+    assert 'Ran 2 prediction job(s)' in result.output
+    db.session.expire_all()
+    statuses = {name: db.session.get(PredictionJob, job_id).status for name, job_id in job_ids.items()}
+    assert statuses == {'queued': 'succeeded', 'lost': 'succeeded', 'busy': 'running'}
+
+def test_requeued_job_does_not_record_a_second_prediction(app, client, token, uploaded_image, monkeypatch):
+    from datetime import datetime, timedelta
+    from app.models import PredictionJob
+
+    app.config['PREDICTION_JOBS_EAGER'] = True
+
+    def slow_predict_disease(image_path):
+        # Taken for lost while the model runs: requeued and claimed again by another worker
+        PredictionJob.query.update({'update_date': datetime.utcnow() + timedelta(hours=1)})
+        db.session.commit()
+        return 'Corn___healthy', 88.0
+
+    monkeypatch.setattr('app.routes.prediction_routes.predict_disease', slow_predict_disease)
+    response = client.post(f'/prediction/predict_disease_async/{uploaded_image}', headers={"Authorization": f"Bearer {token}"})
+    db.session.expire_all()
+    job = db.session.get(PredictionJob, response.get_json()['job_id'])
+    assert job.status == 'running' and job.prediction_id is None
+    assert Prediction.query.count() == 0
+
+def test_job_heartbeat_keeps_a_running_job_fresh(app, uploaded_image):
+    import time
+    from datetime import datetime, timedelta
+    from app.models import PredictionJob
+    from app.utils.job_utils import _Heartbeat
+
+    claimed_at = datetime.utcnow().replace(microsecond=0) - timedelta(hours=1)
+    job = PredictionJob(user_id=1, image_id=uploaded_image, status='running', update_date=claimed_at)
+    db.session.add(job)
+    db.session.commit()
+
+    heartbeat = _Heartbeat(app, job.id, claimed_at, 0.05)
+    time.sleep(0.3)
+    last_beat = heartbeat.stop()
+    db.session.expire_all()
+    assert last_beat > claimed_at and db.session.get(PredictionJob, job.id).update_date == last_beat
+
+def test_prediction_job_not_found(client, token):
+    response = client.get('/prediction/jobs/missing', headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == 404
+    assert response.get_json()['message'] == 'Job not found'
+
+def test_predict_disease_bulk_by_ids(client, token, monkeypatch):
+    batches = []
+
+    def mock_predict_images(image_paths):
+        batches.append(list(image_paths))
+        return [('Corn___Common_rust', 80.0 + i) for i in range(len(image_paths))]
+
+    monkeypatch.setattr('app.routes.prediction_routes.predict_images', mock_predict_images)
+
+    image_ids = []
+    for i in range(3):
+        response = client.post('/image/upload_image', headers={"Authorization": f"Bearer {token}"},
+                               content_type='multipart/form-data',
+                               data={'image': (io.BytesIO(leaf_photo((40, 60 + 40 * i, 60))), f'leaf{i}.jpg')})
+        image_ids.append(response.get_json()['image_id'])
+
+    response = client.post('/prediction/predict_disease_bulk', headers={"Authorization": f"Bearer {token}"},
+                           json={'image_ids': image_ids + [9999]})
+    assert response.status_code == 200, f"Response: {response.data}"
+    results = response.get_json()['results']
+    assert [r['image_id'] for r in results] == image_ids + [9999]
+    assert [r.get('confidence_percentage') for r in results[:3]] == [80.0, 81.0, 82.0]
+    assert results[3]['message'] == 'Image not found'
+    assert len(batches) == 1 and len(batches[0]) == 3
+    assert Prediction.query.count() == 3
+
+def test_predict_disease_bulk_multipart(client, token, monkeypatch):
+    monkeypatch.setattr('app.routes.prediction_routes.predict_images',
+                        lambda image_paths: [('Potato___healthy', 99.0)] * len(image_paths))
+
+    response = client.post('/prediction/predict_disease_bulk', headers={"Authorization": f"Bearer {token}"},
+                           content_type='multipart/form-data',
+                           data={'images': [(io.BytesIO(leaf_photo((40, 160, 60))), 'a.jpg'), (io.BytesIO(leaf_photo((120, 90, 30))), 'b.jpg')]})
+    assert response.status_code == 200, f"Response: {response.data}"
+    results = response.get_json()['results']
+    assert len(results) == 2
+    assert all(r['predicted_class'] == 'Potato___healthy' for r in results)
+    assert Image.query.count() == 2
+    assert Prediction.query.count() == 2
+
+def test_predict_disease_bulk_validation(app, client, token):
+    headers = {"Authorization": f"Bearer {token}"}
+    response = client.post('/prediction/predict_disease_bulk', headers=headers, json={})
+    assert response.status_code == 400
+    response = client.post('/prediction/predict_disease_bulk', headers=headers, json={'image_ids': 'abc'})
+    assert response.status_code == 400
+
+    for top_k in (True, False, '3'):
+        response = client.post('/prediction/predict_disease_bulk', headers=headers, json={'image_ids': [1], 'top_k': top_k})
+        assert response.status_code == 400 and response.get_json()['message'] == 'top_k must be an integer'
+
+    app.config['PREDICTION_BULK_MAX_IMAGES'] = 2
+    response = client.post('/prediction/predict_disease_bulk', headers=headers, json={'image_ids': [1, 2, 3]})
+    assert response.status_code == 400
+
+def test_predict_disease_bulk_refuses_extra_files_as_they_arrive(app, client, token, monkeypatch):
+    from app.utils import upload_utils
+
+    opened = []
+    class CountingUpload(upload_utils.IncomingUpload):
+        def __init__(self, *args, **kwargs):
+            opened.append(args[0])
+            super().__init__(*args, **kwargs)
+
+    monkeypatch.setattr(upload_utils, 'IncomingUpload', CountingUpload)
+    app.config['PREDICTION_BULK_MAX_IMAGES'] = 2
+    response = client.post('/prediction/predict_disease_bulk', headers={"Authorization": f"Bearer {token}"},
+                           content_type='multipart/form-data',
+                           data={'images': [(io.BytesIO(leaf_photo((40, 60 + 40 * i, 60))), f'{i}.jpg') for i in range(5)]})
+    assert response.status_code == 400
+    assert response.get_json()['message'] == 'At most 2 images can be uploaded per request'
+    # The third file is refused before it is spooled, and the first two are removed
+    assert len(opened) == 2 and not any(os.path.exists(path) for path in opened)
+
+def test_predict_disease_bulk_failure_discards_uploads(app, client, token, monkeypatch):
+    from app.utils.inference_pool import InferenceError
+
+    def failing_predict_images(image_paths):
+        raise InferenceError("Inference worker died")
+
+    monkeypatch.setattr('app.routes.prediction_routes.predict_images', failing_predict_images)
+    response = client.post('/prediction/predict_disease_bulk', headers={"Authorization": f"Bearer {token}"},
+                           content_type='multipart/form-data',
+                           data={'images': [(io.BytesIO(leaf_photo((40, 160, 60))), 'a.jpg'), (io.BytesIO(leaf_photo((120, 90, 30))), 'b.jpg')]})
+    assert response.status_code == 500
+    assert Image.query.count() == 0
+    # Only the (empty) spool folder is left
+    assert [files for _, _, files in os.walk(app.config['UPLOAD_FOLDER']) if files] == []
+
+def test_predict_disease_busy_returns_503(client, token, uploaded_image, monkeypatch):
+    from app.utils.inference_pool import InferencePoolBusy
+
+    def mock_predict_disease(image_path):
+        raise InferencePoolBusy("Inference queue is full")
+
+    monkeypatch.setattr('app.routes.prediction_routes.predict_disease', mock_predict_disease)
+
+    response = client.get(f'/prediction/predict_disease/{uploaded_image}', headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '1'
+    assert Prediction.query.count() == 0
+
+def test_predict_disease_top_k_and_stored_probabilities(client, token, uploaded_image, monkeypatch):
+    import numpy as np
+    from app.utils.model_utils import PredictionResult, unpack_probabilities
+
+    probabilities = np.array([0.6, 0.3, 0.1, 0, 0, 0, 0, 0, 0, 0], dtype=np.float32)
+    monkeypatch.setattr('app.routes.prediction_routes.predict_disease',
+                        lambda image_path: PredictionResult('Corn___Common_rust', 60.0, probabilities))
+
+    response = client.get(f'/prediction/predict_disease/{uploaded_image}?top_k=3', headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == 200, f"Response: {response.data}"
+    data = response.get_json()
+    assert [p['predicted_class'] for p in data['top_k']] == ['Corn___Common_rust', 'Corn___Gray_leaf_spot', 'Corn___Northern_Leaf_Blight']
+    assert data['top_k'][1]['confidence_percentage'] == 30.0
+
+    prediction_record = Prediction.query.filter_by(id=data['prediction_id']).first()
+    np.testing.assert_allclose(unpack_probabilities(prediction_record.probabilities), probabilities, atol=1e-3)
+
+    # Without top_k the response is unchanged
+    response = client.get(f'/prediction/predict_disease/{uploaded_image}', headers={"Authorization": f"Bearer {token}"})
+    assert 'top_k' not in response.get_json()
+
+def test_upload_and_predict(client, token, monkeypatch):
+    photo = leaf_photo((70, 150, 50))
+    received = []
+
+    def mock_predict_disease(image):
+        received.append(image)
+        return 'Strawberry___Leaf_scorch', 77.0
+
+    from app.utils import storage_utils
+    put_incoming = storage_utils._put_incoming
+    writers = []
+
+    def record_writer(*args):
+        writers.append(threading.current_thread().name)
+        return put_incoming(*args)
+
+    monkeypatch.setattr('app.routes.prediction_routes.predict_disease', mock_predict_disease)
+    monkeypatch.setattr(storage_utils, '_put_incoming', record_writer)
+
+    response = client.post('/prediction/upload_and_predict', headers={"Authorization": f"Bearer {token}"},
+                           content_type='multipart/form-data',
+                           data={'image': (io.BytesIO(photo), 'leaf.jpg')})
+    assert response.status_code == 201, f"Response: {response.data}"
+    data = response.get_json()
+    assert data['predicted_class'] == 'Strawberry___Leaf_scorch'
+
+    # Inference ran on the uploaded bytes, not on a re-read of the file, while another thread stored it
+    assert received == [photo]
+    assert len(writers) == 1 and writers[0].startswith('upload-store')
+
+    image_record = Image.query.get(data['image_id'])
+    with open(image_record.image_path, 'rb') as f:
+        assert f.read() == photo
+    prediction_record = Prediction.query.get(data['prediction_id'])
+    assert prediction_record.image_id == image_record.id
+
+def test_upload_and_predict_failure_leaves_nothing_behind(client, token, monkeypatch):
+    def mock_predict_disease(image):
+        raise Exception("Test error")
+
+    monkeypatch.setattr('app.routes.prediction_routes.predict_disease', mock_predict_disease)
+
+    response = client.post('/prediction/upload_and_predict', headers={"Authorization": f"Bearer {token}"},
+                           content_type='multipart/form-data',
+                           data={'image': (io.BytesIO(leaf_photo((150, 60, 40))), 'leaf.jpg')})
+    assert response.status_code == 500
+    assert response.get_json()['message'] == 'Upload and prediction failed'
+    assert Image.query.count() == 0
+    assert Prediction.query.count() == 0
+
+def test_predict_disease_failure_is_not_stored(client, token, uploaded_image, monkeypatch):
+    from app.utils.inference_pool import InferenceError
+
+    def mock_predict_disease(image_path):
+        raise InferenceError("Inference worker exited with code -9")
+
+    monkeypatch.setattr('app.routes.prediction_routes.predict_disease', mock_predict_disease)
+    response = client.get(f'/prediction/predict_disease/{uploaded_image}', headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == 500
+    assert Prediction.query.count() == 0
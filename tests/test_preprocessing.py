@@ -0,0 +1,58 @@
+import io
+import numpy as np
+import pytest
+from PIL import Image
+from app.utils import model_utils
+from app.utils.preprocessing import (
+    PILLOW_TOLERANCE_DRAFT_DECODE, PILLOW_TOLERANCE_FULL_DECODE, image_buffer,
+    preprocess_image_pillow, preprocess_image_tf
+)
+
+def leaf_like_jpeg(height, width, seed=0):
+    # Smooth colour gradients with a little sensor noise, roughly like a photo
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    pixels = np.stack([128 + 100 * np.sin(x / (width / 13) + c) * np.cos(y / (height / 7 + c)) for c in range(3)], axis=-1)
+    pixels += rng.normal(0, 6, pixels.shape)
+    buffer = io.BytesIO()
+    Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8)).save(buffer, format='JPEG', quality=90)
+    return buffer.getvalue()
+
+@pytest.mark.parametrize('height, width, tolerance', [
+    (256, 256, PILLOW_TOLERANCE_FULL_DECODE),
+    (300, 420, PILLOW_TOLERANCE_FULL_DECODE),
+    (2400, 3200, PILLOW_TOLERANCE_DRAFT_DECODE)
+])
+def test_pillow_matches_tensorflow_within_tolerance(height, width, tolerance):
+    pytest.importorskip('tensorflow')
+    image = leaf_like_jpeg(height, width)
+    expected = preprocess_image_tf(image, (256, 256))
+    actual = preprocess_image_pillow(image, (256, 256))
+    assert actual.shape == expected.shape == (256, 256, 3)
+    assert actual.dtype == np.float32
+    assert np.mean(np.abs(actual - expected)) <= tolerance
+
+def test_pillow_resize_matches_tensorflow_exactly_on_decoded_pixels():
+    tf = pytest.importorskip('tensorflow')
+    pixels = np.random.default_rng(1).integers(0, 256, size=(97, 131, 3), dtype=np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format='PNG')
+    expected = tf.image.resize(pixels, (256, 256)).numpy()
+    np.testing.assert_allclose(preprocess_image_pillow(buffer.getvalue(), (256, 256)), expected, atol=1e-3)
+
+def test_pillow_writes_into_given_buffer(tmp_path):
+    path = tmp_path / 'leaf.jpg'
+    path.write_bytes(leaf_like_jpeg(600, 800))
+    out = image_buffer((256, 256))
+    assert preprocess_image_pillow(str(path), (256, 256), out=out) is out
+    assert image_buffer((256, 256)) is out
+    assert 0 <= out.min() and out.max() <= 255
+
+def test_preprocess_image_uses_configured_backend(monkeypatch):
+    monkeypatch.setattr(model_utils, 'get_setting', lambda name, default=None: {'PREPROCESSING_BACKEND': 'pillow'}.get(name, default))
+    monkeypatch.setattr(model_utils, 'preprocess_image_tf', lambda image, size: pytest.fail("TensorFlow path used"))
+    assert model_utils.preprocess_image(leaf_like_jpeg(64, 64)).shape == (256, 256, 3)
+
+    monkeypatch.setattr(model_utils, 'get_setting', lambda name, default=None: {'PREPROCESSING_BACKEND': 'opencv'}.get(name, default))
+    with pytest.raises(ValueError):
+        model_utils.preprocess_image(leaf_like_jpeg(64, 64))
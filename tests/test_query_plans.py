@@ -0,0 +1,134 @@
+import pytest
+from app import create_app, db
+from app.models import CureSuggestion, Image, PlantDisease, Prediction
+from app.config import TestingConfig
+from flask_jwt_extended import create_access_token
+from sqlalchemy import event
+from datetime import datetime
+import re
+
+@pytest.fixture
+def app():
+    app = create_app(TestingConfig)
+    with app.app_context():
+        db.create_all()
+        disease = PlantDisease(disease_name='Corn___Common_rust')
+        db.session.add(disease)
+        db.session.commit()
+        db.session.add(CureSuggestion(disease_id=disease.id, suggestion='Apply a fungicide'))
+
+        for user_id in (1, 2):
+            image = Image(user_id=user_id, image_path='/path/to/image.jpg')
+            db.session.add(image)
+            db.session.commit()
+            for day in range(1, 6):
+                db.session.add(Prediction(
+                    user_id=user_id,
+                    image_id=image.id,
+                    predicted_class='Corn___healthy' if day % 2 else 'Corn___Common_rust',
+                    confidence_percentage=80.0,
+                    prediction_date=datetime(2024, 7, day)
+                ))
+        db.session.commit()
+        yield app
+        db.session.remove()
+        db.drop_all()
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+@pytest.fixture
+def token(client):
+    return create_access_token(identity={'id': 1})
+
+def query_plans(client, token, url, table):
+    # EXPLAIN QUERY PLAN of every statement on `table` that the endpoint runs
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if re.search(rf'FROM {table}\b', statement) and not statement.startswith('EXPLAIN'):
+            statements.append((statement, parameters))
+
+    event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        response = client.get(url, headers={"Authorization": f"Bearer {token}"})
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record)
+    assert response.status_code == 200
+    assert statements
+
+    plans = []
+    for statement, parameters in statements:
+        rows = db.session.connection().exec_driver_sql(f'EXPLAIN QUERY PLAN {statement}', parameters).all()
+        plans.append([row[-1] for row in rows])
+    return plans
+
+def assert_index_search(plan, table, index):
+    assert not any(step.startswith(f'SCAN {table}') for step in plan), plan
+    assert any(step.startswith(f'SEARCH {table} USING') and index in step for step in plan), plan
+
+@pytest.mark.parametrize('url', [
+    '/history/view_prediction_history',
+    '/history/view_prediction_history?start_date=2024-07-02&end_date=2024-07-04',
+    '/history/view_prediction_history?limit=2&cursor=WyIyMDI0LTA3LTAzVDAwOjAwOjAwIiwzXQ',
+    '/dashboard/recent_activity',
+])
+def test_date_ordered_history_uses_user_date_index(client, token, url):
+    for plan in query_plans(client, token, url, 'prediction'):
+        assert_index_search(plan, 'prediction', 'ix_prediction_user_id_prediction_date')
+        # Rows come out of the index already in date order
+        assert not any('TEMP B-TREE FOR ORDER BY' in step for step in plan), plan
+
+@pytest.mark.parametrize('url', [
+    '/dashboard/overview',
+    '/dashboard/predictions_by_crop_type',
+    '/stat/charts/number_of_predictions_per_class',
+])
+def test_dashboard_counts_read_a_users_counters(client, token, url):
+    # A range of the (user_id, predicted_class) key of the counters, never the predictions
+    for plan in query_plans(client, token, url, 'prediction_count'):
+        assert_index_search(plan, 'prediction_count', 'INDEX')
+    with pytest.raises(AssertionError):
+        query_plans(client, token, url, 'prediction')
+
+def test_per_class_counts_come_in_key_order(client, token):
+    plan, = query_plans(client, token, '/stat/charts/number_of_predictions_per_class', 'prediction_count')
+    assert not any('TEMP B-TREE' in step for step in plan), plan
+
+def test_global_overview_reads_only_the_counters(client, token):
+    plans = query_plans(client, token, '/stat/overview/all', 'prediction_count')
+    assert len(plans) == 1
+    with pytest.raises(AssertionError):
+        query_plans(client, token, '/stat/overview/all', 'prediction')
+
+def test_cure_suggestions_use_disease_index(client, token):
+    for plan in query_plans(client, token, '/suggestion/detailed_cure_suggestions?disease_name=Corn___Common_rust', 'cure_suggestion'):
+        assert_index_search(plan, 'cure_suggestion', 'ix_cure_suggestion_disease_id')
+
+def test_user_uploads_use_user_upload_date_index(app):
+    query = Image.query.filter(Image.user_id == 1).order_by(Image.upload_date.desc())
+    compiled = query.statement.compile(db.engine)
+    rows = db.session.connection().exec_driver_sql(
+        f'EXPLAIN QUERY PLAN {compiled}', tuple(compiled.params[name] for name in compiled.positiontup)
+    ).all()
+    plan = [row[-1] for row in rows]
+    assert_index_search(plan, 'image', 'ix_image_user_id_upload_date')
+    assert not any('TEMP B-TREE FOR ORDER BY' in step for step in plan), plan
+
+def test_predictions_over_time_reads_daily_counters(client, token):
+    for plan in query_plans(client, token, '/stat/charts/predictions_over_time?granularity=week', 'daily_prediction_count'):
+        assert_index_search(plan, 'daily_prediction_count', 'INDEX')
+    with pytest.raises(AssertionError):
+        query_plans(client, token, '/stat/charts/predictions_over_time', 'prediction')
+
+def test_confidence_distribution_reads_one_users_counters(client, token):
+    for plan in query_plans(client, token, '/stat/charts/confidence_percentage_distribution?by_class=true', 'confidence_count'):
+        assert_index_search(plan, 'confidence_count', 'INDEX')
+    with pytest.raises(AssertionError):
+        query_plans(client, token, '/stat/charts/confidence_percentage_distribution', 'prediction')
+
+def test_survey_statistics_read_only_the_counters(client, token):
+    query_plans(client, token, '/stat/statistics', 'survey_option_count')
+    with pytest.raises(AssertionError):
+        query_plans(client, token, '/stat/statistics', 'user_satisfaction_survey')
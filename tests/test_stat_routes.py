@@ -80,6 +80,32 @@ def test_get_number_of_predictions_per_class(client, token):
     assert sorted(data['classes']) == sorted(['Tomato___healthy', 'Tomato___Early_blight'])
     assert sorted(data['counts']) == sorted([1, 1])
 
+def test_get_predictions_over_time(client, token):
+    user = User.query.first()
+    for date in (datetime(2024, 7, 15, 14, 30), datetime(2024, 7, 15, 18, 0), datetime(2024, 7, 16, 10, 0), datetime(2024, 8, 2, 9, 0)):
+        db.session.add(Prediction(user_id=user.id, predicted_class='Tomato___healthy', confidence_percentage=90.0, prediction_date=date))
+    db.session.commit()
+    headers = {"Authorization": f"Bearer {token}"}
+
+    response = client.get('/stat/charts/predictions_over_time', headers=headers)
+    assert response.status_code == 200
+    assert response.get_json() == {
+        'granularity': 'day',
+        'dates': ['2024-07-15', '2024-07-16', '2024-08-02'],
+        'counts': [2, 1, 1]
+    }
+
+    response = client.get('/stat/charts/predictions_over_time?granularity=month&end_date=2024-07-31', headers=headers)
+    assert response.get_json() == {'granularity': 'month', 'dates': ['2024-07-01'], 'counts': [3]}
+
+    response = client.get('/stat/charts/predictions_over_time?granularity=week&start_date=2024-07-16', headers=headers)
+    assert response.get_json() == {'granularity': 'week', 'dates': ['2024-07-15', '2024-07-29'], 'counts': [1, 1]}
+
+def test_get_predictions_over_time_invalid_arguments(client, token):
+    headers = {"Authorization": f"Bearer {token}"}
+    assert client.get('/stat/charts/predictions_over_time?granularity=year', headers=headers).status_code == 400
+    assert client.get('/stat/charts/predictions_over_time?start_date=15/07/2024', headers=headers).status_code == 400
+
 def test_get_confidence_percentage_distribution(client, token):
     user = User.query.first()
     # Add some predictions with various confidence percentages
@@ -108,10 +134,31 @@ def test_get_confidence_percentage_distribution(client, token):
     assert response.status_code == 200
     data = response.get_json()
 
-    # Bins: [0, 10, 20, ..., 90, 100]
+    # Bins: [0, 10, 20, ..., 90], each labelled by its lower edge
     # Frequencies should reflect the correct bin counts
-    assert data['bins'] == [0, 10, 20, 30, 40, 50, 60, 70, 80, 90, 100]
-    assert data['frequency'] == [0, 0, 0, 0, 0, 1, 0, 0, 1, 1, 0]  # One in 50-60, 85-90, and 90-100 bins
+    assert data['bins'] == [0, 10, 20, 30, 40, 50, 60, 70, 80, 90]
+    assert data['frequency'] == [0, 0, 0, 0, 0, 1, 0, 0, 1, 1]  # One in 50-60, 80-90, and 90-100 bins
+    assert 'by_class' not in data
+
+def test_get_confidence_percentage_distribution_bin_width_and_classes(client, token):
+    user = User.query.first()
+    for predicted_class, confidence in (('Tomato___healthy', 100.0), ('Tomato___healthy', 74.9), ('Tomato___Early_blight', 75.0)):
+        db.session.add(Prediction(user_id=user.id, predicted_class=predicted_class, confidence_percentage=confidence))
+    db.session.commit()
+    headers = {"Authorization": f"Bearer {token}"}
+
+    response = client.get('/stat/charts/confidence_percentage_distribution?bin_width=25&by_class=true', headers=headers)
+    assert response.get_json() == {
+        'bins': [0, 25, 50, 75],
+        'frequency': [0, 0, 1, 2],  # 100% is counted in the last bin
+        'by_class': {'Tomato___healthy': [0, 0, 1, 1], 'Tomato___Early_blight': [0, 0, 0, 1]}
+    }
+    response = client.get('/stat/charts/confidence_percentage_distribution?bin_width=30', headers=headers)
+    assert response.get_json() == {'bins': [0, 30, 60, 90], 'frequency': [0, 0, 2, 1]}
+
+    for bin_width in ('0', '101', 'ten'):
+        response = client.get(f'/stat/charts/confidence_percentage_distribution?bin_width={bin_width}', headers=headers)
+        assert response.status_code == 400
 
 def test_get_statistics(client, token):
     user = User.query.first()
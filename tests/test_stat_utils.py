@@ -0,0 +1,235 @@
+import datetime
+import pytest
+from sqlalchemy.dialects import mysql as mysql_dialect, postgresql as postgresql_dialect
+from app import create_app, db
+from app.commands import backfill_daily, reconcile
+from app.config import TestingConfig
+from app.models import ConfidenceCount, DailyPredictionCount, Image, Prediction, PredictionCount, SurveyOptionCount, UserSatisfactionSurvey
+from app.utils.stat_utils import (
+    class_counts, confidence_histogram, date_bucket, health_counts, percent_bucket, plant_counts, prediction_time_series,
+    reconcile_confidence_counts, reconcile_daily_counts, reconcile_prediction_counts, reconcile_survey_counts,
+    survey_option_counts, uncount_predictions
+)
+
+@pytest.fixture
+def app():
+    app = create_app(TestingConfig)
+    with app.app_context():
+        db.create_all()
+        yield app
+        db.session.remove()
+        db.drop_all()
+
+def add_predictions(user_id, *classes, image_id=None):
+    predictions = [Prediction(user_id=user_id, image_id=image_id, predicted_class=c, confidence_percentage=90.0) for c in classes]
+    db.session.add_all(predictions)
+    db.session.commit()
+    return predictions
+
+def counters():
+    return {(c.user_id, c.predicted_class): c.count for c in PredictionCount.query.all()}
+
+def daily_counters():
+    return {(c.user_id, c.day): c.count for c in DailyPredictionCount.query.all()}
+
+def confidence_counters():
+    return {(c.user_id, c.predicted_class, c.percent): c.count for c in ConfidenceCount.query.all()}
+
+def test_counters_follow_inserts(app):
+    add_predictions(1, 'Corn___healthy', 'Corn___healthy', 'Potato___Late_blight', 'Unknown___Unexpected_input')
+    add_predictions(2, 'Corn___Common_rust')
+
+    assert counters() == {
+        (1, 'Corn___healthy'): 2, (1, 'Potato___Late_blight'): 1, (1, 'Unknown___Unexpected_input'): 1, (2, 'Corn___Common_rust'): 1
+    }
+    counter = PredictionCount.query.filter_by(user_id=1, predicted_class='Potato___Late_blight').one()
+    assert (counter.plant_name, counter.health_status) == ('Potato', 'diseased')
+
+    assert class_counts(1) == [('Corn___healthy', 2), ('Potato___Late_blight', 1), ('Unknown___Unexpected_input', 1)]
+    assert plant_counts(1) == {'Corn': 2, 'Potato': 1, 'Unknown': 1}
+    assert health_counts(1) == {'predictions_made': 4, 'healthy_plants': 2, 'diseased_plants': 1}
+    assert health_counts() == {'predictions_made': 5, 'healthy_plants': 2, 'diseased_plants': 2}
+
+def test_counters_follow_updates_and_deletes(app):
+    first, second = add_predictions(1, 'Corn___healthy', 'Corn___healthy')
+
+    first.predicted_class = 'Corn___Common_rust'
+    second.user_id = 2
+    db.session.commit()
+    assert counters() == {(1, 'Corn___healthy'): 0, (1, 'Corn___Common_rust'): 1, (2, 'Corn___healthy'): 1}
+
+    db.session.delete(first)
+    db.session.commit()
+    assert class_counts(1) == []
+    assert health_counts() == {'predictions_made': 1, 'healthy_plants': 1, 'diseased_plants': 0}
+
+def test_counters_roll_back_with_the_prediction(app):
+    add_predictions(1, 'Corn___healthy')
+    db.session.add(Prediction(user_id=1, predicted_class='Corn___healthy'))
+    db.session.flush()
+    db.session.rollback()
+    assert counters() == {(1, 'Corn___healthy'): 1}
+
+def test_uncount_before_bulk_delete(app):
+    image = Image(user_id=1, image_path='/path/to/image.jpg')
+    db.session.add(image)
+    db.session.commit()
+    add_predictions(1, 'Corn___healthy', 'Potato___Early_blight', image_id=image.id)
+    add_predictions(1, 'Corn___healthy')
+
+    criteria = Prediction.image_id == image.id
+    uncount_predictions(criteria)
+    db.session.execute(db.delete(Prediction).where(criteria))
+    db.session.commit()
+    assert class_counts(1) == [('Corn___healthy', 1)]
+    assert reconcile_prediction_counts(dry_run=True) == 0
+    assert reconcile_daily_counts(dry_run=True) == 0
+    assert reconcile_confidence_counts(dry_run=True) == 0
+
+def test_reconcile_repairs_drift(app):
+    add_predictions(1, 'Corn___healthy', 'Corn___healthy')
+    add_predictions(2, 'Strawberry___Leaf_scorch')
+    # Changes made behind the app's back, e.g. in SQL or by restoring a backup
+    db.session.execute(db.update(PredictionCount).where(PredictionCount.user_id == 2).values(count=7))
+    db.session.execute(db.delete(PredictionCount).where(PredictionCount.user_id == 1))
+    db.session.add(PredictionCount(user_id=3, predicted_class='Corn___healthy', count=4))
+    db.session.commit()
+
+    result = app.test_cli_runner().invoke(reconcile, ['--dry-run'])
+    assert 'Would fix 3 prediction counter(s)' in result.output
+    assert counters()[(2, 'Strawberry___Leaf_scorch')] == 7
+
+    result = app.test_cli_runner().invoke(reconcile)
+    assert 'Fixed 3 prediction counter(s)' in result.output
+    assert 'Fixed 0 confidence counter(s)' in result.output
+    assert counters() == {(1, 'Corn___healthy'): 2, (2, 'Strawberry___Leaf_scorch'): 1, (3, 'Corn___healthy'): 0}
+    assert reconcile_prediction_counts() == 0
+
+def test_daily_counters_follow_the_prediction_date(app):
+    first, second = add_predictions(1, 'Corn___healthy', 'Corn___healthy')
+    first.prediction_date = datetime.datetime(2024, 7, 1, 23, 59)
+    second.prediction_date = datetime.datetime(2024, 7, 1, 8, 0)
+    db.session.commit()
+    assert daily_counters() == {(1, datetime.date(2024, 7, 1)): 2, (1, datetime.datetime.utcnow().date()): 0}
+
+    second.prediction_date = datetime.datetime(2024, 7, 2, 8, 0)
+    db.session.commit()
+    db.session.delete(first)
+    db.session.commit()
+    assert prediction_time_series(1) == [(datetime.date(2024, 7, 2), 1)]
+    assert reconcile_daily_counts(dry_run=True) == 0
+
+def test_time_series_buckets(app):
+    for day in (datetime.date(2024, 7, 1), datetime.date(2024, 7, 7), datetime.date(2024, 7, 8), datetime.date(2024, 8, 31)):
+        db.session.add(Prediction(user_id=1, predicted_class='Corn___healthy', prediction_date=datetime.datetime.combine(day, datetime.time(12))))
+    db.session.add(Prediction(user_id=2, predicted_class='Corn___healthy', prediction_date=datetime.datetime(2024, 7, 1)))
+    db.session.commit()
+
+    assert prediction_time_series(1, 'day') == [
+        (datetime.date(2024, 7, 1), 1), (datetime.date(2024, 7, 7), 1), (datetime.date(2024, 7, 8), 1), (datetime.date(2024, 8, 31), 1)
+    ]
+    # ISO weeks start on Monday: 1 July 2024 was one, 7 July the Sunday after
+    assert prediction_time_series(1, 'week') == [
+        (datetime.date(2024, 7, 1), 2), (datetime.date(2024, 7, 8), 1), (datetime.date(2024, 8, 26), 1)
+    ]
+    assert prediction_time_series(1, 'month') == [(datetime.date(2024, 7, 1), 3), (datetime.date(2024, 8, 1), 1)]
+    assert prediction_time_series(1, 'month', datetime.date(2024, 7, 7), datetime.date(2024, 7, 31)) == [(datetime.date(2024, 7, 1), 2)]
+
+def test_date_bucket_sql_for_other_databases():
+    day = DailyPredictionCount.__table__.c.day
+    mysql = str(date_bucket(day, 'week', 'mysql').compile(dialect=mysql_dialect.dialect()))
+    assert mysql == 'subdate(date(daily_prediction_count.day), weekday(date(daily_prediction_count.day)))'
+    postgresql = str(date_bucket(day, 'month', 'postgresql').compile(dialect=postgresql_dialect.dialect()))
+    assert postgresql == 'CAST(date_trunc(%(date_trunc_1)s::VARCHAR, daily_prediction_count.day) AS DATE)'
+    with pytest.raises(ValueError):
+        date_bucket(day, 'year', 'sqlite')
+
+def test_backfill_daily_counts(app):
+    add_predictions(1, 'Corn___healthy', 'Potato___healthy')
+    db.session.add(Prediction(user_id=2, predicted_class='Corn___healthy', prediction_date=datetime.datetime(2023, 1, 15)))
+    db.session.commit()
+    # As after restoring predictions without their counters
+    db.session.execute(db.delete(DailyPredictionCount))
+    db.session.add(DailyPredictionCount(user_id=3, day=datetime.date(2023, 6, 1), count=5))
+    db.session.commit()
+
+    result = app.test_cli_runner().invoke(backfill_daily, ['--dry-run'])
+    assert 'Would fix 3 daily prediction counter(s)' in result.output
+    result = app.test_cli_runner().invoke(backfill_daily)
+    assert 'Fixed 3 daily prediction counter(s)' in result.output
+    assert daily_counters() == {
+        (1, datetime.datetime.utcnow().date()): 2, (2, datetime.date(2023, 1, 15)): 1, (3, datetime.date(2023, 6, 1)): 0
+    }
+    assert reconcile_daily_counts() == 0
+
+def test_confidence_counters_follow_the_percentage(app):
+    first, second = add_predictions(1, 'Corn___healthy', 'Corn___healthy')
+    first.confidence_percentage = 90.9  # same whole percent, so nothing moves
+    second.confidence_percentage = 100.0
+    db.session.commit()
+    assert confidence_counters() == {(1, 'Corn___healthy', 90): 1, (1, 'Corn___healthy', 99): 1}
+
+    second.predicted_class = 'Corn___Common_rust'
+    second.confidence_percentage = 42.5
+    db.session.commit()
+    db.session.delete(first)
+    db.session.commit()
+    assert confidence_counters() == {(1, 'Corn___healthy', 90): 0, (1, 'Corn___healthy', 99): 0, (1, 'Corn___Common_rust', 42): 1}
+    assert reconcile_confidence_counts(dry_run=True) == 0
+
+def test_confidence_histogram(app):
+    for confidence in (0.0, 9.99, 10.0, 55.5, 99.5, 100.0):
+        db.session.add(Prediction(user_id=1, predicted_class='Corn___healthy', confidence_percentage=confidence))
+    db.session.add(Prediction(user_id=1, predicted_class='Potato___healthy', confidence_percentage=57.0))
+    db.session.add(Prediction(user_id=2, predicted_class='Corn___healthy', confidence_percentage=50.0))
+    db.session.commit()
+
+    assert confidence_histogram(1) == ([0, 10, 20, 30, 40, 50, 60, 70, 80, 90], [2, 1, 0, 0, 0, 2, 0, 0, 0, 2], None)
+    bins, frequency, by_class = confidence_histogram(1, 50, by_class=True)
+    assert (bins, frequency) == ([0, 50], [3, 4])
+    assert by_class == {'Corn___healthy': [3, 3], 'Potato___healthy': [0, 1]}
+    assert confidence_histogram(3, 100) == ([0], [0], None)
+
+def test_reconcile_confidence_counts(app):
+    add_predictions(1, 'Corn___healthy', 'Corn___healthy')
+    add_predictions(250, 'Potato___healthy')
+    db.session.execute(db.delete(ConfidenceCount).where(ConfidenceCount.user_id == 250))
+    db.session.execute(db.update(ConfidenceCount).values(count=5))
+    db.session.add(ConfidenceCount(user_id=3, predicted_class='Corn___healthy', percent=12, count=1))
+    db.session.commit()
+
+    assert reconcile_confidence_counts(dry_run=True) == 3
+    assert reconcile_confidence_counts() == 3
+    assert confidence_counters() == {(1, 'Corn___healthy', 90): 2, (250, 'Potato___healthy', 90): 1, (3, 'Corn___healthy', 12): 0}
+    assert reconcile_confidence_counts() == 0
+
+def test_percent_bucket_sql_for_other_databases():
+    confidence = Prediction.__table__.c.confidence_percentage
+    postgresql = str(percent_bucket(confidence, 'postgresql').compile(dialect=postgresql_dialect.dialect(), compile_kwargs={'literal_binds': True}))
+    assert postgresql == (
+        'CASE WHEN (prediction.confidence_percentage >= 100) THEN 99 WHEN (prediction.confidence_percentage < 0) THEN 0 '
+        'ELSE CAST(floor(prediction.confidence_percentage) AS INTEGER) END'
+    )
+
+def test_survey_option_counts(app):
+    db.session.add(UserSatisfactionSurvey(user_id=1, satisfaction='Satisfied', recommendation='Yes', usefulness='Feature1,Feature2'))
+    survey = UserSatisfactionSurvey(user_id=2, satisfaction='Satisfied', recommendation='No', desired_features='Feature3')
+    db.session.add(survey)
+    db.session.commit()
+    assert survey_option_counts() == {
+        'satisfaction': {'Satisfied': 2}, 'recommendation': {'No': 1, 'Yes': 1},
+        'usefulness': {'Feature1': 1, 'Feature2': 1}, 'desired_features': {'Feature3': 1}
+    }
+
+    db.session.delete(survey)
+    db.session.commit()
+    assert survey_option_counts() == {'satisfaction': {'Satisfied': 1}, 'recommendation': {'Yes': 1}, 'usefulness': {'Feature1': 1, 'Feature2': 1}}
+    assert reconcile_survey_counts(dry_run=True) == 0
+
+    db.session.execute(db.update(SurveyOptionCount).where(SurveyOptionCount.option == 'Feature1').values(count=9))
+    db.session.execute(db.delete(SurveyOptionCount).where(SurveyOptionCount.question == 'satisfaction'))
+    db.session.commit()
+    result = app.test_cli_runner().invoke(reconcile)
+    assert 'Fixed 2 survey option counter(s)' in result.output
+    assert survey_option_counts()['usefulness'] == {'Feature1': 1, 'Feature2': 1}
+    assert survey_option_counts()['satisfaction'] == {'Satisfied': 1}
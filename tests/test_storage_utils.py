@@ -0,0 +1,218 @@
+import io
+import numpy as np
+import os
+import pytest
+from urllib.parse import parse_qs, urlparse
+from app import create_app, db
+from app.commands import rehash
+from app.config import TestingConfig
+from app.models import Blob, Image, Prediction
+from app.utils import model_utils
+from app.utils.storage_utils import S3Storage, get_storage, image_source, store_bytes, store_stream, upload_url_path
+from flask_jwt_extended import create_access_token
+from PIL import Image as PILImage
+
+@pytest.fixture
+def app(tmp_path):
+    class Config(TestingConfig):
+        UPLOAD_FOLDER = str(tmp_path / 'uploads')
+
+    app = create_app(Config)
+    with app.app_context():
+        db.create_all()
+        yield app
+        db.session.remove()
+        db.drop_all()
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+@pytest.fixture
+def token(client):
+    return create_access_token(identity={'id': 1})
+
+def leaf_photo(color=(40, 160, 60), size=(64, 48)):
+    buffer = io.BytesIO()
+    PILImage.new('RGB', size, color).save(buffer, format='JPEG')
+    return buffer.getvalue()
+
+def upload(client, token, content, filename='leaf.jpg'):
+    return client.post('/image/upload_image', headers={"Authorization": f"Bearer {token}"},
+                       content_type='multipart/form-data',
+                       data={'image': (io.BytesIO(content), filename)})
+
+def test_store_stream_shards_by_content_hash(app):
+    image_path, content_hash = store_stream(io.BytesIO(b"leaf photo"), 'Leaf.JPEG')
+    assert upload_url_path(image_path) == f"{content_hash[:2]}/{content_hash[2:4]}/{content_hash}.jpg"
+    with open(image_path, 'rb') as f:
+        assert f.read() == b"leaf photo"
+    assert not os.listdir(os.path.join(app.config['UPLOAD_FOLDER'], '.incoming'))
+
+def test_duplicate_uploads_share_one_blob(app, client, token):
+    photo = leaf_photo()
+    first = upload(client, token, photo).get_json()
+    second = upload(client, token, photo, filename='copy.png').get_json()
+    upload(client, token, leaf_photo((120, 90, 30)))
+
+    assert first['file_path'] == second['file_path']
+    first_image = db.session.get(Image, first['image_id'])
+    blob = db.session.get(Blob, first_image.content_hash)
+    assert blob.ref_count == 2
+    assert Blob.query.count() == 2
+
+    db.session.delete(first_image)
+    db.session.commit()
+    db.session.refresh(blob)
+    assert blob.ref_count == 1
+
+    # Served from its nested path
+    response = client.get(f"/static/uploads/{upload_url_path(second['file_path'])}")
+    assert response.status_code == 200 and response.data == photo
+
+def test_rehash_moves_flat_uploads(app):
+    folder = app.config['UPLOAD_FOLDER']
+    os.makedirs(folder, exist_ok=True)
+    paths = []
+    for name, content in [('a_leaf.jpg', b"leaf one"), ('b_leaf.jpg', b"leaf one"), ('c_leaf.jpg', b"leaf two")]:
+        paths.append(os.path.join(folder, name))
+        with open(paths[-1], 'wb') as f:
+            f.write(content)
+    thumbnail_path = os.path.join(folder, 'a_leaf_thumbnail.jpg')
+    with open(thumbnail_path, 'wb') as f:
+        f.write(b"thumbnail")
+
+    db.session.add_all([Image(user_id=1, image_path=path) for path in paths])
+    db.session.add(Image(user_id=1, image_path=os.path.join(folder, 'gone.jpg')))
+    db.session.get(Image, 1).thumbnail_path = thumbnail_path
+    db.session.commit()
+    db.session.remove()
+
+    result = app.test_cli_runner().invoke(rehash, ['--batch-size', '2'])
+    assert result.exit_code == 0, result.output
+    assert 'Moved 3 upload(s), 1 of them duplicates; 1 missing file(s)' in result.output
+
+    images = Image.query.order_by(Image.id).all()
+    assert images[0].image_path == images[1].image_path != images[2].image_path
+    assert images[3].content_hash is None
+    assert all(os.path.isfile(image.image_path) for image in images[:3])
+    assert not any(os.path.exists(path) for path in paths)
+    assert images[0].thumbnail_path.endswith(f"{images[0].content_hash}_thumbnail.jpg")
+    assert os.path.isfile(images[0].thumbnail_path)
+    assert sorted(blob.ref_count for blob in Blob.query) == [1, 2]
+
+def test_store_bytes_reuses_existing_blob(app):
+    first_path, content_hash = store_bytes(b"leaf", 'leaf.jpg')
+    db.session.add(Image(user_id=1, image_path=first_path, content_hash=content_hash))
+    db.session.commit()
+    second_path, _ = store_bytes(b"leaf", 'leaf.webp')
+    assert second_path == first_path
+
+@pytest.fixture
+def s3_app(tmp_path, monkeypatch):
+    moto = pytest.importorskip('moto')
+    boto3 = pytest.importorskip('boto3')
+    for name in ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY'):
+        monkeypatch.setenv(name, 'testing')
+
+    class Config(TestingConfig):
+        STORAGE_BACKEND = 's3'
+        S3_BUCKET = 'leaf-uploads'
+        S3_PREFIX = 'uploads'
+        S3_REGION = 'us-east-1'
+        UPLOAD_FOLDER = str(tmp_path / 'unused')
+        UPLOAD_SPOOL_FOLDER = str(tmp_path / 'spool')
+
+    with moto.mock_aws():
+        boto3.client('s3', region_name='us-east-1').create_bucket(Bucket='leaf-uploads')
+        app = create_app(Config)
+        with app.app_context():
+            db.create_all()
+            yield app
+            db.session.remove()
+            db.drop_all()
+
+def test_s3_storage_round_trip(s3_app):
+    storage = get_storage()
+    assert isinstance(storage, S3Storage)
+    storage.put_bytes(b"leaf", 'ab/cd/leaf.jpg')
+    assert storage.exists('ab/cd/leaf.jpg') and not storage.exists('ab/cd/other.jpg')
+    assert storage.size('ab/cd/leaf.jpg') == 4
+    assert storage.open('ab/cd/leaf.jpg').read(2) == b"le"
+    assert image_source('ab/cd/leaf.jpg') == b"leaf"
+    storage.put_bytes(b"old", 'legacy.jpg')
+    assert [(key, size) for key, size, _ in storage.iter_files()] == [('ab/cd/leaf.jpg', 4), ('legacy.jpg', 3)]
+    storage.delete('ab/cd/leaf.jpg')
+    assert not storage.exists('ab/cd/leaf.jpg')
+
+def test_s3_upload_variants_and_serving(s3_app, tmp_path):
+    client = s3_app.test_client()
+    token = create_access_token(identity={'id': 1})
+    photo = io.BytesIO()
+    PILImage.new('RGB', (800, 600), (40, 160, 60)).save(photo, format='JPEG')
+
+    data = upload(client, token, photo.getvalue()).get_json()
+    image_record = db.session.get(Image, data['image_id'])
+    key = image_record.image_path
+    assert not os.path.isabs(key) and key.endswith(f"{image_record.content_hash}.jpg")
+    assert image_record.thumbnail_path == key.replace('.jpg', '_thumbnail.jpg')
+
+    objects = boto3_keys(s3_app)
+    assert f"uploads/{key}" in objects and f"uploads/{image_record.thumbnail_path}" in objects
+    assert not os.listdir(tmp_path / 'spool')
+
+    assert storage_object(s3_app, key) == photo.getvalue()
+    with PILImage.open(io.BytesIO(storage_object(s3_app, image_record.thumbnail_path))) as thumbnail:
+        assert thumbnail.size == (150, 113)
+
+    # Browsers fetch the bytes from the bucket, never through the app
+    response = client.get(f"/static/uploads/{key}")
+    assert response.status_code == 302
+    location = response.headers['Location']
+    assert f"/uploads/{key}" in location and 'Signature' in location
+    assert 'immutable' in parse_qs(urlparse(location).query)['response-cache-control'][0]
+    assert response.headers['ETag'] == f'"{image_record.content_hash}"'
+    response = client.get(f"/static/uploads/{key}", headers={'If-None-Match': f'"{image_record.content_hash}"'})
+    assert response.status_code == 304
+    thumbnail = client.get(f"/static/uploads/{key}?variant=thumbnail")
+    assert f"/uploads/{image_record.thumbnail_path}" in thumbnail.headers['Location']
+    assert client.get('/static/uploads/ab/cd/missing.jpg').status_code == 404
+
+    s3_app.extensions['storage'].public_url = 'https://cdn.example.com/leaves'
+    assert client.get(f"/static/uploads/{key}").headers['Location'] == f"https://cdn.example.com/leaves/uploads/{key}"
+
+def storage_object(app, key):
+    storage = app.extensions['storage']
+    return storage.client.get_object(Bucket=storage.bucket, Key=storage._object_key(key))['Body'].read()
+
+def boto3_keys(app):
+    storage = app.extensions['storage']
+    return {item['Key'] for item in storage.client.list_objects_v2(Bucket=storage.bucket).get('Contents', [])}
+
+def test_prediction_and_pdf_read_through_s3(s3_app, monkeypatch):
+    storage = get_storage()
+    photo = io.BytesIO()
+    PILImage.new('RGB', (64, 64), (40, 160, 60)).save(photo, format='JPEG')
+    storage.put_bytes(photo.getvalue(), 'ab/cd/leaf.jpg')
+
+    received = []
+    def mock_preprocess_image(image, out=None):
+        received.append(image)
+        return np.zeros((256, 256, 3), dtype=np.float32)
+
+    monkeypatch.setattr(model_utils, 'preprocess_image', mock_preprocess_image)
+    monkeypatch.setattr(model_utils, 'predict_batch', lambda images: [('Corn___healthy', 90.0)] * len(images))
+    monkeypatch.setattr(model_utils, '_backend', object())
+    s3_app.config['INFERENCE_BATCHING'] = False
+    assert model_utils.predict_disease('ab/cd/leaf.jpg') == ('Corn___healthy', 90.0)
+    assert received == [photo.getvalue()]
+
+    image = Image(user_id=1, image_path='ab/cd/leaf.jpg')
+    db.session.add(image)
+    db.session.flush()
+    db.session.add(Prediction(user_id=1, image_id=image.id, predicted_class='Corn___healthy', confidence_percentage=90.0))
+    db.session.commit()
+    token = create_access_token(identity={'id': 1})
+    response = s3_app.test_client().get('/history/download_prediction_history_pdf', headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == 200
+    assert b'/Subtype /Image' in response.data
@@ -1,6 +1,6 @@
 import pytest
 from app import create_app, db
-from app.models import User, UserSatisfactionSurvey
+from app.models import SurveyAnswer, SurveyOptionCount, User, UserSatisfactionSurvey
 from app.config import TestingConfig
 from flask_jwt_extended import create_access_token
 
@@ -85,3 +85,31 @@ def test_submit_survey_missing_data(client, token):
     response = client.post('/survey/submit', headers={"Authorization": f"Bearer {token}"}, json=data)
     assert response.status_code == 500
     assert "An error occurred" in response.get_json()['message']
+
+def option_counts():
+    return {(c.question, c.option): c.count for c in SurveyOptionCount.query.all() if c.count}
+
+def test_submit_survey_keeps_option_counters(client, token):
+    headers = {"Authorization": f"Bearer {token}"}
+    data = {
+        "satisfaction": "Satisfied",
+        "usefulness": ["Feature1", "Feature2", "Feature1"],
+        "desiredFeatures": ["FeatureA"],
+        "recommendation": "Likely"
+    }
+    assert client.post('/survey/submit', headers=headers, json=data).status_code == 201
+    assert option_counts() == {
+        ('satisfaction', 'Satisfied'): 1, ('recommendation', 'Likely'): 1,
+        ('usefulness', 'Feature1'): 1, ('usefulness', 'Feature2'): 1, ('desired_features', 'FeatureA'): 1
+    }
+    kept = SurveyAnswer.query.filter_by(question='usefulness', option='Feature2').one().id
+
+    # Replacing the survey moves only the answers that changed
+    data.update(satisfaction="Very satisfied", usefulness=["Feature2", "Feature3"], desiredFeatures=[])
+    assert client.post('/survey/submit', headers=headers, json=data).status_code == 200
+    assert option_counts() == {
+        ('satisfaction', 'Very satisfied'): 1, ('recommendation', 'Likely'): 1,
+        ('usefulness', 'Feature2'): 1, ('usefulness', 'Feature3'): 1
+    }
+    assert SurveyAnswer.query.filter_by(question='usefulness', option='Feature2').one().id == kept
+    assert UserSatisfactionSurvey.query.one().desired_features == ''